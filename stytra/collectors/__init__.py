@@ -1,2 +1,4 @@
 from stytra.collectors.accumulators import *
 from stytra.collectors.data_collector import *
+from stytra.collectors.latency import *
+from stytra.collectors.log_stream import *
@@ -4,9 +4,10 @@ import numpy as np
 from queue import Empty
 import pandas as pd
 from collections import namedtuple
-from bisect import bisect_right
 from os.path import basename
 
+from stytra.collectors.log_stream import LogStreamWriter
+from stytra.collectors.row_ring import RowRing
 from stytra.utilities import save_df
 
 
@@ -15,38 +16,76 @@ class Accumulator(QObject):
         super().__init__()
         self.name = name
         self.exp = experiment
-        self.stored_data = []
-        self.times = []
         self.max_history_if_not_running = max_history_if_not_running
 
 
+class StoredRows:
+    """ Read-only list-like view of the rows of a
+    :class:`DataFrameAccumulator` as namedtuples (without the time), kept
+    for compatibility with the code using the stored_data list. The rows are
+    built on access, so the column arrays should be used where speed
+    matters.
+    """
+
+    def __init__(self, accumulator):
+        self.acc = accumulator
+
+    def __len__(self):
+        return self.acc.n_stored
+
+    def __getitem__(self, item):
+        values = self.acc.get_last_n()
+        if values is None:
+            values = np.zeros((0, 1))
+        if isinstance(item, slice):
+            return [self.acc._row_type(*row[1:]) for row in values[item]]
+        return self.acc._row_type(*values[item, 1:])
+
+    def __iter__(self):
+        return iter(self[:])
+
+
 class DataFrameAccumulator(Accumulator):
     """Abstract class for accumulating streams of data.
 
     It is use to save or plot in real time data from stimulus logs or
-    behavior tracking. Data is stored in a list in the stored_data
-    attribute.
+    behavior tracking. The data is stored in columns, in a preallocated
+    2D float64 array (one contiguous row per column, the first being the
+    time), whose capacity is doubled when it is full.
 
     Specific methods
-    for updating the stored_data list (e.g., by acquiring data from a
+    for updating the stored data (e.g., by acquiring data from a
     Queue or a DynamicStimulus attribute) are defined in subclasses of the
-    Accumulator.
+    Accumulator, which add the data points with :meth:`append`.
+
+    The data points are NamedTuples of numbers, whose fields give the
+    columns. Therefore, the data of an Accumulator that is fed 2 values
+    will be stored as the columns t, x and y.
 
-    Data that end up in the stored_data list must be NamedTuples where the first
-    element is a timestamp.
-    Therefore, stored_data of an Accumulator that is fed 2 values will be
-    something like
-    [(t_0, x_0, y_0), (t_0, x_0, y_0), ...]
+    For compatibility, stored_data gives the data points as a list of
+    NamedTuples, and times the times as an array. If the data come from
+    camera frames, the index of the frame of each data point (or -1) is kept
+    in the frame_indices array, and saved in the frame_index column.
 
+    The last data points are given as a numpy array by :meth:`get_last_n()
+    <Accumulator.get_last_n()>` and :meth:`get_last_t()
+    <Accumulator.get_last_t()>` without copying, and as a pandas DataFrame
+    by :meth:`get_dataframe() <Accumulator.get_dataframe()>`. The data
+    points in a time window are found by binary search on the times by
+    :meth:`get_window() <Accumulator.get_window()>`, and the data of
+    multiple accumulators can be aligned in time with :func:`join_asof`.
 
-    Data can be retrieved from the Accumulator as a pandas DataFrame with the
-    :meth:`get_dataframe() <Accumulator.get_dataframe()>` method.
+    With :meth:`stream_to() <Accumulator.stream_to()>`, the data are
+    written to disk in chunks while they are acquired, and only the last
+    ones are kept in memory.
 
 
     Parameters
     ----------
     fps_calc_points : int
         number of data points used to calculate the sampling rate of the data.
+    initial_capacity : int
+        number of data points for which memory is allocated at first
 
     Returns
     -------
@@ -58,23 +97,51 @@ class DataFrameAccumulator(Accumulator):
     sig_acc_reset = pyqtSignal()
     sig_acc_init = pyqtSignal()
 
-    def __init__(self, *args, fps_calc_points=10, monitored_headers=None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        fps_calc_points=10,
+        monitored_headers=None,
+        initial_capacity=1024,
+        **kwargs
+    ):
         super().__init__(*args, **kwargs)
         """ """
         self.plot_columns = monitored_headers
         self.fps_calc_points = fps_calc_points
         self._header_dict = None
+        self._row_type = None
+        self._values = np.full((1, initial_capacity), np.nan)
+        self._frame_indices = np.full(initial_capacity, -1, np.int64)
+        self.n_stored = 0
+        self.stored_data = StoredRows(self)
+
+        self._stream_writer = None
+        self._stream_chunk_size = None
+        self._n_streamed = 0
+        self._n_unwritten = 0
 
     def __getitem__(self, item):
+        """ Gives a column by name, or the rows of a column with a (rows,
+        name) tuple, without copying
+        """
         if isinstance(item, tuple):
-            return np.array(getattr(k, item[1]) for k in self.stored_data[item[0]])
+            return self._values[self.header_dict[item[1]], : self.n_stored][item[0]]
 
         if isinstance(item, str):
-            return np.array(getattr(k, item[1]) for k in self.stored_data)
+            return self._values[self.header_dict[item], : self.n_stored]
+
+    @property
+    def times(self):
+        return self._values[0, : self.n_stored]
+
+    @property
+    def frame_indices(self):
+        return self._frame_indices[: self.n_stored]
 
     @property
     def t(self):
-        return np.array(self.times)
+        return self.times
 
     def values_at_abs_time(self, time):
         """ Finds the values in the accumulator closest to the datetime time
@@ -90,15 +157,14 @@ class DataFrameAccumulator(Accumulator):
 
         """
         find_time = (time - self.exp.t0).total_seconds()
-        i = bisect_right(self.times, find_time)
+        i = np.searchsorted(self.times, find_time, side="right")
         return self.stored_data[i - 1]
 
     @property
     def columns(self):
-        try:
-            return ("t",) + self.stored_data[-1]._fields
-        except IndexError:
+        if self._row_type is None:
             raise ValueError("Accumulator empty, data types not known")
+        return ("t",) + self._row_type._fields
 
     @property
     def header_dict(self):
@@ -124,18 +190,151 @@ class DataFrameAccumulator(Accumulator):
         if monitored_headers is not None:
             self.plot_columns = monitored_headers
 
-        self.stored_data = []
-        self.times = []
+        self.n_stored = 0
+        self._row_type = None
+        self._header_dict = None
+        self._restart_stream()
+
+    def _allocate(self, capacity, n_kept=None):
+        """ Moves the last n_kept data points (by default as many as fit) to
+        new arrays with the given capacity. The arrays are replaced and not
+        modified, so the views of the data previously returned stay valid
+        """
+        if n_kept is None:
+            n_kept = self.n_stored
+        n_kept = min(n_kept, self.n_stored, capacity)
+        values = np.full((self._values.shape[0], capacity), np.nan)
+        values[:, :n_kept] = self._values[:, self.n_stored - n_kept : self.n_stored]
+        frame_indices = np.full(capacity, -1, np.int64)
+        frame_indices[:n_kept] = self._frame_indices[
+            self.n_stored - n_kept : self.n_stored
+        ]
+        self._values = values
+        self._frame_indices = frame_indices
+        self.n_stored = n_kept
+
+    def append(self, t, data, frame_index=None):
+        """ Adds a data point
+
+        Parameters
+        ----------
+        t : float
+            time of the data point, in seconds from the experiment start
+        data : namedtuple
+            values of the data point, the columns are reset if its fields
+            differ from the ones of the previous data
+        frame_index : int
+            index of the camera frame the data come from
+
+        """
+        self._set_row_type(type(data))
+        if self.n_stored == self._values.shape[1]:
+            self._allocate(2 * self._values.shape[1])
+        self._values[0, self.n_stored] = t
+        self._values[1:, self.n_stored] = data
+        self._frame_indices[self.n_stored] = -1 if frame_index is None else frame_index
+        self.n_stored += 1
+        self._count_unwritten(1)
+
+    def extend(self, row_type, times, values, frame_indices=None):
+        """ Adds multiple data points at once
+
+        Parameters
+        ----------
+        row_type : namedtuple class
+            type of the data points, the columns are reset if its fields
+            differ from the ones of the previous data
+        times : np.ndarray
+            times of the data points, in seconds from the experiment start
+        values : np.ndarray
+            NxJ array of the values of the N data points
+        frame_indices : np.ndarray
+            indices of the camera frames the data come from (-1 if none)
 
+        """
+        self._set_row_type(row_type)
+        n_new = len(times)
+        if self.n_stored + n_new > self._values.shape[1]:
+            self._allocate(max(2 * self._values.shape[1], self.n_stored + n_new))
+        new = slice(self.n_stored, self.n_stored + n_new)
+        self._values[0, new] = times
+        self._values[1:, new] = values.T
+        self._frame_indices[new] = -1 if frame_indices is None else frame_indices
+        self.n_stored += n_new
+        self._count_unwritten(n_new)
+
+    def _set_row_type(self, row_type):
+        if self._row_type is not None and row_type._fields == self._row_type._fields:
+            return
+        self._row_type = row_type
         self._header_dict = None
+        self.n_stored = 0
+        self._restart_stream()
+        if self._values.shape[0] != len(row_type._fields) + 1:
+            self._values = np.full(
+                (len(row_type._fields) + 1, self._values.shape[1]), np.nan
+            )
+
+    def _count_unwritten(self, n_new):
+        if self._stream_writer is not None:
+            self._n_unwritten += n_new
+            if self._n_unwritten >= self._stream_chunk_size:
+                self._write_chunk()
 
     def trim_data(self):
-        if (
-            not self.exp.protocol_runner.running
-            and len(self.times) > self.max_history_if_not_running * 1.5
-        ):
-            self.times[: -self.max_history_if_not_running] = []
-            self.stored_data[: -self.max_history_if_not_running] = []
+        if self._stream_writer is not None:
+            # the data already written are not needed in memory
+            n_kept = max(self.max_history_if_not_running, self._stream_chunk_size)
+        elif not self.exp.protocol_runner.running:
+            n_kept = self.max_history_if_not_running
+        else:
+            return
+        if self.n_stored > n_kept * 1.5:
+            self._allocate(self._values.shape[1], n_kept)
+
+    def stream_to(self, path, chunk_size=10000):
+        """ Starts writing the data to disk while they are acquired, in
+        chunks of chunk_size data points (see :class:`LogStreamWriter
+        <stytra.collectors.log_stream.LogStreamWriter>`). While streaming,
+        only the last data points are kept in memory, and the streamed file is
+        finalized by :meth:`save`. A reset discards the data written so far.
+
+        Parameters
+        ----------
+        path : str
+            path of the log, without extension
+        chunk_size : int
+            number of data points written at once
+
+        """
+        self.stop_streaming()
+        self._stream_writer = LogStreamWriter(path)
+        self._stream_chunk_size = chunk_size
+        self._n_streamed = 0
+        self._n_unwritten = self.n_stored
+
+    def stop_streaming(self):
+        """ Stops writing the data to disk and deletes the streamed file
+        """
+        if self._stream_writer is not None:
+            self._stream_writer.clear()
+            self._stream_writer.close()
+            self._stream_writer = None
+
+    def _restart_stream(self):
+        if self._stream_writer is not None:
+            self._stream_writer.clear()
+        self._n_streamed = 0
+        self._n_unwritten = 0
+
+    def _write_chunk(self):
+        if self._n_unwritten == 0:
+            return
+        chunk = self._dataframe(self.n_stored - self._n_unwritten)
+        chunk.index = np.arange(self._n_streamed, self._n_streamed + len(chunk))
+        self._stream_writer.write(chunk)
+        self._n_streamed += len(chunk)
+        self._n_unwritten = 0
 
     def get_fps(self):
         """ """
@@ -159,22 +358,20 @@ class DataFrameAccumulator(Accumulator):
         -------
         np.array
             NxJ Array containing the last n data points, where J is the
-            number of values collected at each timepoint + 1 (the timestamp)
+            number of values collected at each timepoint + 1 (the timestamp,
+            first column), or None if there are no data. The array is a view
+            of the stored data, which is not changed by adding new data.
 
         """
         if n is not None:
-            last_n = min(n, len(self.stored_data))
+            last_n = min(n, self.n_stored)
         else:
-            last_n = len(self.stored_data)
+            last_n = self.n_stored
 
         if last_n == 0:
             return None
 
-        df = pd.DataFrame.from_records(
-            self.stored_data[-last_n:], columns=self.stored_data[-1]._fields
-        )
-        df["t"] = np.array(self.times[-last_n:])
-        return df
+        return self._values[:, self.n_stored - last_n : self.n_stored].T
 
     def get_last_t(self, t):
         """
@@ -188,22 +385,103 @@ class DataFrameAccumulator(Accumulator):
         Returns
         -------
         np.array
-            NxJ Array containing the last n data points, where J is the
-            number of values collected at each timepoint + 1 (the timestamp)
-            and N is t*fps
+            NxJ Array containing the data points of the last t seconds
+            (before the time of the last data point), where J is the
+            number of values collected at each timepoint + 1 (the timestamp),
+            or None if there are no data. The array is a view of the stored
+            data.
 
 
         """
-        try:
-            n = int(self.get_fps() * t)
-            return self.get_last_n(n)
-        except (OverflowError, ValueError):
-            return self.get_last_n(1)
+        if self.n_stored == 0:
+            return None
+        return self.get_window(self.times[-1] - t)
+
+    def window_indices(self, t_start=None, t_end=None):
+        """ Finds by binary search the data points whose times are
+        between t_start and t_end (both included), the times being sorted
+
+        Parameters
+        ----------
+        t_start : float
+            start of the window, if None from the first data point
+        t_end : float
+            end of the window, if None up to the last data point
+
+        Returns
+        -------
+        i_start, i_end : int
+            the data points in the window are the ones from i_start to i_end
+            (excluded)
+
+        """
+        times = self.times
+        i_start = 0 if t_start is None else np.searchsorted(times, t_start, "left")
+        i_end = len(times) if t_end is None else np.searchsorted(times, t_end, "right")
+        return int(i_start), int(max(i_start, i_end))
+
+    def get_window(self, t_start=None, t_end=None):
+        """ Returns the data points whose times are between t_start and
+        t_end (both included)
+
+        Parameters
+        ----------
+        t_start : float
+            start of the window, if None from the first data point
+        t_end : float
+            end of the window, if None up to the last data point
+
+        Returns
+        -------
+        np.array
+            NxJ Array containing the data points in the window, as returned
+            by :meth:`get_last_n`, or None if there are none
+
+        """
+        i_start, i_end = self.window_indices(t_start, t_end)
+        if i_end == i_start:
+            return None
+        return self._values[:, i_start:i_end].T
+
+    def asof_indices(self, times):
+        """ Finds by binary search the last data point at or before each of
+        the given times
+
+        Parameters
+        ----------
+        times : np.ndarray
+            times to search for
+
+        Returns
+        -------
+        np.ndarray
+            index of the data point for each time, -1 if there is none
+
+        """
+        return np.searchsorted(self.times, times, "right") - 1
 
     def get_dataframe(self):
         """Returns pandas DataFrame with data and headers.
         """
-        return self.get_last_n(len(self.stored_data))
+        if self.n_stored == 0:
+            return None
+        df = self._dataframe(0)
+        if not np.any(self.frame_indices >= 0):
+            df = df.drop(columns="frame_index")
+        return df
+
+    def _dataframe(self, i_start):
+        """ Copies the data from the i_start-th stored data point on,
+        always with the frame_index column
+        """
+        values = self._values[:, i_start : self.n_stored]
+        df = pd.DataFrame(
+            {name: values[i] for i, name in enumerate(self.columns) if i > 0},
+            copy=True,
+        )
+        df["t"] = values[0]
+        df["frame_index"] = self._frame_indices[i_start : self.n_stored]
+        return df
 
     def save(self, path, format="csv"):
         """ Saves the content of the accumulator in a tabular format.
@@ -219,6 +497,14 @@ class DataFrameAccumulator(Accumulator):
             output format, csv, feather, hdf5, json
 
         """
+        if self._stream_writer is not None:
+            self._write_chunk()
+            saved_filename = self._stream_writer.finalize(path, format)
+            self._stream_writer = None
+            if saved_filename is None:
+                return
+            return basename(saved_filename)
+
         df = self.get_dataframe()
         if df is None:
             return
@@ -226,7 +512,52 @@ class DataFrameAccumulator(Accumulator):
         return basename(saved_filename)
 
     def is_empty(self):
-        return len(self.stored_data) == 0
+        return self.n_stored == 0
+
+
+def join_asof(accumulators, t_start=None, t_end=None):
+    """ Joins the data of several accumulators (e.g. tracking, estimator
+    and stimulus logs) at the times of the data points of the first one:
+    for each of them, the last data point of each other accumulator at or
+    before its time is taken ("as of" join).
+
+    Parameters
+    ----------
+    accumulators : list of DataFrameAccumulator
+        the accumulators to join, the first giving the times
+    t_start, t_end : float
+        window of the first accumulator to join, see
+        :meth:`DataFrameAccumulator.get_window`
+
+    Returns
+    -------
+    dict
+        array of values for each column. The columns of the first
+        accumulator are views of its data and keep their names, the ones of
+        the others are prefixed with the accumulator name (or acc{i} if it
+        has none) and are NaN where no data point precedes the time. Empty
+        accumulators are left out
+
+    """
+    reference = accumulators[0]
+    if reference.is_empty():
+        return dict()
+    i_start, i_end = reference.window_indices(t_start, t_end)
+    joined = {
+        column: reference._values[i_column, i_start:i_end]
+        for i_column, column in enumerate(reference.columns)
+    }
+    for i_acc, acc in enumerate(accumulators[1:], 1):
+        if acc.is_empty():
+            continue
+        prefix = (acc.name or "acc{:d}".format(i_acc)) + "_"
+        indices = acc.asof_indices(joined["t"])
+        missing = indices < 0
+        for i_column, column in enumerate(acc.columns):
+            values = acc._values[i_column, indices]
+            values[missing] = np.nan
+            joined[prefix + column] = values
+    return joined
 
 
 class QueueDataAccumulator(DataFrameAccumulator):
@@ -235,23 +566,29 @@ class QueueDataAccumulator(DataFrameAccumulator):
     The QueueDataAccumulator takes as input a multiprocessing.Queue object
     and retrieves data from it whenever its :meth:`update_list()
     <QueueDataAccumulator.update_list()>` method is called.
-    All the data are then put in the stored_data list.
+    All the data are then stored in the accumulator.
     It is usually connected with a QTimer() timeout to make sure that data
     from the Queue are constantly retrieved.
 
     Parameters
     ----------
     data_queue : (multiprocessing.Queue object)
-        queue from witch to retrieve data.
+        queue from witch to retrieve data. The data can be put with their time
+        or a (time, frame index) tuple. If it is a :class:`RowRing
+        <stytra.collectors.row_ring.RowRing>`, all the pending data are
+        retrieved at once
     header_list : list of str
         headers for the data to stored.
+    latency_tracer : LatencyTracer
+        if given, the latency between the acquisition time of the data and
+        their arrival is recorded as the tracking latency
 
     Returns
     -------
 
     """
 
-    def __init__(self, data_queue, **kwargs):
+    def __init__(self, data_queue, latency_tracer=None, **kwargs):
         """ """
         super().__init__(**kwargs)
 
@@ -259,18 +596,28 @@ class QueueDataAccumulator(DataFrameAccumulator):
         # only time differences in milliseconds in the list (faster)
         self.starting_time = None
         self.data_queue = data_queue
+        self.latency_tracer = latency_tracer
+        # number of data points received, not reset with the stored data
+        self.n_received = 0
 
     def update_list(self):
         """Upon calling put all available data into a list.
         """
+        if isinstance(self.data_queue, RowRing):
+            self._update_from_ring()
+            return
+
+        t_now = None
         while True:
             try:
                 # Get data from queue:
                 t, data = self.data_queue.get(timeout=0.001)
+                if isinstance(t, tuple):
+                    t, frame_index = t
+                else:
+                    frame_index = None
                 newtype = False
-                if len(self.stored_data) == 0 or type(data) != type(
-                    self.stored_data[-1]
-                ):
+                if self.n_stored == 0 or data._fields != self._row_type._fields:
                     self.reset()
                     newtype = True
 
@@ -278,8 +625,11 @@ class QueueDataAccumulator(DataFrameAccumulator):
                 t_s = (t - self.exp.t0).total_seconds()
 
                 # append:
-                self.times.append(t_s)
-                self.stored_data.append(data)
+                self.append(t_s, data, frame_index)
+                self.n_received += 1
+
+                if self.latency_tracer is not None:
+                    t_now = self.latency_tracer.record("tracking", t_s, t_now)
 
                 self.trim_data()
 
@@ -289,11 +639,56 @@ class QueueDataAccumulator(DataFrameAccumulator):
             except Empty:
                 break
 
+    def _update_from_ring(self):
+        t0 = self.exp.t0.timestamp()
+        while True:
+            try:
+                rows = self.data_queue.get_many()
+            except Empty:
+                break
+            row_type = self.data_queue.tuple_type
+            newtype = self.n_stored == 0 or row_type._fields != self._row_type._fields
+            if newtype:
+                self.reset()
+
+            times = rows[:, 0] - t0
+            self.extend(row_type, times, rows[:, 2:], rows[:, 1])
+            self.n_received += len(rows)
+
+            if self.latency_tracer is not None:
+                self.latency_tracer.record("tracking", times)
+
+            self.trim_data()
+
+            if newtype:
+                self.sig_acc_init.emit()
+
+    def received_since(self, n_received):
+        """ Returns the data points which arrived after the first n_received
+        ones, as far as they are still stored
+
+        Parameters
+        ----------
+        n_received : int
+            value of :attr:`n_received` at the last retrieval
+
+        Returns
+        -------
+        list of namedtuples
+
+        """
+        n_new = min(self.n_received - n_received, self.n_stored)
+        if n_new <= 0:
+            return []
+        return self.stored_data[-n_new:]
+
 
 class FramerateAccumulator(Accumulator):
     def __init__(self, *args, goal_framerate=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.goal_framerate = goal_framerate
+        self.stored_data = []
+        self.times = []
 
     def trim_data(self):
         if len(self.times) > self.max_history_if_not_running * 1.5:
@@ -347,8 +742,8 @@ class DynamicLog(DataFrameAccumulator):
 
     def __init__(self, stimuli, **kwargs):
         """ """
-        self.name = "stimulus_params"
         self._tupletype = None
+        kwargs.setdefault("name", "stimulus_params")
         super().__init__(**kwargs)
         # it is assumed the first dynamic stimulus has all the fields
 
@@ -361,23 +756,30 @@ class DynamicLog(DataFrameAccumulator):
         except IndexError:
             raise ValueError("Data type not set for stimulus log")
 
-    def update_list(self, time, data):
+    def update_list(self, time, data, frame_index=None):
         """
 
         Parameters
         ----------
         data :
 
+        frame_index : int
+            index of the camera frame the stimulus is based on (e.g. for
+            closed-loop stimuli)
+
 
         Returns
         -------
 
         """
-        self.times.append(time)
-        self.stored_data.append(
-            self._tupletype(*(data.get(f, np.nan) for f in self._tupletype._fields))
+        self.append(
+            time,
+            self._tupletype(*(data.get(f, np.nan) for f in self._tupletype._fields)),
+            frame_index,
         )
 
+        self.trim_data()
+
     def update_stimuli(self, stimuli):
         dynamic_params = []
         for stimulus in stimuli:
@@ -394,26 +796,24 @@ class DynamicLog(DataFrameAccumulator):
 class EstimatorLog(DataFrameAccumulator):
     """ """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.stored_data = []
-
-    def update_list(self, t, data):
+    def update_list(self, t, data, frame_index=None):
         """
 
         Parameters
         ----------
         data :
 
+        frame_index : int
+            index of the camera frame the estimate is based on
+
 
         Returns
         -------
 
         """
-        self.times.append(t)
-        self.stored_data.append(data)
+        self.append(t, data, frame_index)
 
         self.trim_data()
 
-        if len(self.stored_data) == 1:
+        if self.n_stored == 1:
             self.sig_acc_init.emit()
@@ -0,0 +1,120 @@
+import datetime
+from collections import namedtuple
+from os.path import basename
+
+import numpy as np
+import pandas as pd
+
+from stytra.collectors.accumulators import DataFrameAccumulator
+from stytra.utilities import save_df
+
+
+class LatencyTracer:
+    """Collects the latencies of the closed loop, from the acquisition of a
+    camera frame to the different stages that use the tracking results
+    obtained from it, as histograms.
+
+    The stages are:
+
+        - tracking: the tracking output of the frame reaches the GUI
+          process (:class:`QueueDataAccumulator`)
+        - estimator: the estimator computes the quantities used by the
+          stimulus from the frame (e.g. the vigor or the position)
+        - display: the stimulus computed from the frame is painted
+
+    Additionally, the tracking frame which drove each painted stimulus frame
+    is logged in display_log.
+
+    Parameters
+    ----------
+    experiment : TrackingExperiment
+    bin_width : float
+        width of the histogram bins in seconds
+    max_latency : float
+        latencies above max_latency are counted in the last bin
+
+    """
+
+    stages = ("tracking", "estimator", "display")
+
+    def __init__(self, experiment, bin_width=0.0005, max_latency=0.5):
+        self.exp = experiment
+        self.bin_width = bin_width
+        self.n_bins = int(round(max_latency / bin_width))
+        self.histograms = {
+            stage: np.zeros(self.n_bins, np.int64) for stage in self.stages
+        }
+        self.display_log = DataFrameAccumulator(experiment=experiment, name="display")
+        self._display_type = namedtuple("d", ["latency"])
+
+    def record(self, stage, frame_time, t_now=None):
+        """ Counts the latency of a stage
+
+        Parameters
+        ----------
+        stage : str
+            one of the stages
+        frame_time : float or np.ndarray
+            acquisition time of the frame (or of multiple frames), in
+            seconds since the experiment start (as in the accumulators)
+        t_now : float
+            time at which the stage is reached, the current time by default
+
+        """
+        if t_now is None:
+            t_now = (datetime.datetime.now() - self.exp.t0).total_seconds()
+        i_bins = ((t_now - np.asarray(frame_time)) / self.bin_width).astype(np.int64)
+        np.add.at(self.histograms[stage], np.clip(i_bins, 0, self.n_bins - 1), 1)
+        return t_now
+
+    def record_display(self):
+        """ Called when the stimulus is painted, logs the tracking frame the
+        stimulus is based on, as given by the estimator
+        """
+        estimator = self.exp.estimator
+        if estimator is None or estimator.frame_time is None:
+            return
+        t_now = self.record("display", estimator.frame_time)
+        self.display_log.append(
+            t_now,
+            self._display_type(t_now - estimator.frame_time),
+            estimator.frame_index,
+        )
+        self.display_log.trim_data()
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram[:] = 0
+        self.display_log.reset()
+
+    def percentiles(self, stage, percs=(50, 95, 99)):
+        """ Returns the percentiles of the latency of a stage in seconds,
+        estimated from the histogram, or None if nothing was recorded
+        """
+        cumulative = np.cumsum(self.histograms[stage])
+        if cumulative[-1] == 0:
+            return None
+        return tuple(
+            (np.searchsorted(cumulative, p / 100 * cumulative[-1]) + 1) * self.bin_width
+            for p in percs
+        )
+
+    def get_dataframe(self):
+        df = pd.DataFrame(self.histograms)
+        df.insert(0, "latency", np.arange(self.n_bins) * self.bin_width)
+        return df
+
+    def save(self, path, format="csv"):
+        """ Saves the histograms, one column per stage with the counts,
+        indexed by the lower bound of the latency bin in seconds
+
+        Parameters
+        ----------
+        path : str
+            output path, without extension name
+        format : str
+            output format, csv, feather, hdf5, json
+
+        """
+        saved_filename = save_df(self.get_dataframe(), path, format)
+        return basename(saved_filename)
@@ -0,0 +1,161 @@
+import os
+import threading
+from queue import Queue
+
+import pandas as pd
+
+from stytra.utilities import save_df
+
+STREAM_SUFFIX = ".stream.h5"
+
+_CLEAR = "clear"
+
+
+class LogStreamWriter:
+    """ Appends the chunks of a log to a table in an HDF5 file, from a
+    background thread so that the experiment does not wait for the disk.
+
+    The file is opened only while a chunk is appended, so that after a
+    crash it contains all the chunks which were completely written, and
+    the log can be recovered with :func:`recover_log`.
+
+    Parameters
+    ----------
+    path : str
+        path of the log, without extension. The data are streamed to
+        path + STREAM_SUFFIX
+    complevel : int
+        blosc compression level of the chunks
+
+    """
+
+    def __init__(self, path, complevel=5):
+        self.path = str(path)
+        self.stream_path = self.path + STREAM_SUFFIX
+        self.complevel = complevel
+        self.n_written = 0
+        self.error = None
+        self._queue = Queue()
+        if os.path.exists(self.stream_path):
+            os.remove(self.stream_path)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            try:
+                if chunk is _CLEAR:
+                    if os.path.exists(self.stream_path):
+                        os.remove(self.stream_path)
+                    self.n_written = 0
+                else:
+                    with pd.HDFStore(
+                        self.stream_path,
+                        mode="a",
+                        complib="blosc",
+                        complevel=self.complevel,
+                    ) as store:
+                        store.append("data", chunk, format="table", index=False)
+                    self.n_written += len(chunk)
+            except Exception as e:
+                self.error = e
+
+    def write(self, chunk):
+        """ Queues a chunk to be appended to the file
+
+        Parameters
+        ----------
+        chunk : pd.DataFrame
+            the next rows of the log, always with the same columns
+
+        """
+        self._queue.put(chunk)
+
+    def clear(self):
+        """ Discards the rows written so far
+        """
+        self._queue.put(_CLEAR)
+
+    def close(self):
+        """ Waits for the queued chunks to be written and stops the thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def finalize(self, path=None, fileformat="csv"):
+        """ Writes the whole log in one of the formats of :func:`save_df
+        <stytra.utilities.save_df>` and deletes the streamed file
+
+        Parameters
+        ----------
+        path : str
+            output path, without extension, by default the one of the stream
+        fileformat : str
+            csv, feather, hdf5 or json
+
+        Returns
+        -------
+        the name of the saved file, None if no data were written
+
+        """
+        self.close()
+        if not os.path.exists(self.stream_path):
+            return None
+        saved_filename = save_df(
+            read_log_stream(self.stream_path), path or self.path, fileformat
+        )
+        os.remove(self.stream_path)
+        return saved_filename
+
+
+def read_log_stream(stream_path):
+    """ Reads a streamed log, also if the writing was interrupted
+
+    Parameters
+    ----------
+    stream_path : str or Path
+        path of the file written by :class:`LogStreamWriter`
+
+    Returns
+    -------
+    pd.DataFrame with the rows of the log, as it would be returned by the
+    get_dataframe method of the accumulator
+
+    """
+    df = pd.read_hdf(str(stream_path), "data")
+    if "frame_index" in df.columns and not (df.frame_index >= 0).any():
+        df = df.drop(columns="frame_index")
+    return df
+
+
+def recover_log(stream_path, fileformat="csv"):
+    """ Saves the log streamed to a file left by an interrupted experiment,
+    next to it and as the log would have been saved at the end of the
+    experiment. The streamed file is kept.
+
+    Parameters
+    ----------
+    stream_path : str or Path
+        path of the file written by :class:`LogStreamWriter`
+    fileformat : str
+        csv, feather, hdf5 or json
+
+    Returns
+    -------
+    the name of the saved file
+
+    """
+    stream_path = str(stream_path)
+    if not stream_path.endswith(STREAM_SUFFIX):
+        raise ValueError(stream_path + " is not a streamed log")
+    return save_df(
+        read_log_stream(stream_path),
+        stream_path[: -len(STREAM_SUFFIX)],
+        fileformat,
+    )
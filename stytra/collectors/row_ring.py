@@ -0,0 +1,214 @@
+"""
+Ring of rows of numbers in shared memory, to pass the outputs of the
+tracking from one process to another without pickling them one by one
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing import Queue, RawArray, RawValue
+from queue import Empty
+
+import numpy as np
+
+
+class RowRing:
+    """ A channel for named tuples of numbers, such as the tracking outputs,
+    with the put interface of the :class:`NamedTupleQueue
+    <stytra.collectors.namedtuplequeue.NamedTupleQueue>`.
+
+    The field names (the schema) are sent only when they change, through a
+    queue. Each tuple is written as a row of float64 values in a ring in
+    shared memory, preceded by its time (as a timestamp) and its frame
+    index. The reader gets all the rows written since its last call at once,
+    as a 2D array, with :meth:`get_many`.
+
+    As for the :class:`FrameRing <stytra.hardware.video.frame_ring.FrameRing>`,
+    the writer never waits for the reader: the rows overwritten before being
+    read, and the unread rows with the previous schema when it changes, are
+    counted in n_dropped. There should be one writing and one reading
+    process.
+
+    Parameters
+    ----------
+    max_mbytes : float
+        size of the shared memory, the number of rows depends on the number
+        of fields
+    max_rows : int
+        maximal number of rows
+
+    """
+
+    def __init__(self, max_mbytes=10, max_rows=100000):
+        self.max_values = int(max_mbytes * 1000000) // 8
+        self.max_rows = max_rows
+        self.buffer = RawArray("d", self.max_values)
+        self.sequence = RawArray("q", max_rows)
+
+        # index of the last row written
+        self.head = RawValue("q", -1)
+
+        # number of rows, number of columns (with the time and frame index)
+        # and index of the first row of the current schema
+        self.layout = RawArray("q", 3)
+        self.layout_version = RawValue("q", 0)
+        self.schema_queue = Queue()
+
+        # state of the writer
+        self._put_type = None
+
+        # state of the reader
+        self.tuple_type = None
+        self.next_index = 0
+        self.n_dropped = 0
+        self._schema_version = 0
+
+        self._view = None
+        self._view_version = 0
+        self._sequence_view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = None
+        state["_view_version"] = 0
+        state["_sequence_view"] = None
+        return state
+
+    def _sequences(self):
+        if self._sequence_view is None:
+            self._sequence_view = np.frombuffer(self.sequence, np.int64)
+        return self._sequence_view
+
+    def _set_schema(self, fields):
+        n_columns = len(fields) + 2
+        n_rows = min(self.max_rows, self.max_values // n_columns)
+        if n_rows < 2:
+            raise ValueError(
+                "Rows of {} values do not fit in a ring of {} values".format(
+                    n_columns, self.max_values
+                )
+            )
+        version = self.layout_version.value + 1
+        self.schema_queue.put((version, tuple(fields)))
+
+        self._sequences()[:] = -1
+        self.layout[0] = n_rows
+        self.layout[1] = n_columns
+        self.layout[2] = self.head.value + 1
+        self.layout_version.value = version
+
+    def _current_view(self):
+        version = self.layout_version.value
+        if version != self._view_version:
+            n_rows, n_columns = self.layout[:2]
+            self._view = np.frombuffer(
+                self.buffer, np.float64, n_rows * n_columns
+            ).reshape(n_rows, n_columns)
+            self._view_version = version
+        return self._view
+
+    def put(self, t, obj):
+        """ Writes a named tuple in the ring, overwriting the oldest one
+
+        Parameters
+        ----------
+        t : datetime or (datetime, int) tuple
+            time of the data, optionally with the index of the frame they
+            come from
+        obj : namedtuple
+            the data, whose fields have to be numbers
+
+        """
+        if type(obj) is not self._put_type:
+            if self._put_type is None or obj._fields != self._put_type._fields:
+                self._set_schema(obj._fields)
+            self._put_type = type(obj)
+
+        if isinstance(t, tuple):
+            t, frame_index = t
+        else:
+            frame_index = None
+
+        view = self._current_view()
+        index = self.head.value + 1
+        slot = index % view.shape[0]
+        self.sequence[slot] = -1
+        row = view[slot]
+        row[0] = t.timestamp()
+        row[1] = -1 if frame_index is None else frame_index
+        row[2:] = obj
+        self.sequence[slot] = index
+        self.head.value = index
+
+    def _read_schema(self, version):
+        while True:
+            schema_version, fields = self.schema_queue.get(timeout=1.0)
+            if schema_version == version:
+                break
+        self.tuple_type = namedtuple("t", fields)
+        self._schema_version = version
+
+        first_index = self.layout[2]
+        if self.next_index < first_index:
+            self.n_dropped += first_index - self.next_index
+            self.next_index = first_index
+
+    def get_many(self):
+        """ Returns all the rows written since the last call
+
+        Returns
+        -------
+        np.ndarray
+            Nx(J+2) array of the rows, each containing the time (as a
+            timestamp), the frame index (-1 if not given) and the J fields
+            of tuple_type
+
+        Raises
+        ------
+        Empty if no new row is available
+
+        """
+        while True:
+            version = self.layout_version.value
+            if version == 0:
+                raise Empty()
+            if version != self._schema_version:
+                self._read_schema(version)
+
+            head = self.head.value
+            if head < self.next_index:
+                raise Empty()
+
+            view = self._current_view()
+            n_rows = view.shape[0]
+            # the slot after the head can be in the process of being overwritten
+            oldest = head - n_rows + 2
+            if self.next_index < oldest:
+                self.n_dropped += oldest - self.next_index
+                self.next_index = oldest
+
+            indices = np.arange(self.next_index, head + 1)
+            slots = indices % n_rows
+            rows = view[slots]
+            if self.layout_version.value != version:
+                # the schema changed while copying
+                continue
+
+            # the rows overwritten while copying are the oldest ones
+            overwritten = np.flatnonzero(self._sequences()[slots] != indices)
+            i_first = overwritten[-1] + 1 if len(overwritten) > 0 else 0
+            self.n_dropped += i_first
+            self.next_index = head + 1
+            if i_first < len(rows):
+                return rows[i_first:]
+
+    def to_tuples(self, rows):
+        """ Converts rows returned by :meth:`get_many` to the time, frame
+        index and data tuples given to :meth:`put`
+        """
+        return [
+            (
+                (datetime.fromtimestamp(row[0]), int(row[1]) if row[1] >= 0 else None),
+                self.tuple_type(*row[2:]),
+            )
+            for row in rows.tolist()
+        ]
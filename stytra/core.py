@@ -83,7 +83,9 @@ class Stytra:
             preprocessing_method: str, optional
                "prefilter" or "bgsub"
             method: str
-                one of "tail", "eyes" or "fish"
+                one of "tail", "tail_angles", "eyes", "eyes_moments" (faster
+                eye tracking from image moments), "eyes_tail", "fish" or
+                "multiwell" (one fish in each well of a plate)
             estimator: str or class
                 for closed-loop experiments: either "vigor" for embedded experiments
                     or "position" for freely-swimming ones. A custom estimator can be supplied.
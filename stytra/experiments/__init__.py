@@ -84,6 +84,12 @@ class Experiment(QObject):
         if stytra is used in offline analysis, stimulus is not displayed
     log_format : str
         one of "csv", "feather", "hdf5" (pytables-based) or "json"
+    stream_logs : bool
+        if True, the logs are written to disk in chunks during the protocol
+        (see :meth:`DataFrameAccumulator.stream_to()
+        <stytra.collectors.accumulators.DataFrameAccumulator.stream_to()>`),
+        so that long experiments do not fill the memory and the data of a
+        crashed experiment can be recovered
     """
 
     sig_data_saved = pyqtSignal()
@@ -100,6 +106,7 @@ class Experiment(QObject):
         metadata_animal=None,
         loop_protocol=False,
         log_format="csv",
+        stream_logs=False,
         trigger_duration_queue=None,
         scope_triggering=None,
         offline=False,
@@ -125,6 +132,7 @@ class Experiment(QObject):
         self.database = database
         self.use_db = True if database else False
         self.log_format = log_format
+        self.stream_logs = stream_logs
         self.loop_protocol = loop_protocol
 
         self.dc = DataCollector(
@@ -198,6 +206,18 @@ class Experiment(QObject):
 
         self.dc.add_static_data(logname, category + "/" + name)
 
+    def stream_log(self, log, name):
+        """ Starts writing a log to disk during the protocol, if the logs
+        are streamed and the data are saved (base_dir is set). The log is
+        then finalized by :meth:`save_log` under the same name.
+        """
+        if self.stream_logs and self.base_dir is not None:
+            log.stream_to(self.filename_base() + name)
+
+    def start_log_streams(self):
+        if self.protocol_runner.dynamic_log is not None:
+            self.stream_log(self.protocol_runner.dynamic_log, "stimulus_log")
+
     def initialize_plots(self):
         pass
 
@@ -311,6 +331,7 @@ class Experiment(QObject):
         """
         self.check_trigger()
         self.reset()
+        self.start_log_streams()
         self.protocol_runner.start()
         self.read_scope_data()
 
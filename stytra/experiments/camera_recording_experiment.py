@@ -20,7 +20,7 @@ class VideoRecordingExperiment(CameraVisualExperiment):
         self.saving_evt = Event()
 
         self.frame_dispatcher = DispatchProcess(
-            self.camera.frame_queue, self.finished_evt, self.saving_evt
+            self.camera.frame_ring.reader(), self.finished_evt
         )
 
         # start frame dispatcher process:
@@ -39,7 +39,7 @@ class VideoRecordingExperiment(CameraVisualExperiment):
 
         self.set_id()
         self.video_writer = H5VideoWriter(
-            self.frame_dispatcher.output_frame_queue, self.finished_evt, self.saving_evt
+            self.camera.frame_ring.reader(), self.finished_evt, self.saving_evt
         )
 
         self.video_writer.start()
@@ -1,14 +1,16 @@
 from stytra.tracking.pipelines import Pipeline
 from stytra.tracking.preprocessing import Prefilter, BackgroundSubtractor
-from stytra.tracking.tail import CentroidTrackingMethod
-from stytra.tracking.fish import FishTrackingMethod
-from stytra.tracking.eyes import EyeTrackingMethod
+from stytra.tracking.tail import CentroidTrackingMethod, AnglesTrackingMethod
+from stytra.tracking.fish import FishTrackingMethod, MultiWellTrackingMethod
+from stytra.tracking.eyes import EyeTrackingMethod, EyeMomentsTrackingMethod
+from stytra.tracking.online_bouts import BoutDetectorNode
 from stytra.gui.fishplots import TailStreamPlot, BoutPlot
 from stytra.gui.camera_display import (
     TailTrackingSelection,
     CameraViewFish,
     EyeTrackingSelection,
     EyeTailTrackingSelection,
+    MultiWellSelection,
 )
 
 
@@ -17,6 +19,17 @@ class TailTrackingPipeline(Pipeline):
         super().__init__()
         self.filter = Prefilter(parent=self.root)
         self.tailtrack = CentroidTrackingMethod(parent=self.filter)
+        self.bouts = BoutDetectorNode(parent=self.tailtrack)
+        self.extra_widget = TailStreamPlot
+        self.display_overlay = TailTrackingSelection
+
+
+class TailAnglesTrackingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.filter = Prefilter(parent=self.root)
+        self.tailtrack = AnglesTrackingMethod(parent=self.filter)
+        self.bouts = BoutDetectorNode(parent=self.tailtrack)
         self.extra_widget = TailStreamPlot
         self.display_overlay = TailTrackingSelection
 
@@ -26,10 +39,20 @@ class FishTrackingPipeline(Pipeline):
         super().__init__()
         self.bgsub = BackgroundSubtractor(parent=self.root)
         self.fishtrack = FishTrackingMethod(parent=self.bgsub)
+        self.bouts = BoutDetectorNode(parent=self.fishtrack)
         self.extra_widget = BoutPlot
         self.display_overlay = CameraViewFish
 
 
+class MultiWellPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.fishtrack = MultiWellTrackingMethod(parent=self.root)
+        self.bouts = BoutDetectorNode(parent=self.fishtrack)
+        self.extra_widget = BoutPlot
+        self.display_overlay = MultiWellSelection
+
+
 class EyeTrackingPipeline(Pipeline):
     def __init__(self):
         super().__init__()
@@ -38,11 +61,19 @@ class EyeTrackingPipeline(Pipeline):
         self.display_overlay = EyeTrackingSelection
 
 
+class EyeMomentsTrackingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.eyetrack = EyeMomentsTrackingMethod(parent=self.root)
+        self.display_overlay = EyeTrackingSelection
+
+
 class EyeTailTrackingPipeline(Pipeline):
     def __init__(self):
         super().__init__()
         self.filter = Prefilter(parent=self.root)
         self.tailtrack = CentroidTrackingMethod(parent=self.filter)
+        self.bouts = BoutDetectorNode(parent=self.tailtrack)
 
         self.eyetrack = EyeTrackingMethod(parent=self.root)
         self.display_overlay = EyeTailTrackingSelection
@@ -50,7 +81,10 @@ class EyeTailTrackingPipeline(Pipeline):
 
 pipeline_dict = dict(
     tail=TailTrackingPipeline,
+    tail_angles=TailAnglesTrackingPipeline,
     fish=FishTrackingPipeline,
+    multiwell=MultiWellPipeline,
     eyes=EyeTrackingPipeline,
+    eyes_moments=EyeMomentsTrackingPipeline,
     eyes_tail=EyeTailTrackingPipeline,
 )
@@ -20,13 +20,18 @@ from stytra.collectors import (
     QueueDataAccumulator,
     EstimatorLog,
     FramerateQueueAccumulator,
+    LatencyTracer,
 )
-from stytra.tracking.tracking_process import TrackingProcess
+from stytra.tracking.tracking_process import TrackingProcess, TrackingReassemblyProcess
 from stytra.tracking.pipelines import Pipeline
-from stytra.collectors.namedtuplequeue import NamedTupleQueue
+from stytra.collectors.row_ring import RowRing
 from stytra.experiments.fish_pipelines import pipeline_dict
 
-from stytra.stimulation.estimators import estimator_dict
+from stytra.stimulation.estimators import (
+    estimator_dict,
+    EstimationStage,
+    SharedEstimate,
+)
 
 from stytra.hardware.video.write import H5VideoWriter, StreamingVideoWriter
 
@@ -131,9 +136,6 @@ class CameraVisualExperiment(VisualExperiment):
         super().wrap_up(*args, **kwargs)
         self.camera.kill_event.set()
 
-        for q in [self.camera.frame_queue]:
-            q.clear()
-
         self.camera.join()
 
     def excepthook(self, exctype, value, tb):
@@ -184,14 +186,48 @@ class TrackingExperiment(CameraVisualExperiment):
         tracking: dict
             containing fields:  tracking_method
                                 estimator: can be vigor for embedded fish, position
-                                    for freely-swimming, or a custom subclass of Estimator
+                                    for freely-swimming, multi_position for
+                                    multiple freely-swimming fish, or a custom
+                                    subclass of Estimator
+                                profile: if True, the time spent in each
+                                    node of the pipeline is measured and
+                                    shown in a profiler window
+                                frame_policy: "fifo" (default), "latest" or
+                                    "budgeted", which frames are tracked
+                                    when the tracking is slower than the
+                                    camera (see :class:`TrackingProcess
+                                    <stytra.tracking.tracking_process.TrackingProcess>`)
+                                max_latency: latency target in seconds
+                                    for the "budgeted" frame policy
+                                trace_latency: if True, the latencies from
+                                    the camera frames to the tracking,
+                                    estimator and stimulus display are
+                                    recorded as histograms (see
+                                    :class:`LatencyTracer
+                                    <stytra.collectors.latency.LatencyTracer>`),
+                                    shown in a window and saved
+                                estimate_in_tracking: if True, the vigor,
+                                    position and bout count are computed in
+                                    the tracking process, as the last stage
+                                    of the tracking, and read by the
+                                    estimator from shared memory (see
+                                    :class:`EstimationStage
+                                    <stytra.stimulation.estimators.EstimationStage>`)
+        n_tracking_processes: int
+            number of tracking processes. If more than one, the frames
+            are shared among a pool of processes, and the outputs are put back
+            in frame order by a :class:`TrackingReassemblyProcess
+            <stytra.tracking.tracking_process.TrackingReassemblyProcess>`,
+            which also runs the stateful nodes of the pipeline.
 
     Returns
     -------
 
     """
 
-    def __init__(self, *args, tracking, recording=None, **kwargs):
+    def __init__(
+        self, *args, tracking, recording=None, n_tracking_processes=1, **kwargs
+    ):
         """
         :param tracking_method: class with the parameters for tracking (instance
                                 of TrackingMethod class, defined in the child);
@@ -202,7 +238,8 @@ class TrackingExperiment(CameraVisualExperiment):
         """
 
         self.processing_params_queue = Queue()
-        self.tracking_output_queue = NamedTupleQueue()
+        self.tracking_output_queue = RowRing()
+        self.tracking_event_queue = Queue()
         self.finished_sig = Event()
         super().__init__(*args, **kwargs)
         self.arguments.update(locals())
@@ -217,26 +254,96 @@ class TrackingExperiment(CameraVisualExperiment):
             else tracking["method"]
         )
 
-        self.frame_dispatcher = TrackingProcess(
-            in_frame_queue=self.camera.frame_queue,
-            finished_signal=self.camera.kill_event,
-            pipeline=self.pipeline_cls,
-            processing_parameter_queue=self.processing_params_queue,
-            output_queue=self.tracking_output_queue,
-            recording_signal=self.recording_event,
-            gui_framerate=20,
+        self.profile_tracking = tracking.get("profile", False)
+        frame_policy = dict(
+            frame_policy=tracking.get("frame_policy", "fifo"),
+            max_latency=tracking.get("max_latency", 0.02),
         )
+
+        # the estimates can be computed in the tracking process, in frame
+        # order, and shared with the estimator of the GUI process
+        if tracking.get("estimate_in_tracking", False) and tracking.get(
+            "estimator", None
+        ):
+            self.shared_estimate = SharedEstimate()
+            estimation = EstimationStage(
+                self.shared_estimate, **tracking.get("estimator_params", {})
+            )
+        else:
+            self.shared_estimate = None
+            estimation = None
+
+        if n_tracking_processes == 1:
+            self.processing_params_queues = [self.processing_params_queue]
+            self.frame_dispatchers = [
+                TrackingProcess(
+                    in_frame_queue=self.camera.frame_ring.reader(),
+                    finished_signal=self.camera.kill_event,
+                    pipeline=self.pipeline_cls,
+                    processing_parameter_queue=self.processing_params_queue,
+                    output_queue=self.tracking_output_queue,
+                    event_queue=self.tracking_event_queue,
+                    estimation=estimation,
+                    gui_framerate=20,
+                    profile=self.profile_tracking,
+                    **frame_policy
+                )
+            ]
+            self.tracking_reassembler = None
+        else:
+            # the first parameter queue is for the process running the
+            # stateful part of the pipeline
+            self.processing_params_queues = [self.processing_params_queue] + [
+                Queue() for _ in range(n_tracking_processes)
+            ]
+            # the processes of the pool share the position in the frame ring
+            frame_reader = self.camera.frame_ring.reader(shared=True)
+            self.frame_dispatchers = [
+                TrackingProcess(
+                    in_frame_queue=frame_reader,
+                    finished_signal=self.camera.kill_event,
+                    pipeline=self.pipeline_cls,
+                    processing_parameter_queue=param_queue,
+                    output_queue=RowRing(),
+                    gui_framerate=20,
+                    sharded=True,
+                    gui_dispatcher=i_process == 0,
+                    profile=self.profile_tracking,
+                    **frame_policy
+                )
+                for i_process, param_queue in enumerate(
+                    self.processing_params_queues[1:]
+                )
+            ]
+            self.tracking_reassembler = TrackingReassemblyProcess(
+                worker_queues=[fd.output_queue for fd in self.frame_dispatchers],
+                finished_signal=self.camera.kill_event,
+                pipeline=self.pipeline_cls,
+                processing_parameter_queue=self.processing_params_queue,
+                output_queue=self.tracking_output_queue,
+                event_queue=self.tracking_event_queue,
+                estimation=estimation,
+            )
+
+        # the first tracking process dispatches the frames to the GUI
+        self.frame_dispatcher = self.frame_dispatchers[0]
+
         if self.pipeline_cls is None:
             raise NameError("The selected tracking method does not exist!")
         self.pipeline = self.pipeline_cls()
         assert isinstance(self.pipeline, Pipeline)
         self.pipeline.setup(tree=self.dc)
 
+        self.latency_tracer = (
+            LatencyTracer(self) if tracking.get("trace_latency", False) else None
+        )
+
         self.acc_tracking = QueueDataAccumulator(
             name="tracking",
             experiment=self,
             data_queue=self.tracking_output_queue,
             monitored_headers=self.pipeline.headers_to_plot,
+            latency_tracer=self.latency_tracer,
         )
         self.acc_tracking.sig_acc_init.connect(self.refresh_plots)
 
@@ -246,8 +353,20 @@ class TrackingExperiment(CameraVisualExperiment):
         # Tracking is reset at experiment start:
         self.protocol_runner.sig_protocol_started.connect(self.acc_tracking.reset)
 
-        # start frame dispatcher process:
-        self.frame_dispatcher.start()
+        # the events detected in the tracking (e.g. bouts), if the pipeline
+        # detects any
+        if self.pipeline.event_nodes:
+            self.bout_log = QueueDataAccumulator(
+                name="bouts", experiment=self, data_queue=self.tracking_event_queue
+            )
+            self.gui_timer.timeout.connect(self.bout_log.update_list)
+            self.protocol_runner.sig_protocol_started.connect(self.bout_log.reset)
+        else:
+            self.bout_log = None
+
+        # start frame dispatcher processes:
+        for process in self.tracking_processes:
+            process.start()
 
         est_type = tracking.get("estimator", None)
         if est_type is None:
@@ -258,7 +377,7 @@ class TrackingExperiment(CameraVisualExperiment):
             est = est_type
 
         if est is not None:
-            self.estimator_log = EstimatorLog(experiment=self)
+            self.estimator_log = EstimatorLog(experiment=self, name="estimator")
             self.estimator = est(
                 self.acc_tracking,
                 experiment=self,
@@ -270,23 +389,25 @@ class TrackingExperiment(CameraVisualExperiment):
 
         self.acc_tracking_framerate = FramerateQueueAccumulator(
             self,
-            queue=self.frame_dispatcher.framerate_queue,
+            queue=self.tracking_processes[-1].framerate_queue,
             name="tracking",
             goal_framerate=kwargs["camera"].get("min_framerate", None),
         )
+        self.acc_tracking_latency = FramerateQueueAccumulator(
+            self, queue=self.tracking_processes[-1].latency_queue, name="latency"
+        )
 
         if recording is not None:
             if recording["extension"] == "h5":
                 self.frame_recorder = H5VideoWriter(
-                    self.filename_base(),
-                    self.frame_dispatcher.frame_copy_queue,
+                    self.camera.frame_ring.reader(),
                     self.finished_sig,
                     self.recording_event,
                     log_format=self.log_format,
                 )
             else:
                 self.frame_recorder = StreamingVideoWriter(
-                    self.frame_dispatcher.frame_copy_queue,
+                    self.camera.frame_ring.reader(),
                     self.finished_sig,
                     self.recording_event,
                     kbit_rate=recording.get("kbit_rate", 1000),
@@ -295,14 +416,28 @@ class TrackingExperiment(CameraVisualExperiment):
             self.frame_recorder.start()
 
         self.gui_timer.timeout.connect(self.acc_tracking_framerate.update_list)
+        self.gui_timer.timeout.connect(self.acc_tracking_latency.update_list)
+
+    @property
+    def tracking_processes(self):
+        """ All processes involved in tracking, the one giving the final
+        output last"""
+        if self.tracking_reassembler is None:
+            return self.frame_dispatchers
+        return self.frame_dispatchers + [self.tracking_reassembler]
 
     def reset(self):
         super().reset()
         self.acc_tracking_framerate.reset()
+        self.acc_tracking_latency.reset()
         self.acc_tracking.reset()
+        if self.bout_log is not None:
+            self.bout_log.reset()
         if self.estimator is not None:
             self.estimator.reset()
             self.estimator_log.reset()
+        if self.latency_tracer is not None:
+            self.latency_tracer.reset()
 
     def make_window(self):
         self.window_main = TrackingExperimentWindow(experiment=self)
@@ -339,7 +474,17 @@ class TrackingExperiment(CameraVisualExperiment):
 
         """
         super().send_gui_parameters()
-        self.processing_params_queue.put(self.pipeline.serialize_changed_params())
+        changed_params = self.pipeline.serialize_changed_params()
+        for params_queue in self.processing_params_queues:
+            params_queue.put(changed_params)
+
+    def start_log_streams(self):
+        super().start_log_streams()
+        self.stream_log(self.acc_tracking, "behavior_log")
+        if self.bout_log is not None:
+            self.stream_log(self.bout_log, "bout_log")
+        if self.estimator is not None:
+            self.stream_log(self.estimator_log, "estimator_log")
 
     def start_protocol(self):
         # Freeze the plots so the plotting does not interfere with
@@ -380,10 +525,15 @@ class TrackingExperiment(CameraVisualExperiment):
 
         # Save log and estimators:
         self.save_log(self.acc_tracking, "behavior_log")
+        if self.bout_log is not None:
+            self.save_log(self.bout_log, "bout_log")
         try:
             self.save_log(self.estimator.log, "estimator_log")
         except AttributeError:
             pass
+        if self.latency_tracer is not None:
+            self.save_log(self.latency_tracer, "latency_log")
+            self.save_log(self.latency_tracer.display_log, "display_log")
 
         super().save_data()
 
@@ -401,6 +551,8 @@ class TrackingExperiment(CameraVisualExperiment):
         """
         super().set_protocol(protocol)
         self.protocol.sig_protocol_started.connect(self.acc_tracking.reset)
+        if self.bout_log is not None:
+            self.protocol.sig_protocol_started.connect(self.bout_log.reset)
 
     def wrap_up(self, *args, **kwargs):
         """
@@ -425,7 +577,8 @@ class TrackingExperiment(CameraVisualExperiment):
 
         self.frame_dispatcher.gui_queue.clear()
 
-        self.frame_dispatcher.join()
+        for process in self.tracking_processes:
+            process.join()
 
     def excepthook(self, exctype, value, tb):
         """ If an exception happens in the main loop, close all the
@@ -436,4 +589,5 @@ class TrackingExperiment(CameraVisualExperiment):
         print("{0}: {1}".format(exctype, value))
         self.finished_sig.set()
         self.camera.join()
-        self.frame_dispatcher.join()
+        for process in self.tracking_processes:
+            process.join()
@@ -12,6 +12,8 @@ from math import sin, cos
 from lightparam.gui import ParameterGui, ControlToggleIcon
 
 from stytra.gui.buttons import IconButton, ToggleIconButton, get_icon
+from stytra.tracking.preprocessing import Prefilter
+from stytra.tracking.tail import tail_roi
 
 
 class SingleLineROI(pg.LineSegmentROI):
@@ -78,7 +80,7 @@ class CameraViewWidget(QWidget):
         if hasattr(experiment, "frame_dispatcher"):
             self.frame_queue = self.experiment.frame_dispatcher.gui_queue
         else:
-            self.frame_queue = self.camera.frame_queue
+            self.frame_queue = self.camera.frame_ring.reader()
 
         # Queue of control parameters for the camera:
         self.control_queue = self.camera.control_queue
@@ -324,6 +326,15 @@ class TailTrackingSelection(CameraSelection):
         )
         self.tail_params.params.tail_length.changed = True
 
+        # if the filtering is cropped, it is restricted to the area
+        # the tail can reach
+        filter_node = getattr(self.experiment.pipeline, "filter", None)
+        if isinstance(filter_node, Prefilter):
+            filter_node._params.roi = tail_roi(
+                self.tail_params.tail_start, self.tail_params.tail_length
+            )
+            filter_node._params.params.roi.changed = True
+
         self.setting_param_val = False
 
     def scale_changed(self):
@@ -648,3 +659,98 @@ class CameraViewFish(CameraViewCalib):
                 self.lines_fish.setData(x=xs, y=ys)
         except ValueError as e:
             pass
+
+
+class MultiWellSelection(CameraSelection):
+    """ Shows the grid of wells of a multi-well plate, which can be moved
+    and resized, and the fish tracked in them
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tracking_params = self.experiment.pipeline.fishtrack._params
+
+        self.roi_plate = pg.ROI(
+            pos=self.tracking_params.plate_pos,
+            size=self.tracking_params.plate_dim,
+            pen=dict(color=(5, 40, 200), width=3),
+        )
+        self.roi_plate.addScaleHandle([0, 0], [1, 1])
+        self.roi_plate.addScaleHandle([1, 1], [0, 0])
+
+        self.lines_wells = pg.PlotCurveItem(
+            connect="pairs", pen=pg.mkPen((5, 40, 200), width=1)
+        )
+        self.points_fish = pg.ScatterPlotItem(
+            size=5, pxMode=True, brush=(255, 0, 0), pen=None
+        )
+        self.lines_fish = pg.PlotCurveItem(
+            connect="pairs", pen=pg.mkPen((10, 100, 200), width=3)
+        )
+        for item in [self.lines_wells, self.points_fish, self.lines_fish]:
+            self.display_area.addItem(item)
+
+        self.initialise_roi(self.roi_plate)
+        self.setting_param_val = False
+        self.draw_wells()
+
+    def draw_wells(self):
+        """ Draws the lines between the wells"""
+        (x, y), (w, h) = self.tracking_params.plate_pos, self.tracking_params.plate_dim
+        n_rows, n_columns = self.tracking_params.n_rows, self.tracking_params.n_columns
+        row_ys = y + h * np.arange(1, n_rows) / n_rows
+        column_xs = x + w * np.arange(1, n_columns) / n_columns
+        xs = np.concatenate(
+            [np.repeat([[x, x + w]], len(row_ys), 0).ravel(), np.repeat(column_xs, 2)]
+        )
+        ys = np.concatenate(
+            [np.repeat(row_ys, 2), np.repeat([[y, y + h]], len(column_xs), 0).ravel()]
+        )
+        self.lines_wells.setData(x=xs, y=ys)
+
+    def set_pos_from_tree(self):
+        """Go to parent for definition."""
+        super().set_pos_from_tree()
+        if not self.setting_param_val:
+            self.roi_plate.setPos(self.tracking_params.plate_pos, finish=False)
+            self.roi_plate.setSize(self.tracking_params.plate_dim)
+
+    def set_pos_from_roi(self):
+        """Go to parent for definition."""
+        super().set_pos_from_roi()
+        self.setting_param_val = True
+        self.tracking_params.params.plate_dim.changed = True
+        self.tracking_params.plate_dim = tuple([int(p) for p in self.roi_plate.size()])
+        self.tracking_params.params.plate_pos.changed = True
+        self.tracking_params.plate_pos = tuple([int(p) for p in self.roi_plate.pos()])
+        self.setting_param_val = False
+
+    def scale_changed(self):
+        self.set_pos_from_tree()
+
+    def retrieve_image(self):
+        """Go to parent for definition."""
+        super().retrieve_image()
+
+        # the plate and the number of wells can be changed in the parameters
+        self.draw_wells()
+
+        if (
+            len(self.experiment.acc_tracking.stored_data) == 0
+            or self.current_image is None
+        ):
+            return
+
+        current_data = self.experiment.acc_tracking.values_at_abs_time(
+            self.current_frame_time
+        )
+        n_wells = self.tracking_params.n_rows * self.tracking_params.n_columns
+        try:
+            retrieved_data = np.array(current_data).reshape(n_wells, -1)
+        except ValueError:
+            return
+        valid = np.logical_not(np.all(np.isnan(retrieved_data), 1))
+        self.points_fish.setData(y=retrieved_data[valid, 2], x=retrieved_data[valid, 0])
+        tail_len = self.tracking_params.tail_length / self.tracking_params.n_segments
+        ys, xs = _tail_points_from_coords(retrieved_data[valid], tail_len)
+        self.lines_fish.setData(x=xs, y=ys)
@@ -20,7 +20,11 @@ from stytra.gui.protocol_control import ProtocolControlToolbar
 from stytra.gui.camera_display import CameraViewWidget
 from stytra.gui.buttons import IconButton, ToggleIconButton
 from stytra.gui.status_display import StatusMessageDisplay
-from stytra.gui.framerate_viewer import MultiFrameratesWidget
+from stytra.gui.framerate_viewer import (
+    MultiFrameratesWidget,
+    PipelineProfilerWidget,
+    LatencyHistogramWidget,
+)
 
 from stytra.stimulation.stimulus_display import StimulusDisplayOnMainWindow
 
@@ -367,9 +371,12 @@ class TrackingExperimentWindow(CameraExperimentWindow):
 
         self.track_params_wnd = None
 
-        self.status_display.addMessageQueue(
-            self.experiment.frame_dispatcher.message_queue
-        )
+        for process in self.experiment.tracking_processes:
+            self.status_display.addMessageQueue(process.message_queue)
+        if self.experiment.recording_event is not None:
+            self.status_display.addMessageQueue(
+                self.experiment.frame_recorder.message_queue
+            )
 
     def construct_ui(self):
         """ """
@@ -385,6 +392,31 @@ class TrackingExperimentWindow(CameraExperimentWindow):
         self.add_dock(monitoring_dock)
 
         self.plot_framerate.add_framerate(self.experiment.acc_tracking_framerate)
+        self.plot_framerate.add_latency(self.experiment.acc_tracking_latency)
+
+        if self.experiment.profile_tracking:
+            self.profiler_widget = PipelineProfilerWidget(
+                [fd.profiling_queue for fd in self.experiment.frame_dispatchers]
+            )
+            self.experiment.gui_timer.timeout.connect(self.profiler_widget.update)
+
+            dock_profiler = QDockWidget("Tracking profiler", self)
+            dock_profiler.setObjectName("dock_profiler")
+            dock_profiler.setWidget(self.profiler_widget)
+            self.add_dock(dock_profiler)
+            self.addDockWidget(Qt.RightDockWidgetArea, dock_profiler)
+
+        if self.experiment.latency_tracer is not None:
+            self.latency_widget = LatencyHistogramWidget(
+                self.experiment.latency_tracer
+            )
+            self.experiment.gui_timer.timeout.connect(self.latency_widget.update)
+
+            dock_latency = QDockWidget("Closed-loop latency", self)
+            dock_latency.setObjectName("dock_latency")
+            dock_latency.setWidget(self.latency_widget)
+            self.add_dock(dock_latency)
+            self.addDockWidget(Qt.RightDockWidgetArea, dock_latency)
 
         if self.extra_widget:
             self.experiment.gui_timer.timeout.connect(self.extra_widget.update)
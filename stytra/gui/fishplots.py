@@ -102,10 +102,11 @@ class TailStreamPlot(QWidget):
     def update(self):
         if not self.isVisible():
             return
-        data_array = np.array(self.acc.stored_data[-self.n_points :])
-        if len(data_array) > 0:
+        data_array = self.acc.get_last_n(self.n_points)
+        if data_array is not None:
+            # the first columns are the time and the tail sum
             self.image_item.setImage(
-                image=np.diff(data_array[:, 1:], axis=1).T, autoLevels=False
+                image=np.diff(data_array[:, 2:], axis=1).T, autoLevels=False
             )
 
 
@@ -204,17 +205,13 @@ class BoutPlot(QWidget):
         if not self.isVisible():
             return
 
-        current_index = len(self.acc.stored_data)
+        current_index = self.acc.n_stored
         if current_index == 0 or current_index < self.processed_index + 2:
             return
 
         # Pull the new data from the accumulator
-        new_coords = np.array(
-            self.acc.stored_data[
-                max(
-                    self.processed_index, current_index - self.n_save_max
-                ) : current_index
-            ]
+        new_coords = self.acc.get_last_n(
+            current_index - max(self.processed_index, current_index - self.n_save_max)
         )
         self.processed_index = current_index
 
@@ -1,9 +1,20 @@
 from PyQt5.QtCore import QPoint
-from PyQt5.QtWidgets import QWidget, QLabel, QHBoxLayout, QSizePolicy, QSpacerItem
+from PyQt5.QtWidgets import (
+    QWidget,
+    QLabel,
+    QHBoxLayout,
+    QSizePolicy,
+    QSpacerItem,
+    QTableWidget,
+    QTableWidgetItem,
+    QHeaderView,
+)
 from PyQt5.QtGui import QPainter, QColor, QPen, QBrush
 from PyQt5.QtCore import Qt
 
 import numpy as np
+import pyqtgraph as pg
+from queue import Empty
 
 
 class FramerateWidget(QWidget):
@@ -167,6 +178,106 @@ class MultiFrameratesWidget(QWidget):
         self.fr_widgets.append(fr_disp)
         self.layout().addWidget(fr_disp)
 
+    def add_latency(self, latency_acc):
+        lat_disp = LatencyWidget(latency_acc)
+        self.layout().addItem(QSpacerItem(40, 10))
+        self.fr_widgets.append(lat_disp)
+        self.layout().addWidget(lat_disp)
+
+
+class LatencyWidget(QLabel):
+    """Shows the last latency (in seconds) in an accumulator, in ms"""
+
+    def __init__(self, acc):
+        super().__init__()
+        self.acc = acc
+        self.setText("{}: -".format(self.acc.name))
+
+    def update(self):
+        if len(self.acc.stored_data) > 0:
+            self.setText(
+                "{}: {:.1f} ms".format(self.acc.name, self.acc.stored_data[-1] * 1000)
+            )
+
+
+class PipelineProfilerWidget(QTableWidget):
+    """Table showing the percentiles of the time spent in each node of the
+    tracking pipeline, as sent through the profiling queues of the tracking
+    processes (see :class:`PipelineProfiler
+    <stytra.tracking.pipelines.PipelineProfiler>`)
+    """
+
+    def __init__(self, queues):
+        super().__init__()
+        self.queues = queues
+        self.summaries = [dict() for _ in queues]
+        self.setColumnCount(3)
+        self.setHorizontalHeaderLabels(["p50 (us)", "p95 (us)", "p99 (us)"])
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.setEditTriggers(QTableWidget.NoEditTriggers)
+
+    def update(self):
+        new_data = False
+        for i_queue, queue in enumerate(self.queues):
+            while True:
+                try:
+                    _, self.summaries[i_queue] = queue.get(timeout=0.001)
+                    new_data = True
+                except Empty:
+                    break
+        if not new_data:
+            return
+
+        rows = []
+        for i_queue, summary in enumerate(self.summaries):
+            for name, percs in summary.items():
+                if len(self.queues) > 1:
+                    name = "{} ({})".format(name, i_queue)
+                rows.append((name, percs))
+
+        self.setRowCount(len(rows))
+        self.setVerticalHeaderLabels([name for name, _ in rows])
+        for i_row, (_, percs) in enumerate(rows):
+            for i_col, val in enumerate(percs):
+                self.setItem(i_row, i_col, QTableWidgetItem("{:.0f}".format(val)))
+
+
+class LatencyHistogramWidget(pg.PlotWidget):
+    """Plots the histograms of the closed-loop latencies collected by a
+    :class:`LatencyTracer <stytra.collectors.latency.LatencyTracer>`, with
+    their median and 95th percentile in the title
+    """
+
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+        self.setLabel("bottom", "latency", "ms")
+        self.addLegend()
+        bins = np.arange(tracer.n_bins + 1) * tracer.bin_width * 1000
+        self.curves = {
+            stage: self.plot(
+                bins,
+                np.zeros(tracer.n_bins),
+                stepMode=True,
+                pen=pg.intColor(i_stage, len(tracer.stages)),
+                name=stage,
+            )
+            for i_stage, stage in enumerate(tracer.stages)
+        }
+        self.bins = bins
+
+    def update(self):
+        titles = []
+        for stage, curve in self.curves.items():
+            histogram = self.tracer.histograms[stage]
+            curve.setData(self.bins, histogram, stepMode=True)
+            percs = self.tracer.percentiles(stage, (50, 95))
+            if percs is not None:
+                titles.append(
+                    "{} {:.1f}/{:.1f}".format(stage, percs[0] * 1000, percs[1] * 1000)
+                )
+        self.setTitle("p50/p95 (ms): " + ", ".join(titles) if titles else None)
+
 
 if __name__ == "__main__":
     from PyQt5.QtWidgets import QApplication
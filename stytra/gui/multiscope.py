@@ -78,7 +78,7 @@ class MultiStreamPlot(QWidget):
 
             try:
                 tm = self.experiment.tracking_method_name
-                if tm == "tail" or tm == "fish":
+                if tm in ["tail", "fish", "multiwell"]:
                     self.btn_extra = QPushButton(
                         "Show tail curvature" if tm == "tail" else "Show last bouts"
                     )
@@ -312,10 +312,10 @@ class MultiStreamPlot(QWidget):
             # try:
             # difference from data accumulator time and now in seconds:
             delta_t = (self.experiment.t0 - current_time).total_seconds()
-            data_frame = acc.get_last_t(self.time_past)
+            data_array = acc.get_last_t(self.time_past)
 
             # if this accumulator does not have enough data to plot, skip it
-            if data_frame is None or data_frame.shape[0] <= 1:
+            if data_array is None or data_array.shape[0] <= 1:
                 for _ in sel_cols:
                     self._set_labels(self.stream_items[i_stream])
                     self.stream_items[i_stream].curve.setData(x=[], y=[])
@@ -323,22 +323,20 @@ class MultiStreamPlot(QWidget):
                 continue
 
             # downsampling if there are too many points
-            if len(data_frame) > self.n_points_max:
-                data_frame = data_frame[:: len(data_frame) // self.n_points_max]
+            if len(data_array) > self.n_points_max:
+                data_array = data_array[:: len(data_array) // self.n_points_max]
 
-            time_array = delta_t + data_frame.t.values
+            time_array = delta_t + data_array[:, 0]
+            col_arrays = [data_array[:, acc.header_dict[col]] for col in sel_cols]
 
             # loop to handle nan values in a single column
             new_bounds = np.zeros((len(sel_cols), 2))
 
-            for id, col in enumerate(sel_cols):
+            for id, d in enumerate(col_arrays):
                 # Exclude nans from calculation of percentile boundaries:
-                d = data_frame[col].values
-                if d.dtype != np.float64:
-                    continue
                 b = ~np.isnan(d)
                 if np.any(b):
-                    non_nan_data = data_frame[col][b]
+                    non_nan_data = d[b]
                     new_bounds[id, :] = np.percentile(non_nan_data, (0.5, 99.5), 0)
                     # if the bounds are the same, set arbitrary ones
                     if new_bounds[id, 0] == new_bounds[id, 1]:
@@ -346,19 +344,15 @@ class MultiStreamPlot(QWidget):
 
             self.update_bounds(i_acc, new_bounds)
 
-            for col, (lb, ub) in zip(sel_cols, self.bounds[i_acc]):
+            for d, (lb, ub) in zip(col_arrays, self.bounds[i_acc]):
                 scale = ub - lb
                 if scale < 0.00001:
                     self.stream_items[i_stream].curve.setData(x=[], y=[])
                 else:
                     self.stream_items[i_stream].curve.setData(
-                        x=time_array,
-                        y=i_stream + ((data_frame[col].values - lb) / scale),
+                        x=time_array, y=i_stream + ((d - lb) / scale)
                     )
-                self._set_labels(
-                    self.stream_items[i_stream],
-                    values=(lb, ub, data_frame[col].values[-1]),
-                )
+                self._set_labels(self.stream_items[i_stream], values=(lb, ub, d[-1]))
                 i_stream += 1
 
     def show_extra_plot(self):
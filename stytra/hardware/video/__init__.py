@@ -6,14 +6,14 @@ implement video saving
 import numpy as np
 
 from multiprocessing import Queue, Event
-from queue import Empty, Full
+from queue import Empty
 
 from lightparam import Param
 from lightparam.param_qt import ParametrizedQt
 
 from stytra.hardware.video.cameras.interface import CameraError
 from stytra.utilities import FrameProcess
-from arrayqueues.shared_arrays import IndexedArrayQueue
+from stytra.hardware.video.frame_ring import FrameRing
 import flammkuchen as fl
 
 from stytra.hardware.video.cameras import camera_class_dict
@@ -38,11 +38,12 @@ class VideoSource(FrameProcess):
         object.
 
 
-    **Output Queues**
+    **Output**
 
-    self.frame_queue :
-        TimestampedArrayQueue from the arrayqueues module
-        where the frames read from the camera are sent.
+    self.frame_ring :
+        :class:`FrameRing <stytra.hardware.video.frame_ring.FrameRing>`
+        in shared memory where the frames read from the camera are written,
+        and from which the consumers read them
 
 
     **Events**
@@ -56,35 +57,26 @@ class VideoSource(FrameProcess):
     rotation : int
         n of times image should be rotated of 90 degrees
     max_mbytes_queue : int
-        maximum size of camera queue (Mbytes)
+        maximum size of the frame ring (Mbytes)
 
     Returns
     -------
 
     """
 
-    def __init__(self, rotation=False, max_mbytes_queue=200, n_consumers=1):
+    def __init__(self, rotation=False, max_mbytes_queue=200):
         """ """
         super().__init__(name="camera")
         self.rotation = rotation
         self.control_queue = Queue()
-        self.frame_queue = IndexedArrayQueue(max_mbytes=max_mbytes_queue)
+        self.frame_ring = FrameRing(max_mbytes=max_mbytes_queue)
         self.kill_event = Event()
-        self.n_consumers = 1
         self.state = None
 
     def put_frame(self, frame, messages):
-        # If the queue is full, arrayqueues should print a warning!
-        try:
-            if self.frame_queue.queue.qsize() < self.n_consumers + 2:
-                self.frame_queue.put(frame)
-            else:
-                messages.append("W:Dropped frame")
-        except NotImplementedError:
-            try:
-                self.frame_queue.put(frame)
-            except Full:
-                messages.append("W:Dropped frame")
+        # The frame is written once, the consumers which are too slow
+        # account for the frames they miss
+        self.frame_ring.put(frame)
         self.update_framerate()
 
 
@@ -157,7 +149,7 @@ class CameraSource(VideoSource):
         following:
 
             - read control parameters from the control_queue and set them;
-            - read frames from the camera and put them in the frame_queue.
+            - read frames from the camera and put them in the frame_ring.
 
 
         """
@@ -204,7 +196,7 @@ class CameraSource(VideoSource):
                     "I:Ring_buffer_size:" + str(self.ring_buffer.length)
                 )
                 if self.ring_buffer.arr is not None:
-                    self.frame_queue.put(self.ring_buffer.get_most_recent())
+                    self.frame_ring.put(self.ring_buffer.get_most_recent())
                 else:
                     self.message_queue.put("E:camera paused before any frames acquired")
                 prt = None
@@ -221,7 +213,7 @@ class CameraSource(VideoSource):
                         int(round(self.state.replay_limits[1] * old_fps)),
                     )
                 try:
-                    self.frame_queue.put(self.ring_buffer.get())
+                    self.frame_ring.put(self.ring_buffer.get())
                 except ValueError:
                     pass
                 delta_t = 1 / self.state.replay_fps
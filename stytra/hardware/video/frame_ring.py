@@ -0,0 +1,280 @@
+"""
+Ring of frames in shared memory, written once by a video source and read
+without copying by any number of consumer processes
+"""
+
+import time
+from datetime import datetime
+from multiprocessing import RawArray, RawValue, Value
+from queue import Empty
+
+import numpy as np
+
+
+class FrameRing:
+    """A ring of frame slots in shared memory. The video source writes
+    each frame once with :meth:`put`, and the consumers (tracking, recording,
+    display) read them by frame index through :class:`FrameRingReader`
+    objects, getting views of the shared memory instead of copies.
+
+    The writer never waits for the readers: each slot has a sequence number,
+    the index of the frame written in it (-1 while it is being written),
+    so that readers can tell when a frame has been overwritten before they
+    got to it, and count it as dropped.
+
+    Parameters
+    ----------
+    max_mbytes : int
+        size of the shared memory, the number of slots depends on the size
+        of the frames
+    max_slots : int
+        maximal number of slots
+
+    """
+
+    def __init__(self, max_mbytes=100, max_slots=1000):
+        self.max_bytes = int(max_mbytes * 1000000)
+        self.max_slots = max_slots
+        self.buffer = RawArray("b", self.max_bytes)
+        self.sequence = RawArray("q", max_slots)
+        self.times = RawArray("d", max_slots)
+
+        # index of the last frame written
+        self.head = RawValue("q", -1)
+
+        # number of slots, dtype character and shape (up to 3 dimensions)
+        self.layout = RawArray("q", 6)
+        self.layout_version = RawValue("q", 0)
+
+        self._view = None
+        self._view_version = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = None
+        state["_view_version"] = 0
+        return state
+
+    @property
+    def n_slots(self):
+        return self.layout[0]
+
+    def _set_layout(self, frame):
+        n_slots = min(self.max_slots, self.max_bytes // max(frame.nbytes, 1))
+        if n_slots < 2:
+            raise ValueError(
+                "Frames of {} bytes do not fit in a ring of {} bytes".format(
+                    frame.nbytes, self.max_bytes
+                )
+            )
+        if frame.ndim > 3:
+            raise ValueError("Frames can have at most 3 dimensions")
+
+        for i in range(self.max_slots):
+            self.sequence[i] = -1
+        self.layout[0] = n_slots
+        self.layout[1] = ord(frame.dtype.char)
+        self.layout[2] = frame.ndim
+        for i_dim in range(3):
+            self.layout[3 + i_dim] = (
+                frame.shape[i_dim] if i_dim < frame.ndim else 1
+            )
+        self.layout_version.value += 1
+
+    def _current_view(self):
+        version = self.layout_version.value
+        if version != self._view_version:
+            n_slots, dtype_char, ndim = self.layout[:3]
+            shape = tuple(self.layout[3 : 3 + ndim])
+            self._view = np.frombuffer(
+                self.buffer, np.dtype(chr(dtype_char)), n_slots * int(np.prod(shape))
+            ).reshape((n_slots,) + shape)
+            self._view_version = version
+        return self._view
+
+    def put(self, frame, timestamp=None):
+        """ Writes a frame in the ring, overwriting the oldest one
+
+        Parameters
+        ----------
+        frame : np.ndarray
+        timestamp : datetime
+            time of the frame, if not given the current time is used
+
+        """
+        view = self._current_view()
+        if view is None or view.shape[1:] != frame.shape or view.dtype != frame.dtype:
+            self._set_layout(frame)
+            view = self._current_view()
+
+        if timestamp is None:
+            timestamp = datetime.now()
+
+        index = self.head.value + 1
+        slot = index % view.shape[0]
+        self.sequence[slot] = -1
+        view[slot] = frame
+        self.times[slot] = timestamp.timestamp()
+        self.sequence[slot] = index
+        self.head.value = index
+
+    def read(self, index):
+        """ Returns the time and a view of the frame with the given index,
+        or None if the frame is not in the ring. The view is only valid until
+        the frame is overwritten, which has to be checked with
+        :meth:`is_valid` once the frame has been used
+
+        """
+        view = self._current_view()
+        if view is None:
+            return None
+        slot = index % view.shape[0]
+        # the time is read before checking the slot, so that it cannot be
+        # the one of a newer frame
+        timestamp = self.times[slot]
+        if self.sequence[slot] != index:
+            return None
+        return datetime.fromtimestamp(timestamp), view[slot]
+
+    def is_valid(self, index):
+        """ Checks whether the frame with the given index is still in the ring """
+        view = self._current_view()
+        return view is not None and self.sequence[index % view.shape[0]] == index
+
+    def get_latest(self):
+        """ Returns the time, index and a view of the last frame written
+
+        Raises
+        ------
+        Empty if no frame has been written yet
+        """
+        index = self.head.value
+        read = self.read(index) if index >= 0 else None
+        if read is None:
+            raise Empty()
+        return read[0], index, read[1]
+
+    def reader(self, shared=False):
+        """ Creates a new :class:`FrameRingReader` for this ring
+
+        Parameters
+        ----------
+        shared : bool
+            if True, all the copies of the reader passed to different
+            processes share the same position, so that each frame is read
+            by only one of them (for a pool of processes)
+
+        """
+        return FrameRingReader(self, shared=shared)
+
+
+class FrameRingReader:
+    """Reads the frames of a :class:`FrameRing` in order, with the same
+    get interface as the arrayqueues IndexedArrayQueue, returning the time,
+    index and a view of each frame.
+
+    Each reader counts the frames it missed because they were overwritten
+    before being read, or while being used (see :meth:`confirm`), in
+    n_dropped, and the ones it skipped on purpose to
+    keep up with the camera in n_skipped. The reading starts from the latest
+    frame written when the first frame is read.
+
+    """
+
+    def __init__(self, ring, shared=False):
+        self.ring = ring
+        self.cursor = Value("q", -1) if shared else None
+        self.next_index = -1
+        self.n_dropped = 0
+        self.n_skipped = 0
+
+    def _advance(self, next_index, latest=False):
+        """ Returns the index of the frame to be read given the index of
+        the next frame wanted, or None if there is no new frame
+        """
+        head = self.ring.head.value
+        if head < 0:
+            return None
+        if next_index < 0:
+            return head
+        if next_index > head:
+            return None
+        if latest:
+            self.n_skipped += head - next_index
+            return head
+        # the slot after the head can be in the process of being overwritten
+        oldest = head - self.ring.n_slots + 2
+        if next_index < oldest:
+            self.n_dropped += oldest - next_index
+            return oldest
+        return next_index
+
+    def _claim(self, latest=False):
+        if self.cursor is None:
+            index = self._advance(self.next_index, latest)
+            if index is not None:
+                self.next_index = index + 1
+            return index
+
+        with self.cursor.get_lock():
+            index = self._advance(self.cursor.value, latest)
+            if index is not None:
+                self.cursor.value = index + 1
+        return index
+
+    def get(self, timeout=0.001, latest=False, max_latency=None, **kwargs):
+        """ Returns the time, index and a view of the next frame, waiting
+        for at most timeout seconds
+
+        Parameters
+        ----------
+        timeout : float
+            maximal waiting time in seconds
+        latest : bool
+            if True, skip to the last frame written
+        max_latency : float
+            if given, frames older than max_latency seconds are skipped
+            if there are newer ones
+
+        Raises
+        ------
+        Empty if no new frame is available
+        """
+        t_end = time.perf_counter() + (timeout or 0)
+        while True:
+            index = self._claim(latest)
+            if index is not None:
+                read = self.ring.read(index)
+                if read is None:
+                    self.n_dropped += 1
+                    continue
+                if (
+                    max_latency is not None
+                    and index < self.ring.head.value
+                    and time.time() - read[0].timestamp() > max_latency
+                ):
+                    self.n_skipped += 1
+                    continue
+                return read[0], index, read[1]
+            if time.perf_counter() >= t_end:
+                raise Empty()
+            time.sleep(0.0002)
+
+    def is_valid(self, index):
+        return self.ring.is_valid(index)
+
+    def confirm(self, index):
+        """ Checks, once the frame with the given index has been used (e.g.
+        tracked or copied), that it was not overwritten in the meantime.
+        Otherwise the frame is counted in n_dropped, and whatever was
+        obtained from it has to be discarded
+
+        Returns
+        -------
+        True if the frame was still valid
+
+        """
+        if self.ring.is_valid(index):
+            return True
+        self.n_dropped += 1
+        return False
@@ -21,7 +21,8 @@ class VideoWriter(FrameProcess):
     folder
         output folder
     input_queue
-        queue of incoming frames
+        :class:`FrameRingReader <stytra.hardware.video.frame_ring.FrameRingReader>`
+        of the camera frames
     finished_signal
         signal to finish recording
     kbit_rate
@@ -39,6 +40,7 @@ class VideoWriter(FrameProcess):
         self.times = []
         self.recording = False
         self.log_format = log_format
+        self.n_dropped_reported = 0
 
     def run(self):
         while True:
@@ -46,14 +48,22 @@ class VideoWriter(FrameProcess):
             self.reset()
             while True:
                 try:
-                    t, current_frame = self.input_queue.get(timeout=0.01)
+                    t, frame_idx, current_frame = self.input_queue.get(timeout=0.01)
                     if self.saving_evt.is_set():
                         if not self.recording:
                             self.configure(current_frame.shape)
                             self.recording = True
-                        self.ingest_frame(current_frame)
-                        self.times.append(t)
-                        toggle_save = True
+                            self.n_dropped_reported = self.input_queue.n_dropped
+                        # the frame is a view of the camera frame ring, it
+                        # is discarded if overwritten while being copied
+                        frame = self.copy_frame(current_frame)
+                        if self.input_queue.confirm(frame_idx):
+                            self.ingest_frame(frame)
+                            self.times.append(t)
+                            toggle_save = True
+                        if self.input_queue.n_dropped > self.n_dropped_reported:
+                            self.n_dropped_reported = self.input_queue.n_dropped
+                            self.message_queue.put("W:Dropped frames in recording")
 
                 except Empty:
                     pass
@@ -75,12 +85,18 @@ class VideoWriter(FrameProcess):
     def configure(self, size):
         self.filename_base = self.filename_queue.get(timeout=0.01)
 
+    def copy_frame(self, frame):
+        """ Copies a frame out of the camera frame ring, in the form taken
+        by ingest_frame
+        """
+        return frame.copy()
+
     def ingest_frame(self, frame):
         pass
 
     def complete(self):
         save_df(
-            pd.DataFrame(self.times, columns="t"),
+            pd.DataFrame(self.times, columns=["t"]),
             self.filename_base + "video_times",
             self.log_format,
         )
@@ -139,11 +155,13 @@ class StreamingVideoWriter(VideoWriter):
         self.stream.codec_context.bit_rate_tolerance = self.kbit_rate * 200
         self.stream.pix_fmt = "yuv420p"
 
+    def copy_frame(self, frame):
+        return av.VideoFrame.from_ndarray(frame, format="gray8")
+
     def ingest_frame(self, frame):
         if self.stream is None:
-            self.configure(frame.shape)
-        av_frame = av.VideoFrame.from_ndarray(frame, format="gray8")
-        for packet in self.stream.encode(av_frame):
+            self.configure((frame.height, frame.width))
+        for packet in self.stream.encode(frame):
             self.container.mux(packet)
 
     def reset(self):
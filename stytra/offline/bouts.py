@@ -0,0 +1,403 @@
+""" Offline bout segmentation of the behavior logs saved by stytra, with the
+same rules as the online detection of
+:class:`BoutDetectorNode <stytra.tracking.online_bouts.BoutDetectorNode>`,
+so that the bouts found offline are the ones which were (or would have been)
+detected during the experiment.
+
+Example
+-------
+    segment_logs(Path("data").glob("*behavior_log.csv"), threshold=0.2)
+
+writes a bout table (named as the log, with _bouts appended) for each log,
+processing the logs in parallel.
+"""
+
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from stytra.utilities import reduce_to_pi, save_df
+
+bout_table_columns = [
+    "fish",
+    "start_index",
+    "n_frames",
+    "t_start",
+    "duration",
+    "x",
+    "y",
+    "theta",
+    "dx",
+    "dy",
+    "displacement",
+    "heading_change",
+    "max_tail_amplitude",
+    "tail_beat_frequency",
+    "peak_vel",
+]
+
+
+def segment_bouts(
+    vel, threshold=0.2, n_without_crossing=5, pad_after=5, min_bout_len=1, i_first=1
+):
+    """ Segments the bouts in a velocity trace. The threshold crossings are
+    found for the whole trace at once, and the bouts are chained from them
+    with the rules of the online detection (see
+    :func:`_process_input <stytra.tracking.online_bouts._process_input>`):
+    a bout starts when the velocity crosses the threshold upwards, and ends
+    n_without_crossing + 1 samples after it first crosses it downwards.
+    No bout can start in the pad_after samples following a bout.
+
+    Parameters
+    ----------
+    vel : np.ndarray
+        velocity trace
+    i_first : int
+        index of the first sample at which a bout can start
+
+    Returns
+    -------
+    starts : np.ndarray
+        index of the first sample of each bout
+    ends : np.ndarray
+        index of the sample at which each bout ends (the first one not
+        belonging to it)
+    i_next : int
+        if the trace is extended, the index from which the segmentation
+        has to be continued: the start of a bout which has not ended yet,
+        or the first sample at which a new bout can start
+
+    """
+    above = vel > threshold
+    below = vel < threshold
+    ups = np.flatnonzero(below[:-1] & above[1:]) + 1
+    downs = np.flatnonzero(above[:-1] & below[1:]) + 1
+
+    starts = []
+    ends = []
+    i_free = i_first
+    while True:
+        i_up = np.searchsorted(ups, i_free)
+        if i_up == len(ups):
+            i_next = max(i_free, len(vel))
+            break
+        start = ups[i_up]
+        i_down = np.searchsorted(downs, start + 1)
+        if i_down == len(downs) or downs[i_down] + n_without_crossing + 1 >= len(vel):
+            i_next = start
+            break
+        end = downs[i_down] + n_without_crossing + 1
+        if end - start >= min_bout_len:
+            starts.append(start)
+            ends.append(end)
+            i_free = end + pad_after + 1
+        else:
+            i_free = end + 1
+    return np.array(starts, np.int64), np.array(ends, np.int64), i_next
+
+
+def fish_columns(columns):
+    """ Finds the columns describing each fish in a behavior log, either
+    the f{i}_ column groups of the freely-swimming fish tracking, or the
+    tail_sum of the tail tracking
+
+    Returns
+    -------
+    list of dictionaries with the x, y, theta and tail angle columns of each
+    fish, None if not present
+
+    """
+    columns = set(columns)
+    fish = []
+    while "f{:d}_x".format(len(fish)) in columns:
+        prefix = "f{:d}_".format(len(fish))
+        tail_columns = sorted(c for c in columns if c.startswith(prefix + "theta_"))
+        fish.append(
+            dict(
+                x=prefix + "x",
+                y=prefix + "y",
+                theta=prefix + "theta",
+                tail=tail_columns[-1] if tail_columns else None,
+            )
+        )
+    if not fish and "tail_sum" in columns:
+        fish.append(dict(x=None, y=None, theta=None, tail="tail_sum"))
+    return fish
+
+
+def _column(df, name):
+    if name is None:
+        return np.full(len(df), np.nan)
+    return df[name].values.astype(np.float64)
+
+
+def bout_features(df, fish, starts, ends, vel):
+    """ Computes the kinematic features of the bouts of one fish
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        behavior log
+    fish : dict
+        columns of the fish, see :func:`fish_columns`
+    starts, ends : np.ndarray
+        bouts, as returned by :func:`segment_bouts`
+    vel : np.ndarray
+        velocity trace used for the segmentation
+
+    Returns
+    -------
+    dictionary of the features, with an array of values for each
+
+    """
+    t = df["t"].values
+    x, y = _column(df, fish["x"]), _column(df, fish["y"])
+    if fish["x"] is None:
+        # for the tail tracking, the tail angle is used for the segmentation
+        theta = _column(df, fish["tail"])
+    else:
+        theta = _column(df, fish["theta"])
+    tail = _column(df, fish["tail"])
+    if fish["x"] is not None:
+        # the angle of the last tail segment relative to the first one
+        tail = reduce_to_pi(tail)
+
+    # the pose before each bout and its change at the end of the bout
+    before = starts - 1
+    dx = x[ends] - x[before]
+    dy = y[ends] - y[before]
+    dtheta = theta[ends] - theta[before]
+    if fish["x"] is not None:
+        dtheta = reduce_to_pi(dtheta)
+
+    # reductions over the samples of each bout
+    lengths = ends - starts
+    bout_edges = np.stack([starts, ends], 1).ravel()
+    peak_vel = np.maximum.reduceat(vel, bout_edges)[::2]
+    max_amplitude = np.fmax.reduceat(np.abs(tail), bout_edges)[::2]
+
+    # tail beats, from the crossings of the mean tail angle of each bout
+    i_bout = np.repeat(np.arange(len(starts)), lengths)
+    rows = np.arange(lengths.sum()) + np.repeat(
+        starts - np.cumsum(lengths) + lengths, lengths
+    )
+    finite = np.isfinite(tail[rows])
+    mean_tail = np.bincount(
+        i_bout[finite], tail[rows][finite], minlength=len(starts)
+    ) / np.maximum(np.bincount(i_bout[finite], minlength=len(starts)), 1)
+    signs = np.sign(tail[rows] - mean_tail[i_bout])
+    crossing = (signs[1:] * signs[:-1] < 0) & (i_bout[1:] == i_bout[:-1])
+    n_crossings = np.bincount(i_bout[1:][crossing], minlength=len(starts))
+
+    duration = t[ends] - t[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frequency = np.where(duration > 0, n_crossings / (2 * duration), np.nan)
+    if fish["tail"] is None:
+        frequency[:] = np.nan
+
+    return dict(
+        start_index=starts,
+        n_frames=lengths,
+        t_start=t[starts],
+        duration=duration,
+        x=x[before],
+        y=y[before],
+        theta=theta[before],
+        dx=dx,
+        dy=dy,
+        displacement=np.sqrt(dx ** 2 + dy ** 2),
+        heading_change=dtheta,
+        max_tail_amplitude=max_amplitude,
+        tail_beat_frequency=frequency,
+        peak_vel=peak_vel,
+    )
+
+
+class BoutSegmenter:
+    """ Segments the bouts of all the fish in a behavior log which is read
+    in consecutive chunks. The samples of the bouts which have not ended at
+    the end of a chunk are kept and segmented together with the next one.
+
+    The velocity of each fish is the squared displacement of its position
+    between samples, or the squared change of the tail_sum for the tail
+    tracking, as for the online detection. Samples in which the fish
+    is not found are taken as still.
+
+    Parameters
+    ----------
+    threshold, n_without_crossing, pad_after, min_bout_len :
+        parameters of the segmentation, see :func:`segment_bouts`
+
+    """
+
+    def __init__(
+        self, threshold=0.2, n_without_crossing=5, pad_after=5, min_bout_len=1
+    ):
+        self.params = dict(
+            threshold=threshold,
+            n_without_crossing=n_without_crossing,
+            pad_after=pad_after,
+            min_bout_len=min_bout_len,
+        )
+        self._buffer = None
+        self._offset = 0
+        self._fish = None
+        self._i_next = None
+
+    def feed(self, chunk):
+        """ Segments the next chunk of the log
+
+        Parameters
+        ----------
+        chunk : pd.DataFrame
+            the next samples of the log
+
+        Returns
+        -------
+        pd.DataFrame of the bouts ended in the chunk, with the columns of
+        bout_table_columns
+
+        """
+        if self._buffer is None:
+            buffer = chunk
+            self._fish = fish_columns(chunk.columns)
+            self._i_next = [1] * len(self._fish)
+        else:
+            buffer = pd.concat([self._buffer, chunk])
+
+        # the velocity at the first sample of the buffer is not known
+        # if earlier samples have been discarded
+        i_min = 1 if self._offset == 0 else 2
+        bouts = []
+        i_keep = len(buffer) - 2
+        for i_fish, fish in enumerate(self._fish):
+            if fish["x"] is None:
+                coords = _column(buffer, fish["tail"])[:, None]
+            else:
+                coords = np.stack(
+                    [_column(buffer, fish["x"]), _column(buffer, fish["y"])], 1
+                )
+            vel = np.zeros(len(buffer))
+            vel[1:] = np.sum(np.diff(coords, axis=0) ** 2, 1)
+            vel[~np.isfinite(vel)] = 0
+
+            starts, ends, i_next = segment_bouts(
+                vel,
+                i_first=max(self._i_next[i_fish] - self._offset, i_min),
+                **self.params
+            )
+            self._i_next[i_fish] = i_next + self._offset
+            i_keep = min(i_keep, i_next - 2)
+            if len(starts) > 0:
+                features = bout_features(buffer, fish, starts, ends, vel)
+                features["start_index"] = features["start_index"] + self._offset
+                bouts.append(pd.DataFrame(dict(fish=i_fish, **features)))
+
+        i_keep = max(i_keep, 0)
+        self._buffer = buffer.iloc[i_keep:]
+        self._offset += i_keep
+
+        if not bouts:
+            return pd.DataFrame(columns=bout_table_columns)
+        return (
+            pd.concat(bouts)[bout_table_columns]
+            .sort_values(["start_index", "fish"], kind="stable")
+            .reset_index(drop=True)
+        )
+
+
+def read_log_chunks(path, chunk_size=100000):
+    """ Reads a log saved in one of the formats of :func:`save_df
+    <stytra.utilities.save_df>` in chunks of chunk_size rows. The csv files
+    are streamed, the other formats are loaded at once and then split.
+    """
+    path = Path(path)
+    if path.suffix == ".csv":
+        yield from pd.read_csv(str(path), sep=";", index_col=0, chunksize=chunk_size)
+        return
+    if path.suffix == ".feather":
+        df = pd.read_feather(path)
+    elif path.suffix == ".hdf5":
+        df = pd.read_hdf(path, "/data")
+    elif path.suffix == ".json":
+        df = pd.read_json(path)
+    else:
+        raise NotImplementedError(path.suffix + " is not an implemented log format")
+    for i_start in range(0, len(df), chunk_size):
+        yield df.iloc[i_start : i_start + chunk_size]
+
+
+def segment_log(path, chunk_size=100000, **params):
+    """ Segments the bouts of a saved behavior log
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the log
+    chunk_size : int
+        number of samples which are read at once
+    params :
+        parameters of the segmentation, see :class:`BoutSegmenter`
+
+    Returns
+    -------
+    pd.DataFrame with a row for each bout
+
+    """
+    segmenter = BoutSegmenter(**params)
+    return pd.concat(
+        [segmenter.feed(chunk) for chunk in read_log_chunks(path, chunk_size)],
+        ignore_index=True,
+    )
+
+
+def segment_log_file(path, output_format=None, **kwargs):
+    """ Segments the bouts of a saved behavior log and saves the bout table
+    next to it, with _bouts appended to the name
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the log
+    output_format : str
+        format of the bout table, by default the one of the log
+    kwargs :
+        arguments of :func:`segment_log`
+
+    Returns
+    -------
+    the name of the bout table file
+
+    """
+    path = Path(path)
+    bouts = segment_log(path, **kwargs)
+    return save_df(
+        bouts,
+        path.parent / (path.stem + "_bouts"),
+        output_format or path.suffix[1:],
+    )
+
+
+def segment_logs(paths, n_processes=None, **kwargs):
+    """ Segments the bouts of multiple saved behavior logs in parallel,
+    saving a bout table for each one
+
+    Parameters
+    ----------
+    paths :
+        paths of the logs
+    n_processes : int
+        number of processes, by default the number of cores
+    kwargs :
+        arguments of :func:`segment_log_file`
+
+    Returns
+    -------
+    list of the names of the bout tables
+
+    """
+    with Pool(n_processes) as pool:
+        return pool.map(partial(segment_log_file, **kwargs), list(paths))
@@ -258,10 +258,16 @@ class ProtocolRunner(QObject):
 
     def update_dynamic_log(self):
         """
-        Update a dynamic log. Called only if one is present.
+        Update a dynamic log. Called only if one is present. If the experiment
+        has an estimator, the index of the camera frame of its last estimate
+        is logged as well.
         """
-
-        self.dynamic_log.update_list(self.t, self.current_stimulus.get_dynamic_state())
+        estimator = getattr(self.experiment, "estimator", None)
+        self.dynamic_log.update_list(
+            self.t,
+            self.current_stimulus.get_dynamic_state(),
+            None if estimator is None else estimator.frame_index,
+        )
 
     @property
     def duration(self):
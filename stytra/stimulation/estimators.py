@@ -1,7 +1,10 @@
 import numpy as np
 import datetime
+from collections import OrderedDict, deque
+from multiprocessing import RawArray, RawValue
 
 from stytra.collectors import QueueDataAccumulator
+from stytra.tracking.online_bouts import BOUT_STARTED
 from stytra.utilities import reduce_to_pi
 from collections import namedtuple
 
@@ -11,15 +14,303 @@ class Estimator:
     An estimator is an object that estimate quantities required for the
     control of the stimulus (animal position/speed etc.) from the output
     stream of the tracking pipelines (position in pixels, tail angles, etc.).
+
+    The index and acquisition time (in seconds from the experiment start) of
+    the camera frame the last estimate is based on are kept in frame_index
+    and frame_time, to trace the latency of the closed loop.
+
+    If the tracking pipeline detects bouts, the bout events are available
+    in bout_log.
+
+    If the experiment computes the estimates in the tracking process (see
+    :class:`EstimationStage`), the latest ones are read from
+    shared_estimate instead of the tracking accumulator.
+
+    If the pipeline tracks several fish, i_fish is the one whose behavior
+    is estimated. The experiment passes the same estimator_params to the
+    EstimationStage, so that both follow the same fish.
     """
 
-    def __init__(self, acc_tracking: QueueDataAccumulator, experiment):
+    def __init__(self, acc_tracking: QueueDataAccumulator, experiment, i_fish=0):
         self.exp = experiment
+        self.i_fish = i_fish
         self.log = experiment.estimator_log
         self.acc_tracking = acc_tracking
+        self.bout_log = getattr(experiment, "bout_log", None)
+        self.latency_tracer = getattr(experiment, "latency_tracer", None)
+        self.shared_estimate = getattr(experiment, "shared_estimate", None)
+        self.frame_index = None
+        self.frame_time = None
 
     def reset(self):
         self.log.reset()
+        self.frame_index = None
+        self.frame_time = None
+
+    def set_frame(self, i_sample=-1):
+        """ Sets the frame the current estimate is based on
+
+        Parameters
+        ----------
+        i_sample : int
+            index of the last sample used in the tracking accumulator
+
+        """
+        self.record_frame(
+            self.acc_tracking.times[i_sample], self.acc_tracking.frame_indices[i_sample]
+        )
+
+    def record_frame(self, frame_time, frame_index):
+        """ Sets the time and index (-1 if unknown) of the frame the current
+        estimate is based on
+        """
+        self.frame_time = frame_time
+        self.frame_index = int(frame_index) if frame_index >= 0 else None
+        if self.latency_tracer is not None:
+            self.latency_tracer.record("estimator", self.frame_time)
+
+    def read_shared_estimate(self):
+        """ Reads the latest estimate of the tracking process and sets the
+        frame it is based on
+
+        Returns
+        -------
+        :class:`Estimate`, or None if no frame has been tracked yet
+
+        """
+        estimate = self.shared_estimate.read()
+        if estimate is not None:
+            self.record_frame(
+                estimate.t - self.exp.t0.timestamp(), estimate.frame_index
+            )
+        return estimate
+
+
+class SlidingStd:
+    """ Running mean and standard deviation of the values in a sliding
+    window, updated in constant time when a value enters or leaves the
+    window (Welford's algorithm with removal). NaN values are ignored.
+    To avoid the accumulation of rounding errors, the sums are recomputed
+    from the values in the window every recompute_every removals.
+    """
+
+    def __init__(self, recompute_every=100000):
+        self.recompute_every = recompute_every
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.n_removed = 0
+
+    def add(self, x):
+        if x != x:
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x):
+        if x != x:
+            return
+        self.n -= 1
+        self.n_removed += 1
+        if self.n == 0:
+            self.mean = 0.0
+            self.m2 = 0.0
+            return
+        delta = x - self.mean
+        self.mean -= delta / self.n
+        self.m2 -= delta * (x - self.mean)
+
+    def recompute(self, values):
+        """ Sets the sums from all the values in the window """
+        values = values[np.isfinite(values)]
+        self.n = len(values)
+        self.mean = float(np.mean(values)) if self.n > 0 else 0.0
+        self.m2 = float(np.sum((values - self.mean) ** 2))
+        self.n_removed = 0
+
+    @property
+    def std(self):
+        if self.n == 0:
+            return np.nan
+        return np.sqrt(max(self.m2, 0.0) / self.n)
+
+
+Estimate = namedtuple(
+    "Estimate",
+    ["t", "frame_index", "vigor", "x", "y", "theta", "vx", "vy", "vtheta", "n_bouts"],
+)
+
+
+class SharedEstimate:
+    """ The latest estimate computed in the tracking process, in a block
+    of shared memory protected by a sequence lock: the writer increments the
+    sequence number before and after writing, and a reader retries if the
+    number is odd or changed while it was reading, so that neither of them
+    ever waits for a lock.
+
+    The estimate (see :class:`Estimate`) contains the time of the frame (as
+    a timestamp) and its index, the vigor, the camera position of the fish
+    and its velocity (per frame) if the tracking estimates it, and the number
+    of bouts started.
+
+    Parameters
+    ----------
+    max_retries : int
+        maximal number of attempts of a read, so that the reader does not
+        hang if the writer dies in the middle of a write
+
+    """
+
+    def __init__(self, max_retries=500):
+        self.values = RawArray("d", len(Estimate._fields))
+        self.sequence = RawValue("q", 0)
+        self.max_retries = max_retries
+        self._last_read = None
+
+    def write(self, estimate):
+        self.sequence.value += 1
+        self.values[:] = estimate
+        self.sequence.value += 1
+
+    def read(self):
+        """ Returns the latest :class:`Estimate`, or None if nothing was
+        written yet. If no consistent estimate can be read in max_retries
+        attempts (e.g. if the writing process died while writing), the last
+        one read successfully is returned instead
+        """
+        for _ in range(self.max_retries):
+            sequence = self.sequence.value
+            if sequence == 0:
+                return None
+            if sequence % 2 == 1:
+                continue
+            values = self.values[:]
+            if self.sequence.value == sequence:
+                self._last_read = Estimate(*values)
+                return self._last_read
+        return self._last_read
+
+
+class EstimationStage:
+    """ Computes the estimates from the tracking output of each frame as
+    the last stage of the tracking process, and publishes them in a
+    :class:`SharedEstimate`, so that the closed-loop stimuli get them
+    without waiting for the outputs to reach the accumulator of the GUI
+    process.
+
+    The vigor is computed as in :class:`VigorMotionEstimator` (without lag)
+    if the pipeline outputs the tail_sum, the position is the one of fish
+    i_fish in camera coordinates (the calibration is applied when it is
+    read) if the pipeline tracks fish. The bouts of fish i_fish are counted
+    when the vigor crosses bout_threshold, or from the bout events if
+    use_bout_events is set and the pipeline detects them, as in
+    :class:`BoutsEstimator`.
+
+    Parameters
+    ----------
+    shared_estimate : SharedEstimate
+    vigor_window : float
+        duration of the vigor window in seconds
+    bout_threshold : float
+        vigor threshold for the bouts
+    min_interbout : float
+        minimal time between bouts detected from the vigor, in seconds
+    i_fish : int
+        fish whose position and bouts are estimated
+    use_bout_events : bool
+        if True, the bouts are the ones detected by the event nodes of the
+        pipeline
+    kwargs :
+        the other estimator parameters, which are applied in the GUI process
+
+    """
+
+    def __init__(
+        self,
+        shared_estimate,
+        vigor_window=0.05,
+        bout_threshold=0.05,
+        min_interbout=0.1,
+        i_fish=0,
+        use_bout_events=False,
+        **kwargs
+    ):
+        self.shared_estimate = shared_estimate
+        self.use_bout_events = use_bout_events
+        self.vigor_window = vigor_window
+        self.bout_threshold = bout_threshold
+        self.min_interbout = min_interbout
+        self.i_fish = i_fish
+        self.position_fields = tuple(
+            "f{:d}_{}".format(i_fish, var)
+            for var in ("x", "y", "theta", "vx", "vy", "vtheta")
+        )
+
+        self._samples = deque()
+        self._sliding = SlidingStd()
+        self._n_bouts = 0
+        self._last_bout_t = None
+
+    def update(self, time, frame_index, output, events=None):
+        """ Computes and publishes the estimate for a frame
+
+        Parameters
+        ----------
+        time : datetime
+            time of the frame
+        frame_index : int
+            index of the frame
+        output : namedtuple
+            tracking output of the frame
+        events : list
+            the events detected in the frame, None if the pipeline does not
+            detect events
+
+        """
+        t = time.timestamp()
+
+        tail_sum = getattr(output, "tail_sum", None)
+        if tail_sum is not None:
+            self._samples.append((t, tail_sum))
+            self._sliding.add(tail_sum)
+            # the samples in the window, at least two
+            while (
+                len(self._samples) > 2
+                and self._samples[0][0] < t - self.vigor_window
+            ):
+                self._sliding.remove(self._samples.popleft()[1])
+            if self._sliding.n_removed >= self._sliding.recompute_every:
+                self._sliding.recompute(np.array([x for _, x in self._samples]))
+            vigor = self._sliding.std
+        else:
+            vigor = np.nan
+
+        position = tuple(
+            getattr(output, field, np.nan) for field in self.position_fields
+        )
+
+        if self.use_bout_events and events is not None:
+            self._n_bouts += sum(
+                event.event == BOUT_STARTED and event.i_fish == self.i_fish
+                for event in events
+            )
+        elif vigor > self.bout_threshold and (
+            self._last_bout_t is None or t - self._last_bout_t > self.min_interbout
+        ):
+            self._n_bouts += 1
+            self._last_bout_t = t
+
+        self.shared_estimate.write(
+            (
+                t,
+                -1 if frame_index is None else frame_index,
+                vigor,
+                *position,
+                self._n_bouts,
+            )
+        )
 
 
 class VigorMotionEstimator(Estimator):
@@ -27,14 +318,119 @@ class VigorMotionEstimator(Estimator):
     A very common way of estimating velocity of an embedded animal is
     vigor, computed as the standard deviation of the tail cumulative angle in a
     specified time window - generally 50 ms.
+
+    The tail angles are read from the tracking accumulator as they arrive,
+    and the standard deviation is kept updated for the windows ending at
+    the last sample and at the lags requested recently (at most max_lags),
+    so that each estimate takes constant time. The samples still needed by
+    the windows are kept in a small buffer.
+
+    If the vigor is computed in the tracking process, the estimates without
+    lag are read from there.
     """
 
-    def __init__(self, *args, vigor_window=0.050, base_gain=-12, **kwargs):
+    def __init__(
+        self, *args, vigor_window=0.050, base_gain=-12, max_lags=4, **kwargs
+    ):
         super().__init__(*args, **kwargs)
         self.vigor_window = vigor_window
-        self.last_dt = 1 / 500.0
         self.base_gain = base_gain
+        self.max_lags = max_lags
         self._output_type = namedtuple("s", "vigor")
+        self._reset_windows()
+
+    def reset(self):
+        super().reset()
+        self._reset_windows()
+
+    def _reset_windows(self):
+        self._n_seen = self.acc_tracking.n_received
+        # time, tail angle and frame index of the buffered samples, which
+        # have the absolute indices from _i_first to _i_next (excluded),
+        # the first column of the buffer having the index _i_buffer
+        self._samples = np.empty((3, 1024))
+        self._i_buffer = 0
+        self._i_first = 0
+        self._i_next = 0
+        # for each lag, the window from i_start to i_end (excluded)
+        self._windows = OrderedDict()
+
+    def _store_samples(self, rows, frame_indices, i_first):
+        """ Writes the samples with the absolute indices from i_first on,
+        moving the buffered ones still needed to a new buffer if required
+        """
+        n_kept = i_first - self._i_first
+        if (
+            i_first < self._i_buffer
+            or i_first + len(rows) - self._i_buffer > self._samples.shape[1]
+        ):
+            samples = np.empty(
+                (3, max(self._samples.shape[1], 2 * (n_kept + len(rows))))
+            )
+            samples[:, :n_kept] = self._samples[
+                :, self._i_first - self._i_buffer : i_first - self._i_buffer
+            ]
+            self._samples = samples
+            self._i_buffer = self._i_first
+
+        new = slice(i_first - self._i_buffer, i_first - self._i_buffer + len(rows))
+        self._samples[0, new] = rows[:, 0]
+        self._samples[1, new] = rows[:, self.acc_tracking.header_dict["tail_sum"]]
+        self._samples[2, new] = frame_indices
+        self._i_next = i_first + len(rows)
+
+    def _read_samples(self):
+        """ Adds the samples which arrived in the accumulator to the buffer,
+        dropping the ones not needed by any window
+        """
+        acc = self.acc_tracking
+        n_new = min(acc.n_received - self._n_seen, acc.n_stored)
+        self._n_seen = acc.n_received
+        if n_new <= 0:
+            return
+
+        # the first sample needed by a window, at least two before its end
+        i_needed = min(
+            [self._i_next]
+            + [min(window[0], window[1] - 2) for window in self._windows.values()]
+        )
+        self._i_first = max(self._i_first, i_needed)
+        self._store_samples(
+            acc.get_last_n(n_new), acc.frame_indices[-n_new:], self._i_next
+        )
+
+    def _read_history(self):
+        """ Buffers all the past samples still in the accumulator, for a
+        window with a new lag
+        """
+        n_history = min(self.acc_tracking.n_stored, self._i_next)
+        if n_history <= self._i_next - self._i_first:
+            return
+        self._i_first = self._i_next - n_history
+        self._store_samples(
+            self.acc_tracking.get_last_n(n_history),
+            self.acc_tracking.frame_indices[-n_history:],
+            self._i_first,
+        )
+
+    def _update_window(self, lag):
+        window = self._windows[lag]
+        i_start, i_end, sliding = window
+        samples = self._samples
+        i_buffer = self._i_buffer
+        t_end = samples[0, self._i_next - 1 - i_buffer] - lag
+        t_start = t_end - self.vigor_window
+
+        while i_end < self._i_next and samples[0, i_end - i_buffer] <= t_end:
+            sliding.add(samples[1, i_end - i_buffer])
+            i_end += 1
+        while i_start < i_end and samples[0, i_start - i_buffer] < t_start:
+            sliding.remove(samples[1, i_start - i_buffer])
+            i_start += 1
+        if sliding.n_removed >= sliding.recompute_every:
+            sliding.recompute(samples[1, i_start - i_buffer : i_end - i_buffer])
+
+        window[0], window[1] = i_start, i_end
 
     def get_velocity(self, lag=0):
         """
@@ -48,37 +444,100 @@ class VigorMotionEstimator(Estimator):
         -------
 
         """
-        vigor_n_samples = max(int(round(self.vigor_window / self.last_dt)), 2)
-        n_samples_lag = max(int(round(lag / self.last_dt)), 0)
-        if not self.acc_tracking.stored_data:
+        if self.shared_estimate is not None and lag == 0:
+            estimate = self.read_shared_estimate()
+            if estimate is None:
+                return 0
+            vigor = 0 if np.isnan(estimate.vigor) else estimate.vigor
+            self._log_vigor(self.frame_time, vigor)
+            return vigor * self.base_gain
+
+        self._read_samples()
+        if self._i_next == 0:
+            return 0
+
+        if lag in self._windows:
+            self._windows.move_to_end(lag)
+        else:
+            if len(self._windows) >= self.max_lags:
+                self._windows.popitem(last=False)
+            self._read_history()
+            self._windows[lag] = [self._i_first, self._i_first, SlidingStd()]
+
+        # the windows of all the recent lags are moved forward, so that
+        # the samples before them can be dropped from the buffer
+        for window_lag in self._windows:
+            self._update_window(window_lag)
+
+        # the samples in the vigor window ending lag seconds before the last
+        # one, at least two
+        i_start, i_end, sliding = self._windows[lag]
+        if i_end == self._i_first:
             return 0
-        past_tail_motion = self.acc_tracking.get_last_n(
-            vigor_n_samples + n_samples_lag
-        )[0:vigor_n_samples]
-        end_t = past_tail_motion.t.iloc[-1]
-        start_t = past_tail_motion.t.iloc[0]
-        new_dt = (end_t - start_t) / vigor_n_samples
-        if new_dt > 0:
-            self.last_dt = new_dt
-        vigor = np.nanstd(np.array(past_tail_motion.tail_sum))
+        i_buffer = self._i_buffer
+        if i_end - i_start >= 2:
+            vigor = sliding.std
+        else:
+            vigor = np.nanstd(
+                self._samples[
+                    1, max(i_end - 2, self._i_first) - i_buffer : i_end - i_buffer
+                ]
+            )
+        end_t, _, frame_index = self._samples[:, i_end - 1 - i_buffer]
+        self.record_frame(end_t, frame_index)
         if np.isnan(vigor):
             vigor = 0
 
-        if len(self.log.times) == 0 or self.log.times[-1] < end_t:
-            self.log.update_list(end_t, self._output_type(vigor))
+        self._log_vigor(end_t, vigor)
         return vigor * self.base_gain
 
+    def _log_vigor(self, end_t, vigor):
+        if len(self.log.times) == 0 or self.log.times[-1] < end_t:
+            self.log.update_list(end_t, self._output_type(vigor), self.frame_index)
+
 
 class BoutsEstimator(VigorMotionEstimator):
+    """ Tells whether a bout started. A bout is detected when the vigor
+    crosses the bout_threshold, at least min_interbout seconds after the
+    previous one. If use_bout_events is True and the tracking pipeline
+    detects bouts, the bout starts of fish i_fish are taken from the bout
+    events instead, and bout_threshold and min_interbout are not used.
+    """
+
     def __init__(self, *args, bout_threshold = 0.05, vigor_window=0.05,
-                 min_interbout=0.1, **kwargs):
+                 min_interbout=0.1, use_bout_events=False, **kwargs):
         super().__init__(*args, base_gain=1, **kwargs)
+        self.use_bout_events = use_bout_events
         self.bout_threshold = bout_threshold
         self.vigor_window = vigor_window
         self.min_interbout = min_interbout
         self.last_bout_t = None
+        self.n_events_seen = 0
+        self.n_bouts_seen = self._n_shared_bouts()
+
+    def _n_shared_bouts(self):
+        if self.shared_estimate is None:
+            return 0
+        estimate = self.shared_estimate.read()
+        return 0 if estimate is None else int(estimate.n_bouts)
+
+    def reset(self):
+        super().reset()
+        self.n_bouts_seen = self._n_shared_bouts()
 
     def bout_occured(self):
+        if self.shared_estimate is not None:
+            n_bouts = self._n_shared_bouts()
+            occured = n_bouts > self.n_bouts_seen
+            self.n_bouts_seen = n_bouts
+            return occured
+        if self.use_bout_events and self.bout_log is not None:
+            events = self.bout_log.received_since(self.n_events_seen)
+            self.n_events_seen = self.bout_log.n_received
+            return any(
+                event.event == BOUT_STARTED and event.i_fish == self.i_fish
+                for event in events
+            )
         if self.get_velocity() > self.base_gain*self.bout_threshold:
             if self.last_bout_t is None or (datetime.datetime.now() - self.last_bout_t).total_seconds() > \
                         self.min_interbout:
@@ -93,15 +552,36 @@ def rot_mat(theta):
 
 
 class PositionEstimator(Estimator):
-    def __init__(self, *args, change_thresholds=None, velocity_window=10, **kwargs):
+    def __init__(
+        self,
+        *args,
+        change_thresholds=None,
+        velocity_window=10,
+        predict=False,
+        display_latency=0.016,
+        **kwargs
+    ):
         """ Uses the projector-to-camera calibration to give fish position in
         scree coordinates. If change_thresholds are set, update only the fish
         position after there is a big enough change (which prevents small
         oscillations due to tracking)
 
+        If predict is True, the pose is extrapolated with the velocities
+        estimated by the tracking (vx, vy and vtheta of fish i_fish, in camera
+        units per frame) to the time at which the stimulus is expected to
+        be displayed: the age of the tracked frame plus the delay from the
+        estimator to the display, measured by the latency tracer if the
+        experiment traces the latency, otherwise display_latency.
+        Both the raw and the predicted pose are logged.
+
         :param args:
         :param calibrator:
         :param change_thresholds: a 3-tuple of thresholds, in px and radians
+        :param velocity_window: number of samples over which the velocity and
+                                the frame period are estimated
+        :param predict: if True, extrapolates the pose to the display time
+        :param display_latency: delay from the estimator to the display in
+                                seconds, if it is not measured
         :param kwargs:
         """
         super().__init__(*args, **kwargs)
@@ -114,63 +594,172 @@ class PositionEstimator(Estimator):
         if change_thresholds is not None:
             self.change_thresholds = np.array(change_thresholds)
 
+        self.predict = predict
+        self.display_latency = display_latency
+
+        self._projection_source = None
+        self._projection = None
+
         self._output_type = namedtuple("f", ["x", "y", "theta"])
+        if predict:
+            self._log_type = namedtuple(
+                "f", ["x", "y", "theta", "raw_x", "raw_y", "raw_theta"]
+            )
+        else:
+            self._log_type = self._output_type
+
+    def _tracked_columns(self, *variables):
+        return ["f{:d}_{}".format(self.i_fish, var) for var in variables]
 
     def get_camera_position(self):
-        past_coords = {
-            name: value
-            for name, value in zip(
-                self.acc_tracking.columns, self.acc_tracking.get_last_n(1)[0, :]
-            )
-        }
-        return past_coords["f0_x"], past_coords["f0_y"], past_coords["f0_theta"]
+        header_dict = self.acc_tracking.header_dict
+        columns = [
+            header_dict[c] for c in self._tracked_columns("x", "y", "theta")
+        ]
+        return tuple(self.acc_tracking.get_last_n(1)[0, columns])
 
     def get_velocity(self):
+        header_dict = self.acc_tracking.header_dict
+        columns = [header_dict[c] for c in self._tracked_columns("x", "y")]
         vel = np.diff(
-            self.acc_tracking.get_last_n(self.velocity_window)[["f0_x", "f0_y"]].values,
-            0,
+            self.acc_tracking.get_last_n(self.velocity_window)[:, columns], 0
         )
         return np.sqrt(np.sum(vel ** 2))
 
     def get_istantaneous_velocity(self):
-        vel_xy = self.acc_tracking.get_last_n(self.velocity_window)[
-            ["f0_vx", "f0_vy"]
-        ].values
+        header_dict = self.acc_tracking.header_dict
+        columns = [header_dict[c] for c in self._tracked_columns("vx", "vy")]
+        vel_xy = self.acc_tracking.get_last_n(self.velocity_window)[:, columns]
         return np.sqrt(np.sum(vel_xy ** 2))
 
     def reset(self):
         super().reset()
         self.past_values = None
 
-    def get_position(self):
-        if len(self.acc_tracking.stored_data) == 0 or not np.isfinite(
-            self.acc_tracking.stored_data[-1].f0_x
-        ):
-            o = self._output_type(np.nan, np.nan, np.nan)
-            return o
+    @property
+    def projection(self):
+        """ The camera-to-projector matrix as a 2x3 array, converted again
+        only when the calibration changes, None if there is no calibration
+        """
+        cam_to_proj = self.calibrator.cam_to_proj
+        if cam_to_proj is not self._projection_source:
+            self._projection_source = cam_to_proj
+            if cam_to_proj is None:
+                self._projection = None
+            else:
+                self._projection = np.array(cam_to_proj, dtype=np.float64)
+                if self._projection.shape != (2, 3):
+                    self._projection = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+        return self._projection
+
+    def display_delay(self):
+        """ The delay from the estimator to the display of the stimulus, as
+        measured by the latency tracer if available, in seconds
+        """
+        if self.latency_tracer is not None:
+            display = self.latency_tracer.percentiles("display", (50,))
+            estimator = self.latency_tracer.percentiles("estimator", (50,))
+            if display is not None and estimator is not None:
+                return max(display[0] - estimator[0], 0.0)
+        return self.display_latency
+
+    def frame_period(self):
+        """ The median interval between the last tracked frames in seconds,
+        None if not enough frames were tracked
+        """
+        last = self.acc_tracking.get_last_n(self.velocity_window)
+        if last is None or len(last) < 2:
+            return None
+        return np.median(np.diff(last[:, 0]))
 
-        past_coords = self.acc_tracking.stored_data[-1]
-        t = self.acc_tracking.times[-1]
+    def predict_pose(self, pose, velocity):
+        """ Extrapolates a camera pose to the expected display time
 
-        if not self.calibrator.cam_to_proj is None:
-            projmat = np.array(self.calibrator.cam_to_proj)
-            if projmat.shape != (2, 3):
-                projmat = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+        Parameters
+        ----------
+        pose : np.ndarray
+            x, y and theta of the fish in the tracked frame
+        velocity : np.ndarray
+            their change per frame
 
-            x, y = projmat @ np.array([past_coords.f0_x, past_coords.f0_y, 1.0])
+        Returns
+        -------
+        the predicted pose, the tracked one if it cannot be predicted
 
-            theta = np.arctan2(
-                *(
-                    projmat[:, :2]
-                    @ np.array(
-                        [np.cos(past_coords.f0_theta), np.sin(past_coords.f0_theta)]
-                    )[::-1]
-                )
-            )
+        """
+        period = self.frame_period()
+        if period is None or not period > 0 or not np.all(np.isfinite(velocity)):
+            return pose
+        t_now = (datetime.datetime.now() - self.exp.t0).total_seconds()
+        horizon = t_now - self.frame_time + self.display_delay()
+        return pose + velocity * (horizon / period)
+
+    def project(self, poses):
+        """ Maps camera poses to the display
+
+        Parameters
+        ----------
+        poses : np.ndarray
+            (n, 3) array of x, y and theta in camera coordinates
+
+        Returns
+        -------
+        (n, 3) array of x, y and theta in projector coordinates
+
+        """
+        projmat = self.projection
+        if projmat is None:
+            return np.array(poses, dtype=np.float64)
+        projected = np.empty((len(poses), 3))
+        projected[:, :2] = poses[:, :2] @ projmat[:, :2].T + projmat[:, 2]
+        directions = (
+            np.stack([np.sin(poses[:, 2]), np.cos(poses[:, 2])], 1) @ projmat[:, :2].T
+        )
+        projected[:, 2] = np.arctan2(directions[:, 0], directions[:, 1])
+        return projected
+
+    def to_display(self, pose):
+        """ Maps a camera pose to the display, as (y, x, theta) """
+        x, y, theta = self.project(np.asarray(pose, dtype=np.float64)[None, :])[0]
+        return np.array((y, x, theta))
+
+    def get_position(self):
+        if self.shared_estimate is not None:
+            estimate = self.read_shared_estimate()
+            if estimate is None or not np.isfinite(estimate.x):
+                return self._output_type(np.nan, np.nan, np.nan)
+            pose = np.array((estimate.x, estimate.y, estimate.theta))
+            velocity = np.array((estimate.vx, estimate.vy, estimate.vtheta))
+            t = self.frame_time
         else:
-            x, y, theta = past_coords.f0_x, past_coords.f0_y, past_coords.f0_theta
+            x_column, = self._tracked_columns("x")
+            if self.acc_tracking.is_empty() or not np.isfinite(
+                self.acc_tracking[x_column][-1]
+            ):
+                o = self._output_type(np.nan, np.nan, np.nan)
+                return o
+
+            pose = np.array(
+                [
+                    self.acc_tracking[c][-1]
+                    for c in self._tracked_columns("x", "y", "theta")
+                ]
+            )
+            if self.predict:
+                velocity = np.array(
+                    [
+                        self.acc_tracking[c][-1]
+                        for c in self._tracked_columns("vx", "vy", "vtheta")
+                    ]
+                )
+            t = self.acc_tracking.times[-1]
+            self.set_frame(-1)
 
-        c_values = np.array((y, x, theta))
+        raw_values = self.to_display(pose)
+        if self.predict:
+            c_values = self.to_display(self.predict_pose(pose, velocity))
+        else:
+            c_values = raw_values
 
         if self.change_thresholds is not None:
 
@@ -183,12 +772,131 @@ class PositionEstimator(Estimator):
                 self.past_values[sel] = c_values[sel]
                 c_values = self.past_values
 
-        logout = self._output_type(*c_values)
-        self.log.update_list(t, logout)
+        if self.predict:
+            logout = self._log_type(*c_values, *raw_values)
+        else:
+            logout = self._log_type(*c_values)
+        self.log.update_list(t, logout, self.frame_index)
 
         return c_values
 
 
+class MultiFishPositionEstimator(PositionEstimator):
+    """ Gives the poses of all the fish tracked in the arena at once, as an
+    (n_fish, 3) array of x, y and theta in projector coordinates, mapped
+    with a single vectorized transform, together with a mask of the fish
+    which are currently tracked. The columns of the fish in the tracking
+    accumulator are looked up only when its fields change.
+
+    The poses are predicted and filtered with change_thresholds (for each
+    fish) as in :class:`PositionEstimator`, and logged as f{i}_x, f{i}_y
+    and f{i}_theta columns. The estimates shared by the tracking process
+    concern a single fish, so the poses are always read from the tracking
+    accumulator. get_position returns the pose of fish i_fish, so the
+    stimuli made for a single fish can be used as well.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shared_estimate = None
+        self.n_fish = 0
+        self._columns_source = None
+        self._pose_columns = None
+        self._velocity_columns = None
+
+    def _fish_columns(self):
+        """ Finds the columns of the pose (and velocity) of each fish, if the
+        fields of the tracking accumulator changed
+        """
+        header_dict = self.acc_tracking.header_dict
+        if header_dict is self._columns_source:
+            return
+        self._columns_source = header_dict
+        n_fish = 0
+        while "f{:d}_x".format(n_fish) in header_dict:
+            n_fish += 1
+
+        def columns(variables):
+            names = [
+                "f{:d}_{}".format(i_fish, var)
+                for i_fish in range(n_fish)
+                for var in variables
+            ]
+            if n_fish == 0 or not all(name in header_dict for name in names):
+                return None
+            return np.array([header_dict[name] for name in names]).reshape(n_fish, 3)
+
+        self._pose_columns = columns(("x", "y", "theta"))
+        self._velocity_columns = columns(("vx", "vy", "vtheta"))
+        if n_fish != self.n_fish:
+            self.n_fish = n_fish
+            self.past_values = None
+            fields = [
+                prefix + "f{:d}_{}".format(i_fish, var)
+                for prefix in (("", "raw_") if self.predict else ("",))
+                for i_fish in range(n_fish)
+                for var in ("x", "y", "theta")
+            ]
+            self._log_type = namedtuple("f", fields)
+
+    def get_positions(self):
+        """ Returns the poses of the fish in the last tracked frame
+
+        Returns
+        -------
+        positions : np.ndarray
+            (n_fish, 3) array of the x, y and theta of each fish in
+            projector coordinates, NaN for the fish which are not tracked
+        valid : np.ndarray
+            boolean mask of the fish which are tracked
+
+        """
+        if self.acc_tracking.is_empty():
+            return np.full((self.n_fish, 3), np.nan), np.zeros(self.n_fish, bool)
+        self._fish_columns()
+        if self._pose_columns is None:
+            return np.full((0, 3), np.nan), np.zeros(0, bool)
+
+        last = self.acc_tracking.get_last_n(1)[0]
+        poses = last[self._pose_columns]
+        valid = np.isfinite(poses[:, 0]) & np.isfinite(poses[:, 1])
+        self.set_frame(-1)
+
+        raw_positions = self.project(poses)
+        if self.predict and self._velocity_columns is not None:
+            positions = self.project(
+                self.predict_pose(poses, last[self._velocity_columns])
+            )
+        else:
+            positions = raw_positions
+
+        if self.change_thresholds is not None:
+            if self.past_values is None:
+                self.past_values = positions.copy()
+            else:
+                deltas = positions - self.past_values
+                deltas[:, 2] = reduce_to_pi(deltas[:, 2])
+                # the fish which appear are placed directly
+                sel = ~(np.abs(deltas) <= self.change_thresholds)
+                self.past_values[sel] = positions[sel]
+                positions = self.past_values.copy()
+
+        if self.predict:
+            logout = self._log_type(*positions.ravel(), *raw_positions.ravel())
+        else:
+            logout = self._log_type(*positions.ravel())
+        self.log.update_list(self.frame_time, logout, self.frame_index)
+
+        return positions, valid
+
+    def get_position(self):
+        positions, valid = self.get_positions()
+        if len(valid) <= self.i_fish or not valid[self.i_fish]:
+            return self._output_type(np.nan, np.nan, np.nan)
+        x, y, theta = positions[self.i_fish]
+        return np.array((y, x, theta))
+
+
 class SimulatedPositionEstimator(Estimator):
     def __init__(self, *args, motion, **kwargs):
         """ Uses the projector-to-camera calibration to give fish position in
@@ -215,4 +923,5 @@ class SimulatedPositionEstimator(Estimator):
 
 
 estimator_dict = dict(position=PositionEstimator, vigor=VigorMotionEstimator,
-                      bouts=BoutsEstimator)
+                      bouts=BoutsEstimator,
+                      multi_position=MultiFishPositionEstimator)
@@ -1,5 +1,6 @@
 import numpy as np
-from PyQt5.QtGui import QTransform
+from PyQt5.QtCore import QPointF, Qt
+from PyQt5.QtGui import QTransform, QPainter, QBrush, QColor, QPen
 
 try:
     from random import choices
@@ -12,6 +13,7 @@ from stytra.stimulation.stimuli import (
     PositionStimulus,
     InterpolatedStimulus,
     Stimulus,
+    VisualStimulus,
 )
 
 
@@ -369,3 +371,54 @@ class FishRelativeStimulus(BackgroundStimulus):
         return super().get_transform(w, h, x, y) * (
             QTransform().translate(x_fish, y_fish).rotate(rot_fish)
         )
+
+
+class MultiFishOverlayStimulus(VisualStimulus, DynamicStimulus):
+    """ Draws a marker on each of the fish tracked in the arena, with the
+    poses given by a :class:`MultiFishPositionEstimator
+    <stytra.stimulation.estimators.MultiFishPositionEstimator>`.
+
+    Parameters
+    ----------
+    colors : list of tuple(int, int, int)
+        RGB colors of the fish markers, used in turn for the fish
+    radius : float
+        radius of the marker in projector pixels
+    heading_length : float
+        length of the heading line in projector pixels
+
+    """
+
+    def __init__(
+        self,
+        *args,
+        colors=((255, 50, 0), (0, 200, 255)),
+        radius=3,
+        heading_length=20,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.colors = colors
+        self.radius = radius
+        self.heading_length = heading_length
+        self.name = "multi_fish_overlay"
+        self._positions = np.full((0, 3), np.nan)
+        self._valid = np.zeros(0, bool)
+
+    def update(self):
+        self._positions, self._valid = self._experiment.estimator.get_positions()
+        super().update()
+
+    def paint(self, p, w, h):
+        p.setRenderHint(QPainter.Antialiasing)
+        ends = self._positions[:, :2] + self.heading_length * np.stack(
+            [np.cos(self._positions[:, 2]), np.sin(self._positions[:, 2])], 1
+        )
+        for i_fish in np.flatnonzero(self._valid):
+            color = QColor(*self.colors[i_fish % len(self.colors)])
+            x, y = self._positions[i_fish, :2]
+            p.setPen(Qt.NoPen)
+            p.setBrush(QBrush(color))
+            p.drawEllipse(QPointF(x, y), self.radius, self.radius)
+            p.setPen(QPen(color))
+            p.drawLine(QPointF(x, y), QPointF(*ends[i_fish]))
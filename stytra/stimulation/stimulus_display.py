@@ -226,6 +226,16 @@ class StimDisplayWidget:
 
         p.end()
 
+        self.trace_latency()
+
+    def trace_latency(self):
+        """ Logs which camera frame the painted stimulus is based on, if
+        the experiment traces the closed-loop latency """
+        if self.protocol_runner is not None and self.protocol_runner.running:
+            tracer = getattr(self.protocol_runner.experiment, "latency_tracer", None)
+            if tracer is not None:
+                tracer.record_display()
+
     def display_stimulus(self):
         """Function called by the protocol_runner timestep timer that update
         the displayed image and, if required, grab a picture of the current
@@ -354,3 +364,6 @@ class StimDisplayWidgetConditional(StimDisplayWidget):
                     self.calibrator.paint_calibration_pattern(p, h, w)
 
         p.end()
+
+        if self.display_state:
+            self.trace_latency()
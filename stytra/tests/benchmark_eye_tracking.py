@@ -0,0 +1,64 @@
+"""Compares the eye tracking with contour fitting and with image moments on
+the frames of the example video: the time per frame and the differences
+between the ellipses.
+
+Run with python -m stytra.tests.benchmark_eye_tracking
+"""
+
+from pathlib import Path
+from time import perf_counter
+
+import flammkuchen as fl
+import numpy as np
+
+import stytra
+from stytra.tracking.eyes import EyeTrackingMethod, EyeMomentsTrackingMethod
+
+
+def track_eyes(method, video):
+    """ Tracks the eyes in all the frames of the video
+
+    Returns
+    -------
+    the time per frame in seconds, and an array (n_frames, 10) of
+    the ellipses of the eyes
+
+    """
+    node = method()
+    node.setup()
+    params = node._params.params.values
+    node._process(video[0], **params)  # compilation
+    t_start = perf_counter()
+    ellipses = np.array([node._process(frame, **params).data for frame in video])
+    return (perf_counter() - t_start) / len(video), ellipses
+
+
+def benchmark_eye_tracking():
+    video = fl.load(
+        str(Path(stytra.__file__).parent / "examples" / "assets" / "fish_compressed.h5")
+    )["video"]
+    t_contours, contours = track_eyes(EyeTrackingMethod, video)
+    t_moments, moments = track_eyes(EyeMomentsTrackingMethod, video)
+    differences = np.abs(contours - moments)
+    return dict(
+        t_contours=t_contours,
+        t_moments=t_moments,
+        position=np.nanmax(differences[:, [0, 1, 5, 6]]),
+        dimensions=np.nanmax(differences[:, [2, 3, 7, 8]]),
+        angle=np.nanmax(np.abs(np.mod(differences[:, [4, 9]] + 90, 180) - 90)),
+    )
+
+
+if __name__ == "__main__":
+    results = benchmark_eye_tracking()
+    print(
+        "contours: {:.1f} us per frame, moments: {:.1f} us per frame".format(
+            results["t_contours"] * 1e6, results["t_moments"] * 1e6
+        )
+    )
+    print(
+        "maximal differences: {position:.2f} px in position, "
+        "{dimensions:.2f} px in dimensions, {angle:.2f} degrees in angle".format(
+            **results
+        )
+    )
@@ -0,0 +1,93 @@
+"""Tracks simulated free-swimming fish with the Kalman filters of
+the fish tracking, and measures the time per frame and the number of
+identity switches for different numbers of fish.
+
+Run with python -m stytra.tests.benchmark_fish_assignment
+"""
+
+from time import perf_counter
+
+import numpy as np
+
+from stytra.tracking.fish import Fishes
+
+
+def simulate_fish(n_fish, n_frames=500, arena_size=400.0, seed=0):
+    """ Simulates fish swimming in bouts in a square arena
+
+    Returns
+    -------
+    array (n_frames, n_fish, 3) of the x, y and theta of the fish
+
+    """
+    rng = np.random.RandomState(seed)
+    positions = rng.uniform(0, arena_size, (n_fish, 2))
+    thetas = rng.uniform(-np.pi, np.pi, n_fish)
+    speeds = np.zeros(n_fish)
+    coords = np.empty((n_frames, n_fish, 3))
+    for i_frame in range(n_frames):
+        # the fish turn at the start of the bouts, towards the center if
+        # they are close to the walls
+        starting = rng.uniform(size=n_fish) < 0.03
+        to_center = np.arctan2(*(arena_size / 2 - positions.T)[::-1])
+        near_wall = np.any(np.abs(positions - arena_size / 2) > arena_size * 0.4, 1)
+        turns = rng.normal(0, 0.4, n_fish)
+        turns[near_wall] = (
+            np.mod(to_center - thetas + np.pi, 2 * np.pi)[near_wall] - np.pi
+        ) / 2
+        thetas[starting] += turns[starting]
+        speeds[starting] = rng.uniform(3, 8, np.sum(starting))
+        speeds *= 0.85
+        positions += speeds[:, None] * np.stack([np.cos(thetas), np.sin(thetas)], 1)
+        positions = np.clip(positions, 0, arena_size)
+
+        coords[i_frame, :, :2] = positions
+        coords[i_frame, :, 2] = np.mod(thetas + np.pi, 2 * np.pi) - np.pi
+    return coords
+
+
+def track_fish(coords, n_segments=2, p_missed=0.02, seed=0):
+    """ Tracks the simulated fish from noisy detections, in random order
+    and some of which are missed
+
+    Returns
+    -------
+    the time per frame in seconds and the number of identity switches
+
+    """
+    rng = np.random.RandomState(seed)
+    n_frames, n_fish, _ = coords.shape
+    fishes = Fishes(n_fish, 1.0, np.pi / 10, n_segments, 0.1, 2)
+    identities = np.full(n_fish, -1)
+    n_switches = 0
+    total_time = 0.0
+    for i_frame in range(n_frames):
+        detected = rng.permutation(np.flatnonzero(rng.uniform(size=n_fish) > p_missed))
+        detections = np.zeros((len(detected), 3 + n_segments))
+        detections[:, :3] = coords[i_frame, detected] + rng.normal(
+            0, [0.5, 0.5, 0.05], (len(detected), 3)
+        )
+
+        t_start = perf_counter()
+        fishes.predict()
+        fish_indices, added = fishes.assign(detections)
+        total_time += perf_counter() - t_start
+
+        previous = identities[detected]
+        n_switches += np.sum((previous != -1) & (fish_indices != previous))
+        identities[detected] = fish_indices
+    return total_time / n_frames, n_switches
+
+
+def benchmark_fish_assignment(n_fish_list=(1, 5, 20, 50)):
+    track_fish(simulate_fish(2, 10))  # compilation
+    return {n_fish: track_fish(simulate_fish(n_fish)) for n_fish in n_fish_list}
+
+
+if __name__ == "__main__":
+    for n_fish, (t, n_switches) in benchmark_fish_assignment().items():
+        print(
+            "{:3d} fish: {:6.1f} us per frame, {:4d} identity switches".format(
+                n_fish, t * 1e6, n_switches
+            )
+        )
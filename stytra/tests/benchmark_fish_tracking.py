@@ -0,0 +1,67 @@
+"""Measures the time per frame of the free-swimming fish tracking for
+different numbers of fish, placing copies of the fish of the example video
+in a large arena.
+
+Run with python -m stytra.tests.benchmark_fish_tracking
+"""
+
+from pathlib import Path
+
+import flammkuchen as fl
+import numpy as np
+
+import stytra
+from stytra.experiments.fish_pipelines import FishTrackingPipeline
+
+
+def fish_arena(video, n_fish, spacing=(100, 220)):
+    """ Tiles copies of the example video in an arena, so that each frame
+    contains n_fish fish
+    """
+    n_columns = int(np.ceil(np.sqrt(n_fish)))
+    n_rows = int(np.ceil(n_fish / n_columns))
+    arena = np.full(
+        (len(video), n_rows * spacing[0] + 50, n_columns * spacing[1] + 50),
+        np.median(video[0]),
+        video.dtype,
+    )
+    for i_fish in range(n_fish):
+        top = 25 + (i_fish // n_columns) * spacing[0]
+        left = 25 + (i_fish % n_columns) * spacing[1]
+        arena[:, top : top + video.shape[1], left : left + video.shape[2]] = video
+    return arena
+
+
+def benchmark_fish_tracking(n_fish_list=(1, 10, 30), n_frames=100):
+    video = fl.load(
+        str(
+            Path(stytra.__file__).parent
+            / "examples"
+            / "assets"
+            / "fish_free_compressed.h5"
+        ),
+        "/video",
+    )[:n_frames]
+
+    times = dict()
+    for n_fish in n_fish_list:
+        pipeline = FishTrackingPipeline()
+        pipeline.setup()
+        pipeline.bgsub._params.params.values = dict(
+            pipeline.bgsub._params.params.values, learning_rate=0.0
+        )
+        pipeline.fishtrack._params.params.values = dict(
+            pipeline.fishtrack._params.params.values, n_fish_max=n_fish
+        )
+        pipeline.fishtrack.reset()
+        pipeline.compile()
+        pipeline.enable_profiling(n_frames)
+        for frame in fish_arena(video, n_fish):
+            pipeline.run(frame)
+        times[n_fish] = pipeline.profiler.summary()["fish_tracking"][0]
+    return times
+
+
+if __name__ == "__main__":
+    for n_fish, t in benchmark_fish_tracking().items():
+        print("{:3d} fish: {:8.1f} us per frame".format(n_fish, t))
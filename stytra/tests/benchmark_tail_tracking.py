@@ -0,0 +1,42 @@
+"""Measures the time per frame of the centroid tail tracking for different
+numbers of segments, on the frames of the example video.
+
+Run with python -m stytra.tests.benchmark_tail_tracking
+"""
+
+from pathlib import Path
+from time import perf_counter
+
+import flammkuchen as fl
+
+import stytra
+from stytra.experiments.fish_pipelines import TailTrackingPipeline
+
+
+def benchmark_tail_tracking(n_segments_list=(12, 30, 50), n_repeats=20):
+    video = fl.load(
+        str(Path(stytra.__file__).parent / "examples" / "assets" / "fish_compressed.h5")
+    )["video"]
+    pipeline = TailTrackingPipeline()
+    pipeline.setup()
+    frames = [
+        pipeline.filter._process(frame, **pipeline.filter._params.params.values).data
+        for frame in video[:100]
+    ]
+    params = pipeline.tailtrack._params.params.values
+
+    times = dict()
+    for n_segments in n_segments_list:
+        params["n_segments"] = n_segments
+        pipeline.tailtrack._process(frames[0], **params)  # compilation
+        t_start = perf_counter()
+        for _ in range(n_repeats):
+            for frame in frames:
+                pipeline.tailtrack._process(frame, **params)
+        times[n_segments] = (perf_counter() - t_start) / (n_repeats * len(frames))
+    return times
+
+
+if __name__ == "__main__":
+    for n_segments, t in benchmark_tail_tracking().items():
+        print("{:3d} segments: {:6.1f} us per frame".format(n_segments, t * 1e6))
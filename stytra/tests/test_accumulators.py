@@ -0,0 +1,103 @@
+import time
+from collections import namedtuple
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from stytra.collectors.accumulators import DataFrameAccumulator, join_asof
+from stytra.collectors.log_stream import STREAM_SUFFIX, recover_log
+
+
+def test_columnar_storage():
+    exp = SimpleNamespace(protocol_runner=SimpleNamespace(running=True))
+    acc = DataFrameAccumulator(experiment=exp, initial_capacity=4)
+    row = namedtuple("r", ["x", "y"])
+    for i in range(10):
+        acc.append(i * 0.1, row(i, -i), frame_index=i if i % 2 else None)
+
+    # the storage has grown beyond the initial capacity
+    assert acc.n_stored == 10
+    np.testing.assert_allclose(acc.times, np.arange(10) * 0.1)
+    np.testing.assert_array_equal(acc["y"], -np.arange(10))
+    assert acc.stored_data[-1] == row(9, -9)
+    assert len(acc.stored_data[2:5]) == 3
+
+    # the last points are views of the storage, which stay valid after it grows
+    last = acc.get_last_n(3)
+    assert last.shape == (3, 3)
+    assert np.shares_memory(last, acc._values)
+    for i in range(10, 100):
+        acc.append(i * 0.1, row(i, -i))
+    np.testing.assert_array_equal(last[:, 1], [7, 8, 9])
+
+    df = acc.get_dataframe()
+    assert list(df.columns) == ["x", "y", "t", "frame_index"]
+    assert df.frame_index.tolist()[:4] == [-1, 1, -1, 3]
+
+    # a change of the data fields resets the storage
+    acc.append(10.0, namedtuple("s", ["z"])(1))
+    assert acc.columns == ("t", "z")
+    assert acc.n_stored == 1
+
+
+def test_log_streaming(tmp_path):
+    exp = SimpleNamespace(protocol_runner=SimpleNamespace(running=True))
+    acc = DataFrameAccumulator(experiment=exp, max_history_if_not_running=10)
+    acc.stream_to(str(tmp_path / "log"), chunk_size=20)
+    row = namedtuple("r", ["x", "y"])
+    for i in range(1000):
+        acc.append(i * 0.1, row(i, -i))
+        acc.trim_data()
+
+    # only the last data points are kept in memory
+    assert acc.n_stored <= 30
+    assert acc.stored_data[-1] == row(999, -999)
+
+    # the chunks written so far can be read while streaming
+    stream_path = tmp_path / ("log" + STREAM_SUFFIX)
+    for _ in range(1000):
+        if acc._stream_writer.n_written == 1000:
+            break
+        time.sleep(0.01)
+    assert recover_log(stream_path, "csv") == "log.csv"
+    recovered = pd.read_csv(str(tmp_path / "log.csv"), sep=";", index_col=0)
+    np.testing.assert_array_equal(recovered.x, np.arange(1000))
+
+    acc.append(100.0, row(1000, -1000))
+    assert acc.save(str(tmp_path / "log"), "hdf5") == "log.hdf5"
+    df = pd.read_hdf(str(tmp_path / "log.hdf5"), "/data")
+    assert list(df.columns) == ["x", "y", "t"]
+    np.testing.assert_array_equal(df.y, -np.arange(1001))
+    np.testing.assert_array_equal(df.index, np.arange(1001))
+    assert not stream_path.exists()
+
+
+def test_time_windows():
+    exp = SimpleNamespace(protocol_runner=SimpleNamespace(running=True))
+    tracking = DataFrameAccumulator(experiment=exp, name="tracking")
+    stimulus = DataFrameAccumulator(experiment=exp, name="stimulus")
+    row = namedtuple("r", ["x"])
+
+    # the sampling rate drops from 100 to 10 Hz
+    times = np.concatenate([np.arange(100) * 0.01, 1 + np.arange(10) * 0.1])
+    for i, t in enumerate(times):
+        tracking.append(t, row(i))
+    for t in [0.5, 1.2]:
+        stimulus.append(t, row(-t))
+
+    last = tracking.get_last_t(0.25)
+    np.testing.assert_allclose(last[:, 0], [1.7, 1.8, 1.9])
+    assert np.shares_memory(last, tracking._values)
+
+    window = tracking.get_window(0.95, 1.1)
+    np.testing.assert_allclose(window[:, 0], [0.95, 0.96, 0.97, 0.98, 0.99, 1.0, 1.1])
+    assert tracking.get_window(2.0) is None
+
+    joined = join_asof([tracking, stimulus], t_start=0.4)
+    assert set(joined) == {"t", "x", "stimulus_t", "stimulus_x"}
+    assert np.shares_memory(joined["x"], tracking._values)
+    expected = np.where(
+        joined["t"] < 0.5, np.nan, np.where(joined["t"] < 1.2, -0.5, -1.2)
+    )
+    np.testing.assert_array_equal(joined["stimulus_x"], expected)
@@ -0,0 +1,42 @@
+import cv2
+import numpy as np
+
+from stytra.tracking.eyes import EyeTrackingMethod, EyeMomentsTrackingMethod
+
+
+def eyes_image(angles, shape=(60, 40)):
+    """ Draws two dark elliptical eyes with the given angles, and a dark
+    pixel which is not an eye. The rows of the ellipses start further left
+    than the ones above them, so they are labelled as multiple regions at
+    first and then merged
+    """
+    im = np.full(shape, 200, np.uint8)
+    cv2.ellipse(im, (20, 15), (10, 6), angles[0], 0, 360, 10, -1)
+    cv2.ellipse(im, (20, 42), (10, 6), angles[1], 0, 360, 10, -1)
+    im[3, 3] = 10
+    return im
+
+
+def test_eye_moments():
+    contours = EyeTrackingMethod()
+    moments = EyeMomentsTrackingMethod()
+    for node in [contours, moments]:
+        node.setup()
+    params = dict(wnd_pos=(0, 0), wnd_dim=(40, 60), threshold=56)
+
+    for angles in [(0, 30), (75, 100), (130, 170)]:
+        im = eyes_image(angles)
+        expected = np.array(contours._process(im, **params).data)
+        found = np.array(moments._process(im, **params).data)
+        np.testing.assert_allclose(
+            found[[0, 1, 5, 6]], expected[[0, 1, 5, 6]], atol=0.5
+        )
+        np.testing.assert_allclose(
+            found[[2, 3, 7, 8]], expected[[2, 3, 7, 8]], atol=1.5
+        )
+        angle_differences = np.mod(found[[4, 9]] - expected[[4, 9]] + 90, 180) - 90
+        assert np.all(np.abs(angle_differences) < 5)
+
+    assert np.all(
+        np.isnan(moments._process(np.full((60, 40), 200, np.uint8), **params).data)
+    )
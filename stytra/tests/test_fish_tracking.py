@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import flammkuchen as fl
+import numpy as np
+
+import stytra
+from stytra.experiments.fish_pipelines import FishTrackingPipeline, MultiWellPipeline
+
+
+def track_video(video, **params):
+    pipeline = FishTrackingPipeline()
+    pipeline.setup()
+    pipeline.bgsub._params.params.values = dict(
+        pipeline.bgsub._params.params.values, learning_rate=0.0
+    )
+    pipeline.fishtrack._params.params.values = dict(
+        pipeline.fishtrack._params.params.values, **params
+    )
+    pipeline.fishtrack.reset()
+    pipeline.compile()
+    return pipeline, np.array([pipeline.run(frame).data for frame in video], float)
+
+
+def test_local_search():
+    video = fl.load(
+        str(
+            Path(stytra.__file__).parent
+            / "examples"
+            / "assets"
+            / "fish_free_compressed.h5"
+        ),
+        "/video",
+    )[:100]
+
+    # the fish swims in a small part of a large arena
+    arena = np.full((len(video), 400, 500), np.median(video[0]), video.dtype)
+    arena[:, 200 : 200 + video.shape[1], 150 : 150 + video.shape[2]] = video
+
+    _, full = track_video(arena, full_scan_every=1)
+    pipeline, local = track_video(arena, full_scan_every=20)
+
+    # the tracked fish are the same, except for the area of the biggest
+    # object, which is only measured around the fish in the local searches
+    np.testing.assert_array_equal(full[:, :-1], local[:, :-1])
+    assert pipeline.fishtrack.n_full_scans >= 5
+    assert pipeline.fishtrack.n_local_scans > pipeline.fishtrack.n_full_scans
+
+
+def test_multiwell_tracking():
+    video = fl.load(
+        str(
+            Path(stytra.__file__).parent
+            / "examples"
+            / "assets"
+            / "fish_free_compressed.h5"
+        ),
+        "/video",
+    )[:50]
+    _, single = track_video(video)
+
+    # the same fish in each well of a 2x3 plate
+    n_rows, n_columns = 2, 3
+    well_h, well_w = video.shape[1:]
+    plate = np.full(
+        (len(video), n_rows * well_h + 20, n_columns * well_w + 30), 200, video.dtype
+    )
+    plate[:, 10 : 10 + n_rows * well_h, 15 : 15 + n_columns * well_w] = np.tile(
+        video, (1, n_rows, n_columns)
+    )
+
+    pipeline = MultiWellPipeline()
+    pipeline.setup()
+    pipeline.fishtrack._params.params.values = dict(
+        pipeline.fishtrack._params.params.values,
+        learning_rate=0.0,
+        plate_pos=(15, 10),
+        plate_dim=(n_columns * well_w, n_rows * well_h),
+        n_rows=n_rows,
+        n_columns=n_columns,
+    )
+    pipeline.fishtrack.reset()
+    pipeline.compile()
+    wells = np.array([pipeline.run(frame).data for frame in plate], float)
+    wells = wells.reshape(len(video), n_rows, n_columns, -1)
+
+    for i_row in range(n_rows):
+        for i_column in range(n_columns):
+            well = wells[:, i_row, i_column].copy()
+            well[:, 0] -= 15 + i_column * well_w
+            well[:, 2] -= 10 + i_row * well_h
+            np.testing.assert_allclose(well, single[:, :-1], atol=1e-9)
@@ -0,0 +1,86 @@
+import copy
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from queue import Empty
+
+from stytra.hardware.video.frame_ring import FrameRing
+
+
+def test_frame_ring():
+    ring = FrameRing(max_mbytes=0.0004)  # room for 4 frames of 10x10
+    reader = ring.reader()
+    with pytest.raises(Empty):
+        reader.get(timeout=0)
+
+    ring.put(np.zeros((10, 10), np.uint8))
+    _, index, frame = reader.get()
+    assert index == 0 and frame.shape == (10, 10)
+
+    for i in range(1, 4):
+        ring.put(np.full((10, 10), i, np.uint8))
+    assert [reader.get()[1] for _ in range(3)] == [1, 2, 3]
+    assert reader.n_dropped == 0
+
+    # a reader which falls behind skips the overwritten frames
+    for i in range(4, 10):
+        ring.put(np.full((10, 10), i, np.uint8))
+    _, index, frame = reader.get()
+    assert index == 7 and frame[0, 0] == 7
+    assert reader.n_dropped == 3
+    _, index, _ = ring.get_latest()
+    assert index == 9
+
+
+def test_shared_reader():
+    ring = FrameRing(max_mbytes=0.001)
+    reader = ring.reader(shared=True)
+    # copies of the reader, as in different processes, share the position
+    reader_copy = copy.copy(reader)
+    ring.put(np.zeros((10, 10), np.uint8))
+    assert reader.get()[1] == 0
+    for i in range(1, 4):
+        ring.put(np.full((10, 10), i, np.uint8))
+    assert [r.get()[1] for r in (reader_copy, reader, reader_copy)] == [1, 2, 3]
+    with pytest.raises(Empty):
+        reader.get(timeout=0)
+
+
+def test_skipping_frames():
+    ring = FrameRing(max_mbytes=0.001)
+    reader = ring.reader()
+    ring.put(np.zeros((10, 10), np.uint8))
+    reader.get()
+    for i in range(1, 5):
+        ring.put(np.full((10, 10), i, np.uint8))
+    assert reader.get(latest=True)[1] == 4
+    assert reader.n_skipped == 3
+
+    old = datetime.now() - timedelta(seconds=1)
+    for i in range(5, 8):
+        ring.put(np.full((10, 10), i, np.uint8), timestamp=old)
+    ring.put(np.full((10, 10), 8, np.uint8))
+    assert reader.get(max_latency=0.5)[1] == 8
+    assert reader.n_skipped == 6 and reader.n_dropped == 0
+
+    # the last frame is not skipped even if it is too old
+    ring.put(np.full((10, 10), 9, np.uint8), timestamp=old)
+    assert reader.get(max_latency=0.5)[1] == 9
+
+
+def test_frame_overwritten_while_used():
+    ring = FrameRing(max_mbytes=0.0004)  # room for 4 frames of 10x10
+    reader = ring.reader()
+    ring.put(np.zeros((10, 10), np.uint8))
+    t, index, frame = reader.get()
+    assert reader.confirm(index)
+
+    ring.put(np.full((10, 10), 1, np.uint8))
+    t, index, frame = reader.get()
+    # the camera wraps around the ring while the frame is being used
+    for i in range(2, 6):
+        ring.put(np.full((10, 10), i, np.uint8))
+    assert frame[0, 0] == 5
+    assert not reader.confirm(index)
+    assert reader.n_dropped == 1
+    assert ring.read(index) is None
@@ -1,5 +1,6 @@
 import numpy as np
 from stytra.tracking.fish import Fishes
+from stytra.tracking.simple_kalman import predict_inplace, update_inplace
 
 
 def test_fish():
@@ -30,3 +31,97 @@ def test_fish():
             ]
         ),
     )
+
+
+def new_fishes(n_fish_max=4):
+    return Fishes(
+        n_fish_max,
+        pos_std=1.0,
+        angle_std=np.pi / 10,
+        n_segments=0,
+        pred_coef=0.1,
+        persist_fish_for=2,
+        max_distance=15.0,
+    )
+
+
+def test_crossing_fish_keep_identities():
+    np.random.seed(0)
+    fishes = new_fishes()
+    # two fish swimming along crossing paths, detected in random order
+    starts = np.array([[0.0, 0.0], [0.0, 60.0]])
+    steps = np.array([[2.0, 1.0], [2.0, -1.0]])
+    thetas = np.arctan2(steps[:, 1], steps[:, 0])
+    identities = None
+    for i_frame in range(60):
+        detections = np.column_stack([starts + i_frame * steps, thetas])
+        detections[:, :2] += np.random.normal(0, 0.2, (2, 2))
+        order = np.random.permutation(2)
+        fishes.predict()
+        fish_indices, added = fishes.assign(detections[order])
+        fish_of_detection = np.empty(2, np.int64)
+        fish_of_detection[order] = fish_indices
+        if identities is None:
+            assert added.all()
+            identities = fish_of_detection
+        else:
+            assert not added.any()
+            np.testing.assert_array_equal(fish_of_detection, identities)
+
+    # the velocities (per frame) are estimated
+    coords = fishes.coords[identities]
+    np.testing.assert_allclose(coords[:, [1, 3]], steps, atol=0.2)
+
+
+def test_far_detection_is_new_fish():
+    fishes = new_fishes()
+    fishes.assign(np.array([[10.0, 10.0, 0.0]]))
+    fishes.predict()
+    # the second detection is outside of the gate and of max_distance
+    fish_indices, added = fishes.assign(
+        np.array([[60.0, 10.0, 0.0], [11.0, 10.0, 0.0]])
+    )
+    assert fish_indices.tolist() == [1, 0]
+    assert added.tolist() == [True, False]
+    np.testing.assert_allclose(fishes.coords[1, [0, 2, 4]], [60, 10, 0])
+
+    # with no room for a new fish, the detection is not assigned
+    fishes = new_fishes(n_fish_max=1)
+    fishes.assign(np.array([[10.0, 10.0, 0.0]]))
+    fishes.predict()
+    fish_indices, added = fishes.assign(np.array([[60.0, 10.0, 0.0]]))
+    assert fish_indices.tolist() == [-1] and not added.any()
+
+
+def test_batched_kalman_matches_reference():
+    np.random.seed(1)
+    n_states = 5
+    F = np.array([[1.0, 1.0], [0.0, 1.0]])
+    Q = np.array([[0.01, 0.02], [0.02, 0.04]])
+    x = np.random.normal(0, 1, (n_states, 2))
+    A = np.random.normal(0, 1, (n_states, 2, 2))
+    P = A @ A.transpose(0, 2, 1) + np.eye(2)
+    indices = np.array([0, 2, 3])
+    z = np.random.normal(0, 1, len(indices))
+    R = np.random.uniform(0.5, 2, len(indices))
+
+    x_batch, P_batch = x.copy(), P.copy()
+    predict_inplace(x_batch, P_batch, F, Q, indices)
+    update_inplace(z, x_batch, P_batch, R, indices)
+
+    # the filter of a single fish, one state at a time, as it was written
+    # before the batching
+    x_ref, P_ref = x.copy(), P.copy()
+    for j, i in enumerate(indices):
+        x_ref[i, 0] = x_ref[i, 0] + x_ref[i, 1]
+        P_ref[i] = F @ P_ref[i] @ F.T + Q
+
+        K = P_ref[i, :, 0] / (P_ref[i, 0, 0] + R[j])
+        x_ref[i] = x_ref[i] + K * (z[j] - x_ref[i, 0])
+        I_KH = np.eye(2)
+        I_KH[0, 0] -= K[0]
+        I_KH[1, 0] = -K[1]
+        P_ref[i] = I_KH @ P_ref[i] @ I_KH.T + R[j] * (K @ K.T)
+
+    np.testing.assert_allclose(x_batch, x_ref)
+    np.testing.assert_allclose(P_batch, P_ref)
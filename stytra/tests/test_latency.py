@@ -0,0 +1,35 @@
+import datetime
+from collections import namedtuple
+from types import SimpleNamespace
+
+import numpy as np
+
+from stytra.collectors import LatencyTracer, QueueDataAccumulator
+from stytra.collectors.namedtuplequeue import NamedTupleQueue
+
+
+def test_latency_tracer():
+    t0 = datetime.datetime.now()
+    exp = SimpleNamespace(
+        t0=t0, protocol_runner=SimpleNamespace(running=True), estimator=None
+    )
+    tracer = LatencyTracer(exp, bin_width=0.001, max_latency=0.1)
+    queue = NamedTupleQueue()
+    acc = QueueDataAccumulator(experiment=exp, data_queue=queue, latency_tracer=tracer)
+    output = namedtuple("o", ["x"])
+    frame_time = datetime.datetime.now() - datetime.timedelta(seconds=0.01)
+    for i in range(3):
+        queue.put((frame_time, 10 + i), output(i))
+    while len(acc.stored_data) < 3:
+        acc.update_list()
+
+    assert acc.get_dataframe().frame_index.tolist() == [10, 11, 12]
+    assert tracer.histograms["tracking"].sum() == 3
+    (p50,) = tracer.percentiles("tracking", (50,))
+    assert 0.01 <= p50 < 0.1
+
+    # the painted stimulus is traced back to the frame of the estimator
+    exp.estimator = SimpleNamespace(frame_index=12, frame_time=acc.times[-1])
+    tracer.record_display()
+    assert tracer.display_log.get_dataframe().frame_index.tolist() == [12]
+    assert np.all(tracer.get_dataframe().display.values <= 1)
@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import flammkuchen as fl
+import numpy as np
+import pandas as pd
+
+import stytra
+from stytra.experiments.fish_pipelines import FishTrackingPipeline
+from stytra.offline.bouts import BoutSegmenter, segment_log
+from stytra.tracking.online_bouts import BOUT_ENDED
+
+
+def test_offline_segmentation(tmp_path):
+    video = fl.load(
+        str(
+            Path(stytra.__file__).parent
+            / "examples"
+            / "assets"
+            / "fish_free_compressed.h5"
+        ),
+        "/video",
+    )
+    pipeline = FishTrackingPipeline()
+    pipeline.setup()
+    # the parameters are shared by all the instances of the node, so the
+    # default threshold is restored after the tracking
+    default_params = pipeline.bouts._params.params.values
+    pipeline.bouts._params.params.values = dict(default_params, threshold=0.05)
+    pipeline.compile()
+    outputs = []
+    events = []
+    try:
+        for i_frame, frame in enumerate(video):
+            output = pipeline.run(frame).data
+            outputs.append(output)
+            events.extend(pipeline.detect_events(output, i_frame).data)
+    finally:
+        pipeline.bouts._params.params.values = default_params
+    ended = [e for e in events if e.event == BOUT_ENDED]
+
+    log = pd.DataFrame.from_records(outputs, columns=outputs[0]._fields)
+    log["t"] = np.arange(len(log)) * 0.01
+
+    # the bouts are the ones detected online, also if the log is split
+    # in chunks
+    for chunk_size in [len(log), 60, 7]:
+        segmenter = BoutSegmenter(threshold=0.05)
+        bouts = pd.concat(
+            [
+                segmenter.feed(log.iloc[i : i + chunk_size])
+                for i in range(0, len(log), chunk_size)
+            ],
+            ignore_index=True,
+        )
+        assert len(bouts) == len(ended) > 2
+        for (_, bout), event in zip(bouts.iterrows(), ended):
+            assert bout.start_index == event.start_index
+            assert bout.n_frames == event.n_frames
+            np.testing.assert_allclose(
+                bout[
+                    ["x", "y", "theta", "dx", "dy", "heading_change", "peak_vel"]
+                ].values.astype(float),
+                [
+                    event.x,
+                    event.y,
+                    event.theta,
+                    event.dx,
+                    event.dy,
+                    event.dtheta,
+                    event.peak_vel,
+                ],
+            )
+            assert np.isclose(bout.duration, bout.n_frames * 0.01)
+    assert np.all((bouts.max_tail_amplitude > 0) & (bouts.max_tail_amplitude < np.pi))
+    assert np.all(bouts.tail_beat_frequency > 0)
+
+    # a second fish, whose bouts are delayed
+    delay = 50
+    second = log[[c for c in log.columns if c.startswith("f0_")]].shift(delay)
+    second.columns = ["f1" + c[2:] for c in second.columns]
+    two_fish = pd.concat([log, second], axis=1)
+    two_fish.to_csv(str(tmp_path / "log.csv"), sep=";")
+    bouts = segment_log(tmp_path / "log.csv", chunk_size=40, threshold=0.05)
+    first = bouts[bouts.fish == 0].reset_index(drop=True)
+    delayed = bouts[bouts.fish == 1].reset_index(drop=True)
+    assert len(first) == len(ended)
+    np.testing.assert_array_equal(
+        delayed.start_index.values,
+        first.start_index.values[: len(delayed)] + delay,
+    )
+    assert np.all(np.diff(bouts.start_index.values) >= 0)
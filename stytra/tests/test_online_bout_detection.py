@@ -1,5 +1,23 @@
+from datetime import datetime
+from pathlib import Path
+from queue import Queue
+from types import SimpleNamespace
+
+import flammkuchen as fl
 import numpy as np
-from stytra.tracking.online_bouts import find_bouts_online, BoutState
+
+import stytra
+from stytra.collectors import EstimatorLog, QueueDataAccumulator
+from stytra.stimulation.estimators import BoutsEstimator
+from stytra.experiments.fish_pipelines import FishTrackingPipeline, TailTrackingPipeline
+from stytra.tracking.online_bouts import (
+    find_bouts_online,
+    BoutState,
+    _process_input,
+    BOUT_STARTED,
+    BOUT_ENDED,
+    BoutEvent,
+)
 
 
 def test_online_bout_det():
@@ -17,3 +35,102 @@ def test_online_bout_det():
         pad_before=0,
     )
     assert len(k) == 11
+
+
+def load_video(name):
+    return fl.load(
+        str(Path(stytra.__file__).parent / "examples" / "assets" / name), "/video"
+    )
+
+
+def run_pipeline(pipeline, video):
+    pipeline.setup()
+    pipeline.compile()
+    outputs = []
+    events = []
+    for i_frame, frame in enumerate(video):
+        output = pipeline.run(frame).data
+        outputs.append(output)
+        events.extend(pipeline.detect_events(output, i_frame).data)
+    return outputs, events
+
+
+def expected_bouts(vel, threshold=0.2):
+    """ The bouts found running the detection on the whole recording"""
+    state = BoutState(0, 0.0, 0, 0, 0)
+    expected = []
+    for i_frame, v in enumerate(vel):
+        next_state = _process_input(v, state, threshold=threshold)
+        if state.state != 1 and next_state.state == 1:
+            i_start = i_frame
+            expected.append((BOUT_STARTED, i_start))
+        if state.state == 2 and next_state.state == 3:
+            expected.append((BOUT_ENDED, i_start))
+        state = next_state
+    return expected
+
+
+def test_bout_detector_node():
+    outputs, events = run_pipeline(
+        FishTrackingPipeline(), load_video("fish_free_compressed.h5")
+    )
+
+    # the same bouts are found running the detection on the whole recording
+    coords = np.array([(o.f0_x, o.f0_y, o.f0_theta) for o in outputs])
+    vel = np.sum(np.diff(coords[:, :2], axis=0) ** 2, 1)
+    vel = np.nan_to_num(np.concatenate([[0], vel]))
+    expected = expected_bouts(vel)
+
+    assert len(expected) > 2
+    assert [(e.event, e.start_index) for e in events] == expected
+    for event in events:
+        assert event.i_fish == 0
+        np.testing.assert_allclose(
+            (event.x, event.y, event.theta), coords[event.start_index - 1]
+        )
+        if event.event == BOUT_ENDED:
+            i_end = event.start_index + event.n_frames
+            np.testing.assert_allclose(
+                (event.dx, event.dy),
+                coords[i_end, :2] - coords[event.start_index - 1, :2],
+            )
+            assert event.peak_vel == np.max(vel[event.start_index : i_end + 1])
+
+    # for the embedded fish, the bouts are detected from the tail_sum
+    outputs, events = run_pipeline(
+        TailTrackingPipeline(), load_video("fish_compressed.h5")
+    )
+    tail_sum = np.array([o.tail_sum for o in outputs])
+    vel = np.concatenate([[0], np.diff(tail_sum) ** 2])
+    expected = expected_bouts(vel)
+
+    assert len(expected) > 2
+    assert [(e.event, e.start_index) for e in events] == expected
+    for event in events:
+        assert event.i_fish == 0 and np.isnan(event.x)
+        assert event.theta == tail_sum[event.start_index - 1]
+        if event.event == BOUT_ENDED:
+            i_end = event.start_index + event.n_frames
+            np.testing.assert_allclose(
+                event.dtheta, tail_sum[i_end] - tail_sum[event.start_index - 1]
+            )
+
+
+def test_bout_events_opt_in():
+    t0 = datetime.now()
+    exp = SimpleNamespace(t0=t0, protocol_runner=SimpleNamespace(running=True))
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    event_queue = Queue()
+    exp.bout_log = QueueDataAccumulator(experiment=exp, data_queue=event_queue)
+    acc = QueueDataAccumulator(experiment=exp, data_queue=Queue())
+    threshold_bouts = BoutsEstimator(acc, experiment=exp)
+    event_bouts = BoutsEstimator(acc, experiment=exp, use_bout_events=True)
+
+    event = BoutEvent(BOUT_STARTED, 0, 10, 1, *[np.nan] * 6, 1.0)
+    event_queue.put(((t0, 10), event))
+    exp.bout_log.update_list()
+
+    # by default, the bouts are still detected from the vigor
+    assert not threshold_bouts.bout_occured()
+    assert event_bouts.bout_occured()
+    assert not event_bouts.bout_occured()
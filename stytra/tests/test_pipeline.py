@@ -38,3 +38,70 @@ def test_a_pipeline():
     p.deserialize_params(ser)
     assert p.run(None) == NodeOutput([], tt(None, 2))
     assert p.diagnostic_image == "img"
+
+
+class CountingNode(ImageToDataNode):
+    stateful = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("countnode", *args, **kwargs)
+        self.count = 0
+
+    def reset(self):
+        self._output_type = namedtuple("o", "frame count")
+
+    def _process(self, input, set_diagnostic=None):
+        if self._output_type is None:
+            self.reset()
+        return NodeOutput([], self._output_type(frame=input, count=0))
+
+    def update_state(self, output):
+        self.count += 1
+        return NodeOutput([], output.data._replace(count=self.count))
+
+
+class StatefulPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.tp = TestNode(parent=self.root)
+        self.cn = CountingNode(parent=self.root)
+
+
+def test_deferred_state():
+    p_direct = StatefulPipeline()
+    p_direct.setup()
+    p_worker = StatefulPipeline()
+    p_worker.setup()
+    p_tail = StatefulPipeline()
+    p_tail.setup()
+
+    for i in range(3):
+        direct = p_direct.run(i)
+        deferred = p_worker.run(i, defer_state=True)
+        assert deferred.data.count == 0
+        assert p_tail.update_state(deferred).data == direct.data
+    assert direct.data.count == 3
+
+
+def test_compiled_pipeline():
+    p_recursive = StatefulPipeline()
+    p_recursive.setup()
+    p_compiled = StatefulPipeline()
+    p_compiled.setup()
+    p_compiled.compile()
+
+    for i in range(3):
+        assert p_compiled.run(i) == p_recursive.run(i)
+    assert p_compiled.run(0).data._fields == ("inp", "par", "frame", "count")
+
+
+def test_pipeline_profiling():
+    p = StatefulPipeline()
+    p.setup()
+    p.enable_profiling(n_frames=4)
+    for i in range(6):
+        p.run(i)
+    summary = p.profiler.summary()
+    assert list(summary.keys()) == ["source", "testnode", "countnode", "total"]
+    assert p.profiler.n_recorded == 4
+    assert all(len(percs) == 3 and percs[0] >= 0 for percs in summary.values())
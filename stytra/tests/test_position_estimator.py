@@ -0,0 +1,127 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from queue import Queue
+from types import SimpleNamespace
+
+import numpy as np
+
+from stytra.collectors import EstimatorLog, QueueDataAccumulator
+from stytra.stimulation.estimators import (
+    EstimationStage,
+    MultiFishPositionEstimator,
+    PositionEstimator,
+    SharedEstimate,
+    VigorMotionEstimator,
+)
+
+
+def test_predicted_position():
+    # the last frame is acquired now
+    t0 = datetime.now() - timedelta(seconds=0.09)
+    exp = SimpleNamespace(
+        t0=t0,
+        protocol_runner=SimpleNamespace(running=True),
+        calibrator=SimpleNamespace(cam_to_proj=None),
+    )
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    queue = Queue()
+    acc = QueueDataAccumulator(experiment=exp, data_queue=queue)
+    estimator = PositionEstimator(
+        acc, experiment=exp, predict=True, display_latency=0.02
+    )
+
+    # a fish swimming at 1 px per frame along x, tracked at 100 Hz
+    row = namedtuple("o", ["f0_x", "f0_vx", "f0_y", "f0_vy", "f0_theta", "f0_vtheta"])
+    for i in range(10):
+        queue.put(((t0 + timedelta(seconds=i * 0.01), i), row(i, 1, 5, 0, 0, 0)))
+    acc.update_list()
+
+    t_before = (datetime.now() - t0).total_seconds()
+    y, x, theta = estimator.get_position()
+    t_after = (datetime.now() - t0).total_seconds()
+    assert (y, theta) == (5, 0)
+    # the fish has moved on by the frames elapsed until the display
+    n_min, n_max = ((t - 0.09 + 0.02) / 0.01 for t in (t_before, t_after))
+    assert n_min - 1e-6 <= x - 9 <= n_max + 1e-6
+
+    # the pose is logged in the order it is returned in
+    df = estimator.log.get_dataframe()
+    assert df[["raw_x", "raw_y", "raw_theta"]].values.tolist() == [[5, 9, 0]]
+    assert df[["x", "y", "theta"]].values.tolist() == [[y, x, theta]]
+
+    # the projection follows the changes of the calibration
+    exp.calibrator.cam_to_proj = ((2.0, 0.0, 1.0), (0.0, 2.0, 0.0))
+    y, x, theta = estimator.get_position()
+    assert y == 10 and x > 19
+    np.testing.assert_array_equal(estimator.projection, [[2, 0, 1], [0, 2, 0]])
+
+
+def test_multi_fish_positions():
+    t0 = datetime.now()
+    exp = SimpleNamespace(
+        t0=t0,
+        protocol_runner=SimpleNamespace(running=True),
+        calibrator=SimpleNamespace(cam_to_proj=((0.0, 2.0, 1.0), (2.0, 0.0, 0.0))),
+    )
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    queue = Queue()
+    acc = QueueDataAccumulator(experiment=exp, data_queue=queue)
+    estimator = MultiFishPositionEstimator(acc, experiment=exp)
+    positions, valid = estimator.get_positions()
+    assert positions.shape == (0, 3)
+
+    # three fish, the second one is not tracked
+    fields = ["f{}_{}".format(i, var) for i in range(3) for var in ("x", "y", "theta")]
+    row = namedtuple("o", fields + ["biggest_area"])
+    poses = np.array([[10, 20, 0.3], [np.nan] * 3, [5, 1, -2.0]])
+    queue.put(((t0, 0), row(*poses.ravel(), 0)))
+    acc.update_list()
+
+    positions, valid = estimator.get_positions()
+    assert valid.tolist() == [True, False, True]
+    for i_fish in np.flatnonzero(valid):
+        # the same transform as for a single fish
+        y, x, theta = estimator.to_display(poses[i_fish])
+        np.testing.assert_allclose(positions[i_fish], [x, y, theta])
+    assert np.isnan(positions[1]).all()
+
+    y, x, theta = estimator.get_position()
+    np.testing.assert_allclose((x, y), positions[0, :2])
+    df = estimator.log.get_dataframe()
+    assert list(df.columns[:9]) == fields
+    np.testing.assert_allclose(df[["f2_x", "f2_y"]].values[-1], positions[2, :2])
+
+
+def test_estimated_fish():
+    t0 = datetime.now()
+    exp = SimpleNamespace(
+        t0=t0,
+        protocol_runner=SimpleNamespace(running=True),
+        calibrator=SimpleNamespace(cam_to_proj=None),
+    )
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    queue = Queue()
+    acc = QueueDataAccumulator(experiment=exp, data_queue=queue)
+
+    # the estimator params are passed both to the estimation stage and to
+    # the estimator
+    estimator_params = dict(i_fish=1)
+    shared_estimate = SharedEstimate()
+    stage = EstimationStage(shared_estimate, **estimator_params)
+    estimator = PositionEstimator(acc, experiment=exp, **estimator_params)
+    multi_estimator = MultiFishPositionEstimator(
+        acc, experiment=exp, **estimator_params
+    )
+    VigorMotionEstimator(acc, experiment=exp, **estimator_params)
+
+    fields = ["f{}_{}".format(i, var) for i in range(2) for var in ("x", "y", "theta")]
+    row = namedtuple("o", fields)
+    data = row(10, 20, 0.3, 5, 1, -2.0)
+    queue.put(((t0, 0), data))
+    acc.update_list()
+    stage.update(t0, 0, data)
+
+    np.testing.assert_allclose(estimator.get_position(), (1, 5, -2.0))
+    np.testing.assert_allclose(multi_estimator.get_position(), (1, 5, -2.0))
+    assert estimator.get_camera_position() == (5, 1, -2.0)
+    assert shared_estimate.read()[3:6] == (5, 1, -2.0)
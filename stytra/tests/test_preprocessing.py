@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+
+from stytra.tracking.preprocessing import Prefilter, BackgroundSubtractor
+
+
+def prefilter_reference(im, image_scale, filter_size, color_invert, clip):
+    if image_scale != 1:
+        im = cv2.resize(
+            im, None, fx=image_scale, fy=image_scale, interpolation=cv2.INTER_AREA
+        )
+    if filter_size > 0:
+        im = cv2.boxFilter(im, -1, (filter_size, filter_size))
+    if color_invert:
+        im = 255 - im
+    if clip > 0:
+        im = np.maximum(im, clip) - clip
+    return im
+
+
+def test_prefilter():
+    prefilter = Prefilter()
+    prefilter.setup()
+    np.random.seed(0)
+    im = np.random.randint(0, 256, (121, 160)).astype(np.uint8)
+    for params in [(1, 0, False, 0), (0.5, 2, True, 140), (0.3, 3, False, 20)]:
+        for _ in range(2):  # with the buffers from the previous frame
+            output = prefilter._process(im, *params, False, (0, 0, 1, 1)).data
+            np.testing.assert_array_equal(output, prefilter_reference(im, *params))
+
+    # with a crop, the region is processed in the same way and the rest is 0
+    params = (0.5, 0, True, 100)
+    output = prefilter._process(im, *params, True, (0.2, 0.4, 0.5, 0.3)).data
+    reference = prefilter_reference(im, *params)
+    assert output.shape == reference.shape
+    np.testing.assert_array_equal(output[12:42, 24:42], reference[12:42, 24:42])
+    assert not output[:12].any() and not output[:, 42:].any()
+
+
+def test_background_subtraction():
+    bgsub = BackgroundSubtractor()
+    bgsub.setup()
+    background = np.full((41, 60), 200, np.uint8)
+    im = background.copy()
+    im[10:20, 30:34] = 50
+    bgsub._process(background, 0.5, 4, True, 2)
+    difference = bgsub._process(im, 0.5, 4, True, 2).data
+    assert difference.shape == (20, 30)
+    assert difference[5:10, 15:17].min() == 150 and difference[:5].max() == 0
+    np.testing.assert_array_equal(
+        bgsub.full_resolution_difference((slice(8, 22), slice(28, 40))),
+        200 - im[8:22, 28:40],
+    )
+
+    # the background is learned in bands of 5 rows over 4 frames, the first
+    # of which was learned in the previous frame
+    for _ in range(3):
+        bgsub._process(im, 0.5, 4, True, 2)
+    assert bgsub.background_image[5:10, 15:17].max() == 125
+    assert bgsub.background_image[:5].min() == 200
@@ -0,0 +1,68 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from types import SimpleNamespace
+from queue import Empty
+
+import numpy as np
+import pytest
+
+from stytra.collectors import QueueDataAccumulator
+from stytra.collectors.row_ring import RowRing
+
+
+def put_rows(ring, n_rows):
+    row = namedtuple("o", ["x", "y"])
+    t0 = datetime.now()
+    for i in range(n_rows):
+        ring.put((t0 + timedelta(seconds=i * 0.01), i), row(i, -i))
+
+
+def test_row_ring():
+    ring = RowRing(max_mbytes=0.0004)  # room for 12 rows of 2 values
+    with pytest.raises(Empty):
+        ring.get_many()
+
+    # the rows are written from another process
+    writer = Process(target=put_rows, args=(ring, 10))
+    writer.start()
+    writer.join()
+    rows = ring.get_many()
+    assert ring.tuple_type._fields == ("x", "y")
+    np.testing.assert_array_equal(rows[:, 1:], [[i, i, -i] for i in range(10)])
+    np.testing.assert_allclose(np.diff(rows[:, 0]), 0.01, atol=1e-6)
+    with pytest.raises(Empty):
+        ring.get_many()
+
+    # a reader which falls behind loses the overwritten rows
+    t = datetime.now()
+    row = namedtuple("o", ["x", "y"])
+    for i in range(10, 30):
+        ring.put((t, i), row(i, -i))
+    rows = ring.get_many()
+    np.testing.assert_array_equal(rows[:, 1], np.arange(19, 30))
+    assert ring.n_dropped == 9
+
+    # the unread rows with the previous fields are dropped
+    ring.put(t, row(30, -30))
+    ring.put(t, namedtuple("o", ["z"])(1))
+    (time, frame_index), data = ring.to_tuples(ring.get_many())[0]
+    assert frame_index is None and data.z == 1
+    assert ring.n_dropped == 10
+
+
+def test_accumulator_from_ring():
+    t0 = datetime.now()
+    exp = SimpleNamespace(t0=t0, protocol_runner=SimpleNamespace(running=True))
+    ring = RowRing()
+    acc = QueueDataAccumulator(experiment=exp, data_queue=ring)
+    row = namedtuple("o", ["x"])
+    for i in range(2000):
+        ring.put((t0 + timedelta(seconds=i * 0.001), i), row(i))
+    acc.update_list()
+
+    assert acc.n_stored == acc.n_received == 2000
+    np.testing.assert_allclose(acc.times, np.arange(2000) * 0.001, atol=1e-6)
+    df = acc.get_dataframe()
+    np.testing.assert_array_equal(df.frame_index, np.arange(2000))
+    np.testing.assert_array_equal(df.x, np.arange(2000))
@@ -0,0 +1,92 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from queue import Queue
+from types import SimpleNamespace
+
+import numpy as np
+
+from stytra.collectors import EstimatorLog, QueueDataAccumulator
+from stytra.stimulation.estimators import (
+    BoutsEstimator,
+    Estimate,
+    EstimationStage,
+    SharedEstimate,
+    VigorMotionEstimator,
+)
+
+row = namedtuple("o", ["f0_x", "f0_y", "f0_theta", "tail_sum"])
+
+
+def synthetic_outputs(n_frames):
+    np.random.seed(0)
+    times = np.cumsum(np.random.uniform(0.001, 0.004, n_frames))
+    tail = np.cumsum(np.random.normal(0, 0.1, n_frames))
+    tail[np.random.uniform(size=n_frames) < 0.05] = np.nan
+    return times, tail
+
+
+def track(shared_estimate, t0, n_frames):
+    times, tail = synthetic_outputs(n_frames)
+    stage = EstimationStage(shared_estimate, vigor_window=0.05, bout_threshold=0.2)
+    for i, (t, tail_sum) in enumerate(zip(times, tail)):
+        stage.update(t0 + timedelta(seconds=t), i, row(i, -i, 0.5, tail_sum))
+
+
+def test_estimates_from_tracking_process():
+    t0 = datetime.now()
+    shared_estimate = SharedEstimate()
+    exp = SimpleNamespace(
+        t0=t0,
+        protocol_runner=SimpleNamespace(running=True),
+        shared_estimate=shared_estimate,
+    )
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    acc = QueueDataAccumulator(experiment=exp, data_queue=Queue())
+    estimator = VigorMotionEstimator(acc, experiment=exp, base_gain=1)
+    assert shared_estimate.read() is None
+    assert estimator.get_velocity() == 0
+
+    # the estimates are computed in another process
+    n_frames = 3000
+    tracking = Process(target=track, args=(shared_estimate, t0, n_frames))
+    tracking.start()
+    tracking.join()
+
+    estimate = shared_estimate.read()
+    assert estimate.frame_index == n_frames - 1
+    assert (estimate.x, estimate.y, estimate.theta) == (n_frames - 1, 1 - n_frames, 0.5)
+
+    # the vigor is the one computed from the accumulated tail trace
+    times, tail = synthetic_outputs(n_frames)
+    in_window = times >= times[-1] - 0.05
+    np.testing.assert_allclose(
+        estimator.get_velocity(), np.nanstd(tail[in_window]), rtol=1e-6
+    )
+    assert estimator.frame_index == n_frames - 1
+    np.testing.assert_allclose(estimator.frame_time, times[-1], atol=1e-6)
+
+    # bouts are signalled when the count of the tracking process increases
+    assert estimate.n_bouts > 0
+    bouts = BoutsEstimator(acc, experiment=exp)
+    assert not bouts.bout_occured()
+    shared_estimate.write(estimate._replace(n_bouts=estimate.n_bouts + 1))
+    assert bouts.bout_occured()
+    assert not bouts.bout_occured()
+
+
+def test_interrupted_write():
+    shared_estimate = SharedEstimate(max_retries=10)
+    estimate = Estimate(1.0, 0, 0.5, 1.0, 2.0, 0.0, 0.0, 0.0, 0.0, 0)
+    shared_estimate.write(estimate)
+    assert shared_estimate.read() == estimate
+
+    # the writer stops in the middle of a write
+    shared_estimate.sequence.value += 1
+    shared_estimate.values[0] = 2.0
+    assert shared_estimate.read() == estimate
+
+    # nothing was read before
+    other = SharedEstimate(max_retries=10)
+    other.sequence.value = 1
+    assert other.read() is None
@@ -0,0 +1,74 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+from stytra.tracking.tail import (
+    _window_offsets,
+    _unwrap_inplace,
+    _gaussian_filter_nearest,
+    _tail_trace_centroid,
+    _arc_table,
+    _tail_trace_angles,
+)
+
+
+def test_window_offsets():
+    for window_size in (1, 4, 7, 15):
+        halfwin = window_size / 2
+        off_x, off_y = _window_offsets(window_size)
+        mask = np.zeros((window_size + 1, window_size + 1), np.bool_)
+        mask[off_y, off_x] = True
+        for y in range(window_size + 1):
+            for x in range(window_size + 1):
+                assert mask[y, x] == (
+                    (halfwin - x) ** 2 + (halfwin - y) ** 2 <= halfwin**2
+                )
+
+
+def test_angle_processing():
+    np.random.seed(0)
+    angles = np.cumsum(np.random.uniform(-2, 2, 40))
+    angles = np.arctan2(np.sin(angles), np.cos(angles))
+    unwrapped = angles.copy()
+    _unwrap_inplace(unwrapped)
+    np.testing.assert_allclose(unwrapped, np.unwrap(angles))
+    for sigma in (0.5, 2.0, 10.0):
+        np.testing.assert_allclose(
+            _gaussian_filter_nearest(unwrapped, sigma),
+            gaussian_filter1d(unwrapped, sigma, mode="nearest"),
+        )
+
+
+def test_centroid_tail_trace():
+    # a straight bright tail going down and to the right at 45 degrees
+    im = np.zeros((100, 100), np.uint8)
+    for i in range(10, 80):
+        im[i, i - 1 : i + 2] = 255
+    output, i_missing = _tail_trace_centroid(
+        im, 0.1, 0.1, 0.6, 0.6, 12, 3.5, *_window_offsets(7), 0.0, 9
+    )
+    assert i_missing == 0
+    np.testing.assert_allclose(output[1:], np.pi / 4, atol=0.1)
+
+    # the tail goes out of the image
+    output, i_missing = _tail_trace_centroid(
+        im, 0.1, 0.1, 1.5, 1.5, 12, 3.5, *_window_offsets(7), 0.0, 9
+    )
+    assert i_missing > 0 and np.isnan(output[-1])
+
+
+def test_angles_tail_trace():
+    im = np.zeros((100, 100), np.uint8)
+    for i in range(10, 80):
+        im[i, i - 1 : i + 2] = 255
+    for bilinear in (False, True):
+        output, i_missing = _tail_trace_angles(
+            im, 0.1, 0.1, 12, *_arc_table((0.6, 0.5), 12, 21), bilinear, 9
+        )
+        assert i_missing == 0
+        np.testing.assert_allclose(output[1:], np.pi / 4, atol=0.1)
+
+    # the tail starts at the corner, pointing out of the image
+    output, i_missing = _tail_trace_angles(
+        im, 0.99, 0.99, 12, *_arc_table((1.5, 1.5), 12, 21), False, 9
+    )
+    assert i_missing == 1 and np.isnan(output[-1])
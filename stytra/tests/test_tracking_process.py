@@ -0,0 +1,153 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Event, Queue
+from queue import Empty
+
+import numpy as np
+
+from stytra.collectors.row_ring import RowRing
+from stytra.hardware.video.frame_ring import FrameRing
+from stytra.tracking.pipelines import ImageToDataNode, NodeOutput, Pipeline
+from stytra.tracking.tracking_process import (
+    TrackingProcess,
+    TrackingReassemblyProcess,
+)
+
+# the camera, which the pipeline below drives to simulate its timing
+camera = dict(ring=None, finished=None)
+
+
+class CountingNode(ImageToDataNode):
+    """ Counts the frames it tracks, as its state """
+
+    stateful = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("countnode", *args, **kwargs)
+        self.count = 0
+
+    def reset(self):
+        self._output_type = namedtuple("o", "frame count")
+
+    def _process(self, frame, set_diagnostic=None):
+        if self._output_type is None:
+            self.reset()
+        return NodeOutput([], self._output_type(frame=int(frame[0, 0]), count=0))
+
+    def update_state(self, output):
+        self.count += 1
+        return NodeOutput([], output.data._replace(count=self.count))
+
+
+class CountingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.cn = CountingNode(parent=self.root)
+
+
+class CameraDrivingNode(CountingNode):
+    """ While frame 1 is being tracked the camera wraps around the ring, and
+    frame 5 is the last one
+    """
+
+    def _process(self, frame, set_diagnostic=None):
+        value = int(frame[0, 0])
+        if value == 1:
+            for i in range(2, 6):
+                camera["ring"].put(np.full((10, 10), i, np.uint8))
+        if value == 5:
+            camera["finished"].set()
+        return super()._process(frame, set_diagnostic)
+
+
+class CameraDrivingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.cn = CameraDrivingNode(parent=self.root)
+
+
+def test_frame_overwritten_during_tracking():
+    camera["ring"] = FrameRing(max_mbytes=0.0004)  # room for 4 frames of 10x10
+    camera["finished"] = Event()
+    reader = camera["ring"].reader()
+    # the reader starts from the last frame written
+    camera["ring"].put(np.full((10, 10), 1, np.uint8))
+
+    output_queue = RowRing()
+    process = TrackingProcess(
+        in_frame_queue=reader,
+        finished_signal=camera["finished"],
+        pipeline=CameraDrivingPipeline,
+        processing_parameter_queue=Queue(),
+        output_queue=output_queue,
+        gui_dispatcher=False,
+    )
+    process.run()
+
+    # frame 1 is dropped without changing the state, frame 2 is overwritten
+    # before being read
+    rows = output_queue.get_many()
+    np.testing.assert_array_equal(rows[:, 2], [3, 4, 5])
+    np.testing.assert_array_equal(rows[:, 3], [1, 2, 3])
+    assert reader.n_dropped == 2
+
+
+def test_reassembly_of_sharded_tracking():
+    t0 = datetime.now()
+    frames = [
+        (t0 + timedelta(seconds=0.01 * i), np.full((10, 10), i, np.uint8))
+        for i in range(10)
+    ]
+    # the frames are split between two workers, which do not update the
+    # state of the pipeline, and frame 6 is dropped by the first one
+    worker_pipelines = [CountingPipeline(), CountingPipeline()]
+    worker_queues = [RowRing(), RowRing()]
+    for pipeline in worker_pipelines:
+        pipeline.setup()
+
+    def track(i_worker, indexes):
+        for i in indexes:
+            time, frame = frames[i]
+            _, output = worker_pipelines[i_worker].run(frame, defer_state=True)
+            worker_queues[i_worker].put((time, i), output)
+
+    output_queue = RowRing()
+    process = TrackingReassemblyProcess(
+        worker_queues, output_queue=output_queue, max_wait=10
+    )
+    process.pipeline = CountingPipeline()
+    process.pipeline.setup()
+    emitted = []
+
+    def emit():
+        process.collect()
+        process.emit_ready()
+        try:
+            rows = output_queue.get_many()
+        except Empty:
+            return []
+        emitted.append(rows)
+        return rows[:, 1].astype(int).tolist()
+
+    # the first worker is ahead, the outputs are emitted in order once
+    # both workers went past them
+    track(0, [0, 2, 4])
+    assert emit() == []
+    track(1, [1, 3])
+    assert emit() == [0, 1, 2, 3, 4]
+    # frame 8 waits until the second worker shows that 6 is missing
+    track(1, [5])
+    track(0, [8])
+    assert emit() == [5]
+    track(1, [7, 9])
+    assert emit() == [7, 8, 9]
+
+    # the state is the one of the pipeline tracking all the frames in order
+    pipeline = CountingPipeline()
+    pipeline.setup()
+    expected = []
+    for i in [0, 1, 2, 3, 4, 5, 7, 8, 9]:
+        time, frame = frames[i]
+        _, output = pipeline.run(frame)
+        expected.append([time.timestamp(), i, *output])
+    np.testing.assert_allclose(np.concatenate(emitted), expected)
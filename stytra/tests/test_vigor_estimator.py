@@ -0,0 +1,62 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from queue import Queue
+from types import SimpleNamespace
+
+import numpy as np
+
+from stytra.collectors import EstimatorLog, QueueDataAccumulator
+from stytra.stimulation.estimators import VigorMotionEstimator
+
+
+def reference_vigor(acc, vigor_window, lag):
+    """ The vigor and frame index computed from the whole accumulator"""
+    t_end = acc.times[-1] - lag
+    i_start, i_end = acc.window_indices(t_end - vigor_window, t_end)
+    if i_end == 0:
+        return 0, None
+    i_start = max(min(i_start, i_end - 2), 0)
+    vigor = np.nanstd(acc["tail_sum"][i_start:i_end])
+    return 0 if np.isnan(vigor) else vigor, acc.frame_indices[i_end - 1]
+
+
+def test_incremental_vigor():
+    t0 = datetime.now()
+    exp = SimpleNamespace(t0=t0, protocol_runner=SimpleNamespace(running=True))
+    exp.estimator_log = EstimatorLog(experiment=exp)
+    queue = Queue()
+    acc = QueueDataAccumulator(experiment=exp, data_queue=queue)
+    estimator = VigorMotionEstimator(acc, experiment=exp, base_gain=1)
+
+    # a tail trace sampled at a jittering rate, with gaps and missing values
+    np.random.seed(0)
+    dts = np.random.uniform(0.001, 0.004, 8000)
+    dts[1000:1010] = 0.05
+    times = np.cumsum(dts)
+    tail = np.cumsum(np.random.normal(0, 0.1, len(times)))
+    tail[np.random.uniform(size=len(times)) < 0.05] = np.nan
+    row = namedtuple("t", ["tail_sum"])
+
+    i_sample = 0
+    for n_new in np.random.randint(0, 20, 400):
+        for _ in range(n_new):
+            queue.put(
+                (
+                    (t0 + timedelta(seconds=times[i_sample]), i_sample),
+                    row(tail[i_sample]),
+                )
+            )
+            i_sample += 1
+        acc.update_list()
+        if acc.is_empty():
+            assert estimator.get_velocity() == 0
+            continue
+        for lag in [0, 0.01, 0.2]:
+            vigor = estimator.get_velocity(lag)
+            expected_vigor, frame_index = reference_vigor(acc, 0.05, lag)
+            np.testing.assert_allclose(vigor, expected_vigor, rtol=1e-9, atol=1e-12)
+            if frame_index is not None:
+                assert estimator.frame_index == frame_index
+
+    # the buffer only keeps the samples needed by the windows
+    assert estimator._i_next - estimator._i_first < 200
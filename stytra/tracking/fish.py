@@ -1,14 +1,11 @@
 import cv2
 import numpy as np
-from numba import jit, int64, float64
-try:
-    from numba.experimental import jitclass
-except ModuleNotFoundError:
-    from numba import jitclass
+from numba import jit, prange
+from scipy.optimize import linear_sum_assignment
 
 
-from stytra.tracking.tail import find_fish_midline
-from stytra.tracking.preprocessing import BackgroundSubtractor
+from stytra.tracking.tail import fish_midline_angles
+from stytra.tracking.preprocessing import BackgroundSubtractor, negdif
 
 from itertools import chain
 
@@ -30,6 +27,8 @@ def _fish_column_names(i_fish, n_segments):
 
 
 class FishTrackingMethod(ImageToDataNode):
+    stateful = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="fish_tracking", **kwargs)
         self.monitored_headers = ["biggest_area", "f0_theta"]
@@ -42,6 +41,14 @@ class FishTrackingMethod(ImageToDataNode):
 
         self.dilation_kernel = np.ones((3, 3), dtype=np.uint8)
         self.fishes = None
+        self._difference = None
+
+        # number of frames in which the whole image was scanned for fish, and
+        # in which only the regions around the tracked fish were searched
+        self.n_full_scans = 0
+        self.n_local_scans = 0
+        self._frames_since_full_scan = 0
+        self._fish_missed = False
 
     def changed(self, vals):
         if any(
@@ -72,6 +79,7 @@ class FishTrackingMethod(ImageToDataNode):
             pred_coef=self._params.prediction_uncertainty,
             angle_std=np.pi / 10,
             persist_fish_for=self._params.persist_fish_for,
+            max_distance=self._params.max_displacement,
         )
 
     def _process(
@@ -79,7 +87,12 @@ class FishTrackingMethod(ImageToDataNode):
         bg,
         n_fish_max: Param(1, (1, 50)),
         n_segments: Param(10, (2, 30)),
-        bg_downsample: Param(1, (1, 8)),
+        bg_downsample: Param(
+            1,
+            (1, 8),
+            desc="Downsampling of the background difference for detecting the "
+            "fish, not used if the background subtraction is downsampled",
+        ),
         bg_dif_threshold: Param(25, (0, 255)),
         threshold_eyes: Param(35, (0, 255)),
         pos_uncertainty: Param(
@@ -93,124 +106,182 @@ class FishTrackingMethod(ImageToDataNode):
             desc="How many frames does the fish persist for if it is not detected",
         ),
         prediction_uncertainty: Param(0.1, (0.0, 10.0, 0.0001)),
+        max_displacement: Param(
+            15.0,
+            (1.0, 200.0),
+            desc="Distance in pixels from its predicted position within which "
+            "a detection can be assigned to a fish, even if it is "
+            "farther than the uncertainty of the prediction",
+        ),
         fish_area: Param((200, 1200), (1, 4000)),
         border_margin: Param(5, (0, 100)),
         tail_length: Param(60.0, (1.0, 200.0)),
         tail_track_window: Param(3, (3, 70)),
+        full_scan_every: Param(
+            1,
+            (1, 1000),
+            desc="Every how many frames the whole image is scanned for fish, "
+            "in between the tracked fish are only searched for around "
+            "their predicted positions",
+        ),
     ):
 
-        # update the previously-detected fish using the Kalman filter
-        if self.fishes is None:
+        if self._output_type is None:
             self.reset()
+
+        # if the background subtraction is done at a lower resolution, the
+        # fish are detected on its output, and the difference at full
+        # resolution is only computed around them
+        if isinstance(self.parent, BackgroundSubtractor) and self.parent.downsample > 1:
+            bg_downsample = self.parent.downsample
+            bg_small = bg
+            full_shape = self.parent.full_resolution_shape
+            full_difference = self.parent.full_resolution_difference
+            if self._difference is None or self._difference.shape != full_shape:
+                self._difference = np.zeros(full_shape, np.uint8)
+            difference = self._difference
         else:
-            self.fishes.predict()
+            # downsample background
+            if bg_downsample > 1:
+                bg_small = cv2.resize(
+                    bg, None, fx=1 / bg_downsample, fy=1 / bg_downsample
+                )
+            else:
+                bg_small = bg
+            full_shape = bg.shape
+            full_difference = None
+            difference = bg
 
         area_scale = bg_downsample * bg_downsample
-        border_margin = border_margin // bg_downsample
 
-        # downsample background
-        if bg_downsample > 1:
-            bg_small = cv2.resize(bg, None, fx=1 / bg_downsample, fy=1 / bg_downsample)
-        else:
-            bg_small = bg
-
-        bg_thresh = cv2.dilate(
-            (bg_small > bg_dif_threshold).view(dtype=np.uint8), self.dilation_kernel
+        # the fish which are already tracked are only searched for around
+        # their predicted positions, and the whole image is scanned every
+        # full_scan_every frames, or if one of them was not found
+        predicted = self._predicted_positions() / bg_downsample
+        border_margin = border_margin // bg_downsample
+        full_scan = (
+            len(predicted) == 0
+            or self._fish_missed
+            or self._frames_since_full_scan + 1 >= full_scan_every
         )
+        if full_scan:
+            bg_thresh = _threshold_difference(
+                bg_small, bg_dif_threshold, self.dilation_kernel
+            )
 
-        # find regions where there is a difference with the background
-        n_comps, labels, stats, centroids = cv2.connectedComponentsWithStats(bg_thresh)
+            # find regions where there is a difference with the background
+            n_comps, labels, stats, centroids = cv2.connectedComponentsWithStats(
+                bg_thresh
+            )
+            stats = stats[1:]
+            self.n_full_scans += 1
+            self._frames_since_full_scan = 0
+        else:
+            bg_thresh = None
+            stats = _local_components(
+                bg_small,
+                predicted,
+                # the window has to contain the whole fish, which can have
+                # moved by up to max_displacement
+                (tail_length + max_displacement) / bg_downsample,
+                bg_dif_threshold,
+                self.dilation_kernel,
+            )
+            self.n_local_scans += 1
+            self._frames_since_full_scan += 1
 
         try:
-            max_area = np.max(stats[1:, cv2.CC_STAT_AREA]) * area_scale
+            max_area = np.max(stats[:, cv2.CC_STAT_AREA]) * area_scale
         except ValueError:
             max_area = 0
 
-        # iterate through all the regions different from the background and try
-        # to find fish
-
         messages = []
 
-        nofish = True
-        for row, centroid in zip(stats, centroids):
-            # check if the contour is fish-sized and central enough
-            if not fish_area[0] < row[cv2.CC_STAT_AREA] * area_scale < fish_area[1]:
-                continue
-
-            # find the bounding box of the fish in the original image coordinates
-            ftop, fleft, fheight, fwidth = (
-                int(round(row[x] * bg_downsample))
-                for x in [
-                    cv2.CC_STAT_TOP,
-                    cv2.CC_STAT_LEFT,
-                    cv2.CC_STAT_HEIGHT,
-                    cv2.CC_STAT_WIDTH,
-                ]
-            )
-
-            if not (
-                (fleft - border_margin >= 0)
-                and (fleft + fwidth + border_margin < bg.shape[1])
-                and (ftop - border_margin >= 0)
-                and (ftop + fheight + border_margin < bg.shape[0])
-            ):
-                messages.append("W:An object of right area found outside margins")
-                continue
-
-            # how much is this region shifted from the upper left corner of the image
-            cent_shift = np.array([fleft - border_margin, ftop - border_margin])
-
-            slices = (
-                slice(ftop - border_margin, ftop + fheight + border_margin),
-                slice(fleft - border_margin, fleft + fwidth + border_margin),
-            )
-
-            # take the region and mask the background away to aid detection
-            fishdet = bg[slices].copy()
+        # the regions different from the background which are fish-sized
+        # and central enough are candidate fish, largest first
+        stats = stats[np.argsort(-stats[:, cv2.CC_STAT_AREA])]
+        stats = stats[
+            (fish_area[0] < stats[:, cv2.CC_STAT_AREA] * area_scale)
+            & (stats[:, cv2.CC_STAT_AREA] * area_scale < fish_area[1])
+        ]
 
-            # estimate the position of the head
-            fish_coords = fish_start(fishdet, threshold_eyes)
+        # find the bounding boxes of the fish in the original image coordinates
+        ftop, fleft, fheight, fwidth = (
+            np.round(stats[:, i_stat] * bg_downsample).astype(np.int64)
+            for i_stat in [
+                cv2.CC_STAT_TOP,
+                cv2.CC_STAT_LEFT,
+                cv2.CC_STAT_HEIGHT,
+                cv2.CC_STAT_WIDTH,
+            ]
+        )
+        inside = (
+            (fleft - border_margin >= 0)
+            & (fleft + fwidth + border_margin < full_shape[1])
+            & (ftop - border_margin >= 0)
+            & (ftop + fheight + border_margin < full_shape[0])
+        )
+        messages.extend(
+            ["W:An object of right area found outside margins"] * int(np.sum(~inside))
+        )
+        boxes = np.stack(
+            [
+                ftop - border_margin,
+                fleft - border_margin,
+                ftop + fheight + border_margin,
+                fleft + fwidth + border_margin,
+            ],
+            axis=1,
+        )[inside]
+
+        # if the difference at full resolution is computed from a downsampled
+        # background, it is only computed in the regions the heads and tails
+        # of the fish can be in
+        reach = int(tail_length + tail_track_window) + 1
+        if full_difference is not None:
+            for top, left, bottom, right in boxes:
+                slices = (
+                    slice(max(top - reach, 0), bottom + reach),
+                    slice(max(left - reach, 0), right + reach),
+                )
+                difference[slices] = full_difference(slices)
+
+        # find the heads and the tails of all the candidates in parallel
+        heads, angles, found = _track_fish_batch(
+            difference,
+            boxes,
+            threshold_eyes,
+            tail_length,
+            tail_track_window,
+            n_segments,
+        )
+        angles = _continuous_angles(angles)
 
-            # if no actual fish was found here, continue on to the next connected component
-            if fish_coords[0] == -1:
+        # the detections are passed on to update_state in the slots of the
+        # output, largest objects first
+        detections = np.full(self.fishes.coords.shape, np.nan)
+        n_detected = 0
+        nofish = True
+        for i_candidate in range(len(boxes)):
+            if found[i_candidate] == _NO_HEAD:
                 messages.append("W:No appropriate tail start position found")
                 continue
-
-            head_coords_up = fish_coords + cent_shift
-
-            theta = _fish_direction_n(bg, head_coords_up, int(round(tail_length / 2)))
-
-            # find the points of the tail
-            points = find_fish_midline(
-                bg,
-                *head_coords_up,
-                theta,
-                tail_track_window,
-                tail_length / n_segments,
-                n_segments + 1,
-            )
-
-            # convert to angles
-            angles = np.mod(points_to_angles(points) + np.pi, np.pi * 2) - np.pi
-            if len(angles) == 0:
+            if found[i_candidate] == _NO_TAIL:
                 messages.append("W:Tail not completely detectable")
                 continue
 
-            # also, make the angles continuous
-            angles[1:] = np.unwrap(angles[1:] - angles[0])
-
-            # put the data together for one fish
-            fish_coords = np.concatenate([np.array(points[0][:2]), angles])
-
             nofish = False
-            # check if this is a new fish, or it is an update of
-            # a fish detected previously
-            if self.fishes.update(fish_coords):
-                messages.append("I:Updated previous fish")
-            elif self.fishes.add_fish(fish_coords):
-                messages.append("I:Added new fish")
-            else:
+            if n_detected == detections.shape[0]:
                 messages.append("E:More fish than n_fish max")
+                continue
+
+            # put the data together for one fish
+            detections[n_detected, 0:6:2] = (
+                *heads[i_candidate],
+                angles[i_candidate, 0],
+            )
+            detections[n_detected, 6:] = angles[i_candidate, 1:]
+            n_detected += 1
 
         if nofish:
             messages.append(
@@ -219,7 +290,18 @@ class FishTrackingMethod(ImageToDataNode):
                 )
             )
 
+        self._fish_missed = not full_scan and n_detected < len(predicted)
+        if self._fish_missed:
+            messages.append("I:Tracked fish not found around its predicted position")
+
         # if a debugging image is to be shown, set it
+        if bg_thresh is None and self.set_diagnostic in (
+            "thresholded background difference",
+            "fish detection",
+        ):
+            bg_thresh = _threshold_difference(
+                bg_small, bg_dif_threshold, self.dilation_kernel
+            )
         if self.set_diagnostic == "background difference":
             self.diagnostic_image = bg
         elif self.set_diagnostic == "thresholded background difference":
@@ -231,108 +313,566 @@ class FishTrackingMethod(ImageToDataNode):
         elif self.set_diagnostic == "thresholded for eye and swim bladder":
             self.diagnostic_image = np.maximum(bg, threshold_eyes) - threshold_eyes
 
+        return NodeOutput(
+            messages, self._output_type(*detections.flatten(), max_area * 1.0)
+        )
+
+    def _predicted_positions(self):
+        """ Positions of the tracked fish in the current frame predicted by
+        their Kalman filters. There are none if the state of the node is
+        updated in another process, as when the tracking is sharded
+        """
+        if self.fishes is None:
+            return np.zeros((0, 2))
+        states = self.fishes.states[~np.isnan(self.fishes.states[:, 0, 0]), :2]
+        return states[:, :, 0] + states[:, :, 1]
+
+    def update_state(self, output):
+        """ Updates the previously-detected fish using the Kalman filter
+        with the detections found in the current frame
+        """
+        messages = list(output.messages)
+        if self.fishes is None:
+            self.reset()
+        else:
+            self.fishes.predict()
+
+        detections = np.array(output.data[:-1]).reshape(self.fishes.coords.shape)
+        detections = detections[~np.isnan(detections[:, 0])]
+
+        # the detections are assigned to the previously detected fish, or
+        # added as new ones
+        fish_indices, added = self.fishes.assign(
+            np.concatenate([detections[:, 0:6:2], detections[:, 6:]], axis=1)
+        )
+        if np.any(~added & (fish_indices >= 0)):
+            messages.append("I:Updated previous fish")
+        if np.any(added):
+            messages.append("I:Added new fish")
+        if np.any(fish_indices == -1):
+            messages.append("E:More fish than n_fish max")
+
+        return NodeOutput(
+            messages,
+            type(output.data)(*self.fishes.coords.flatten(), output.data[-1]),
+        )
+
+
+class MultiWellTrackingMethod(ImageToDataNode):
+    """Tracks one fish in each well of a multi-well plate.
+
+    The plate is a rectangle of the image divided in a grid of equally sized
+    wells. The wells are processed as a stack: the background of each well
+    is learned as the running average of its frames, in a single array for
+    all the wells, and the head and tail of the fish of all the wells are
+    found in a single parallel call. The fish of each well has its own
+    Kalman filter.
+
+    The output has the same columns as the one of
+    :class:`FishTrackingMethod`, the fish of each well in the columns with
+    its index (wells numbered row by row), so that it can be used by the
+    same plots and estimators.
+    """
+
+    stateful = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, name="well_tracking", **kwargs)
+        self.monitored_headers = ["f0_theta"]
+        self.diagnostic_image_options = ["background difference"]
+        self.background = None
+        self.fishes = None
+        self.i = 0
+        self._wells = None
+        self._difference = None
+
+    def changed(self, vals):
+        if any(
+            p in vals.keys()
+            for p in ["n_rows", "n_columns", "n_segments", "plate_pos", "plate_dim"]
+        ) or vals.get("reset", False):
+            self.reset()
+
+    def reset(self):
+        n_wells = self._params.n_rows * self._params.n_columns
+        self._output_type = namedtuple(
+            "t",
+            list(
+                chain.from_iterable(
+                    _fish_column_names(i_well, self._params.n_segments - 1)
+                    for i_well in range(n_wells)
+                )
+            ),
+        )
+        self._output_type_changed = True
+        self.background = None
+        self.fishes = Fishes(
+            n_wells,
+            n_segments=self._params.n_segments - 1,
+            pos_std=self._params.pos_uncertainty,
+            pred_coef=self._params.prediction_uncertainty,
+            angle_std=np.pi / 10,
+            persist_fish_for=self._params.persist_fish_for,
+        )
+
+    def _process(
+        self,
+        im,
+        plate_pos: Param((0, 0), gui=False),
+        plate_dim: Param((600, 400), gui=False),
+        n_rows: Param(4, (1, 16)),
+        n_columns: Param(6, (1, 24)),
+        learning_rate: Param(0.04, (0.0, 1.0)),
+        learn_every: Param(400, (1, 10000)),
+        threshold_eyes: Param(35, (0, 255)),
+        n_segments: Param(10, (2, 30)),
+        tail_length: Param(60.0, (1.0, 200.0)),
+        tail_track_window: Param(3, (3, 70)),
+        pos_uncertainty: Param(
+            1.0,
+            (0, 10.0),
+            desc="Uncertainty in pixels about the location of the head center of mass",
+        ),
+        persist_fish_for: Param(
+            2,
+            (1, 50),
+            desc="How many frames does the fish persist for if it is not detected",
+        ),
+        prediction_uncertainty: Param(0.1, (0.0, 10.0, 0.0001)),
+    ):
+        """
+
+        Parameters
+        ----------
+        im :
+            image (numpy array)
+        plate_pos :
+            position of the top left corner of the plate (x, y)
+        plate_dim :
+            dimensions of the plate (w, h)
+        n_rows :
+            number of rows of wells
+        n_columns :
+            number of columns of wells
+
+        """
         if self._output_type is None:
-            self.reset_state()
+            self.reset()
+        messages = []
 
+        wells, (top, left) = _well_stack(im, plate_pos, plate_dim, n_rows, n_columns)
+        if wells.shape[2] == 0 or wells.shape[3] == 0:
+            return NodeOutput(
+                ["E:Plate outside of the image"],
+                self._output_type(*np.full(self.fishes.coords.size, np.nan)),
+            )
+        n_wells, well_h, well_w = n_rows * n_columns, wells.shape[2], wells.shape[3]
+
+        # the wells are copied to a stack, in which the background of each
+        # well and its difference from it are computed in one go
+        if self._wells is None or self._wells.shape != (n_wells, well_h, well_w):
+            self._wells = np.empty((n_wells, well_h, well_w), np.uint8)
+        np.copyto(self._wells.reshape(wells.shape), wells)
+
+        if self.background is None or self.background.shape != self._wells.shape:
+            self.background = self._wells.astype(np.float32)
+            self._difference = np.empty(self._wells.shape, np.uint8)
+            self.i = 0
+            messages.append("I:New background image set")
+        else:
+            # the backgrounds of a few wells are updated every frame, so
+            # that all of them are updated once every learn_every frames
+            n_updated = -(-n_wells // learn_every)
+            updated = slice(self.i * n_updated, (self.i + 1) * n_updated)
+            if updated.start < n_wells:
+                cv2.accumulateWeighted(
+                    self._wells[updated].reshape(-1, well_w),
+                    self.background[updated].reshape(-1, well_w),
+                    learning_rate,
+                )
+            self.i = (self.i + 1) % learn_every
+        negdif(self.background, self._wells, out=self._difference)
+
+        heads, angles, found = _track_wells_batch(
+            self._difference, threshold_eyes, tail_length, tail_track_window, n_segments
+        )
+        angles = _continuous_angles(angles)
+
+        # the detections are passed on to update_state in the slots of the
+        # output of their wells
+        detections = np.full(self.fishes.coords.shape, np.nan)
+        i_row, i_column = np.divmod(np.arange(n_wells), n_columns)
+        detections[:, 0] = heads[:, 0] + left + i_column * well_w
+        detections[:, 2] = heads[:, 1] + top + i_row * well_h
+        detections[:, 4] = angles[:, 0]
+        detections[:, 6:] = angles[:, 1:]
+
+        n_missing = np.sum(found != _FOUND)
+        if n_missing > 0:
+            messages.append("W:No fish found in {} wells".format(n_missing))
+
+        if self.set_diagnostic == "background difference":
+            self.diagnostic_image = (
+                self._difference.reshape(n_rows, n_columns, well_h, well_w)
+                .transpose(0, 2, 1, 3)
+                .reshape(n_rows * well_h, n_columns * well_w)
+            )
+
+        return NodeOutput(messages, self._output_type(*detections.flatten()))
+
+    def update_state(self, output):
+        """ Updates the Kalman filters of the fish in the wells in which
+        they were detected in the current frame
+        """
+        if self.fishes is None:
+            self.reset()
+        else:
+            self.fishes.predict()
+
+        detections = np.array(output.data).reshape(self.fishes.coords.shape)
+        i_wells = np.flatnonzero(~np.isnan(detections[:, 0]))
+        self.fishes.assign_indexed(
+            i_wells,
+            np.concatenate(
+                [detections[i_wells, 0:6:2], detections[i_wells, 6:]], axis=1
+            ),
+        )
         return NodeOutput(
-            messages, self._output_type(*self.fishes.coords.flatten(), max_area * 1.0)
+            output.messages, type(output.data)(*self.fishes.coords.flatten())
         )
 
 
-spec = [
-    ("n_fish", int64),
-    ("coords", float64[:, :]),
-    ("i_not_updated", int64[:]),
-    ("F", float64[:, :]),
-    ("uncertainties", float64[:]),
-    ("Q", float64[:, :]),
-    ("Ps", float64[:, :, :, :]),
-    ("def_P", float64[:, :, :]),
-    ("persist_fish_for", int64),
-]
+def _well_stack(im, plate_pos, plate_dim, n_rows, n_columns):
+    """ Divides the plate region of the image in wells
+
+    Returns
+    -------
+    a view of the image with the dimensions (n_rows, n_columns,
+    well height, well width), and the top and left of the plate, which is
+    restricted to the image
+
+    """
+    left, top = (max(int(p), 0) for p in plate_pos)
+    right, bottom = (
+        min(int(p) + int(d), size)
+        for p, d, size in zip(plate_pos, plate_dim, im.shape[::-1])
+    )
+    well_h = max(bottom - top, 0) // n_rows
+    well_w = max(right - left, 0) // n_columns
+    plate = im[top : top + n_rows * well_h, left : left + n_columns * well_w]
+    return (
+        plate.reshape(n_rows, well_h, n_columns, well_w).transpose(0, 2, 1, 3),
+        (top, left),
+    )
+
+
+def _threshold_difference(difference, threshold, kernel):
+    """ Regions of the background difference above the threshold, dilated"""
+    return cv2.dilate((difference > threshold).view(dtype=np.uint8), kernel)
+
+
+def _local_components(difference, positions, radius, threshold, kernel):
+    """ Finds the regions different from the background in square windows
+    around the given positions
+
+    Parameters
+    ----------
+    difference : np.ndarray
+        background difference image
+    positions : np.ndarray (n_positions, 2)
+        x and y centers of the windows
+    radius : float
+        half-size of the windows
+    threshold : int
+        threshold of the background difference
+    kernel : np.ndarray
+        dilation kernel
+
+    Returns
+    -------
+    the stats of the regions, as returned by cv2.connectedComponentsWithStats,
+    in the coordinates of the whole image
+
+    """
+    stats = []
+    found = set()
+    for x, y in positions:
+        top, left = (max(int(c - radius), 0) for c in (y, x))
+        bottom, right = (
+            min(int(c + radius) + 1, size) for c, size in zip((y, x), difference.shape)
+        )
+        if bottom <= top or right <= left:
+            continue
+        window = difference[top:bottom, left:right]
+        _, _, window_stats, _ = cv2.connectedComponentsWithStats(
+            _threshold_difference(window, threshold, kernel)
+        )
+        for row in window_stats[1:]:
+            # the regions cut by the edges of the window are left out, as
+            # they are found whole in the window of the fish they belong to
+            if (
+                (row[cv2.CC_STAT_LEFT] == 0 and left > 0)
+                or (row[cv2.CC_STAT_TOP] == 0 and top > 0)
+                or (
+                    row[cv2.CC_STAT_LEFT] + row[cv2.CC_STAT_WIDTH] == window.shape[1]
+                    and right < difference.shape[1]
+                )
+                or (
+                    row[cv2.CC_STAT_TOP] + row[cv2.CC_STAT_HEIGHT] == window.shape[0]
+                    and bottom < difference.shape[0]
+                )
+            ):
+                continue
+            row = row.copy()
+            row[cv2.CC_STAT_LEFT] += left
+            row[cv2.CC_STAT_TOP] += top
+            # windows can overlap and contain the same region
+            if tuple(row) not in found:
+                found.add(tuple(row))
+                stats.append(row)
+    return np.array(stats, dtype=np.int32).reshape(-1, cv2.CC_STAT_MAX)
+
+
+class Fishes:
+    """Kalman filters of the positions and orientations of the tracked fish,
+    which are predicted and updated for all the fish together.
+
+    The detections of each frame are assigned to the fish by solving the
+    linear sum assignment of their Mahalanobis distances from the predicted
+    fish. A detection can be assigned to a fish if it is inside the gate
+    given by the covariance of the prediction, or closer than max_distance
+    pixels and 90 degrees to it.
+
+    Parameters
+    ----------
+    n_fish_max : int
+        maximal number of fish
+    pos_std : float
+        uncertainty of the position, in pixels
+    angle_std : float
+        uncertainty of the orientation, in radians
+    n_segments : int
+        number of tail angles
+    pred_coef : float
+        scaling of the process noise
+    persist_fish_for : int
+        number of frames for which a fish which is not detected is kept
+    max_distance : float
+        maximal distance in pixels for a detection outside of the gate
+        to be assigned to a fish
+    gate : float
+        maximal squared Mahalanobis distance of a detection from a fish it is
+        assigned to, by default the 99.9th percentile of the chi-squared
+        distribution with 3 degrees of freedom
 
+    """
 
-@jitclass(spec)
-class Fishes(object):
     def __init__(
-        self, n_fish_max, pos_std, angle_std, n_segments, pred_coef, persist_fish_for
+        self,
+        n_fish_max,
+        pos_std,
+        angle_std,
+        n_segments,
+        pred_coef,
+        persist_fish_for,
+        max_distance=15.0,
+        gate=16.27,
     ):
         self.n_fish = n_fish_max
-        self.coords = np.full((n_fish_max, 6 + n_segments), np.nan)
-        self.uncertainties = np.array((pos_std, angle_std, angle_std))
+        # the (position, velocity) states of x, y and theta of the fish
+        self.states = np.full((n_fish_max, 3, 2), np.nan)
+        self.tail_angles = np.full((n_fish_max, n_segments), np.nan)
+        self.uncertainties = np.array((pos_std, pos_std, angle_std))
         self.def_P = np.zeros((3, 2, 2))
-        for i, uc in enumerate(self.uncertainties):
-            self.def_P[i, 0, 0] = uc
-            self.def_P[i, 1, 1] = uc
+        self.def_P[:, 0, 0] = self.uncertainties
+        self.def_P[:, 1, 1] = self.uncertainties
         self.i_not_updated = np.zeros(n_fish_max, dtype=np.int64)
         self.Ps = np.zeros((n_fish_max, 3, 2, 2))
         self.F = np.array([[1.0, 1.0], [0.0, 1.0]])
         dt = 0.02
         self.Q = (
-            np.array([[0.25 * dt ** 4, 0.5 * dt ** 3], [0.5 * dt ** 3, dt ** 2]])
-            * pred_coef
+            np.array([[0.25 * dt**4, 0.5 * dt**3], [0.5 * dt**3, dt**2]]) * pred_coef
         )
         self.persist_fish_for = persist_fish_for
+        self.max_distance = max_distance
+        self.gate = gate
+
+    @property
+    def coords(self):
+        """ x, vx, y, vy, theta, vtheta and the tail angles of the fish """
+        return np.concatenate(
+            [self.states.reshape(self.n_fish, 6), self.tail_angles], axis=1
+        )
 
     def predict(self):
-        for i_fish in range(self.n_fish):
-            if not np.isnan(self.coords[i_fish, 0]):
-                for i_coord in range(0, 6, 2):
-                    predict_inplace(
-                        self.coords[i_fish, i_coord : i_coord + 2],
-                        self.Ps[i_fish, i_coord // 2],
-                        self.F,
-                        self.Q,
-                    )
-                self.i_not_updated[i_fish] += 1
-                if self.i_not_updated[i_fish] > self.persist_fish_for:
-                    self.coords[i_fish, :] = np.nan
+        i_fish = np.flatnonzero(~np.isnan(self.states[:, 0, 0]))
+        predict_inplace(
+            self.states.reshape(-1, 2),
+            self.Ps.reshape(-1, 2, 2),
+            self.F,
+            self.Q,
+            _state_indices(i_fish),
+        )
+        self.i_not_updated[i_fish] += 1
+        lost = i_fish[self.i_not_updated[i_fish] > self.persist_fish_for]
+        self.states[lost] = np.nan
+        self.tail_angles[lost] = np.nan
+
+    def match(self, detections):
+        """ Finds which detections can be assigned to which fish
+
+        Parameters
+        ----------
+        detections : np.ndarray (n_detections, 3 + n_segments)
+            x, y, theta and tail angles of the detections
+
+        Returns
+        -------
+        indices of the fish and of the detections assigned to them,
+        and the differences between them in x, y and theta
+
+        """
+        i_fish = np.flatnonzero(~np.isnan(self.states[:, 0, 0]))
+        costs, allowed, difs = _assignment_costs(
+            self.states,
+            self.Ps,
+            self.uncertainties,
+            detections,
+            i_fish,
+            self.max_distance,
+            self.gate,
+        )
+        # the assignments which are not allowed are only chosen if there is
+        # nothing else, and discarded afterwards
+        rows, cols = linear_sum_assignment(np.where(allowed, costs, 1e12))
+        valid = allowed[rows, cols]
+        rows, cols = rows[valid], cols[valid]
+        return i_fish[rows], cols, difs[rows, cols]
 
     def update(self, new_fish):
-        for i_fish in range(self.n_fish):
-            if not np.isnan(self.coords[i_fish, 0]):
-                if self.is_close(new_fish, i_fish) and self.i_not_updated[i_fish] != 0:
-                    # update position with Kalman filtering
-                    for i_coord in range(0, 3):
-                        # if it is the angle find the modulo 2pi closest
-                        nc = new_fish[i_coord]
-                        if i_coord == 2:
-                            nc = _minimal_angle_dif(self.coords[i_fish, 4], nc)
-                        update_inplace(
-                            nc,
-                            self.coords[i_fish, i_coord * 2 : i_coord * 2 + 2],
-                            self.Ps[i_fish, i_coord],
-                            self.uncertainties[i_coord],
-                        )
-                    # update tail angles
-                    self.coords[i_fish, 6:] = new_fish[3:]
-                    self.i_not_updated[i_fish] = 0
-                    return True
+        """ Updates the fish a single detection can be assigned to
+
+        Returns
+        -------
+        True if the detection was assigned to a fish
 
-    def add_fish(self, new_fish):
-        for i_fish in range(self.n_fish):
-            if np.isnan(self.coords[i_fish, 0]):
-                self.coords[i_fish, 0:6:2] = new_fish[:3]
-                self.coords[i_fish, 1:6:2] = 0.0
-                self.coords[i_fish, 6:] = new_fish[3:]
-                self.Ps[i_fish] = self.def_P
-                self.i_not_updated[i_fish] = 0
-                return True
-        return False
-
-    def is_close(self, new_fish, i_fish):
-        """ Check whether the new coordinates are
-        within a certain number of pixels of the old estimate
-        and within a certain angle
         """
-        n_px = 15
-        d_theta = np.pi / 2
-        dists = new_fish[:2] - self.coords[i_fish, 0:4:2]
-        dtheta = np.abs(
-            np.mod(new_fish[2] - self.coords[i_fish, 4] + np.pi, np.pi * 2) - np.pi
+        i_fish, _, difs = self.match(new_fish[None, :])
+        self._update(i_fish, new_fish[None, :], difs)
+        return len(i_fish) > 0
+
+    def _update(self, i_fish, detections, difs):
+        # the measured theta is the one closest to the prediction modulo 2pi
+        update_inplace(
+            (self.states[i_fish, :, 0] + difs).ravel(),
+            self.states.reshape(-1, 2),
+            self.Ps.reshape(-1, 2, 2),
+            np.tile(self.uncertainties, len(i_fish)),
+            _state_indices(i_fish),
         )
+        self.tail_angles[i_fish] = detections[:, 3:]
+        self.i_not_updated[i_fish] = 0
 
-        return np.sum(dists ** 2) < n_px ** 2 and dtheta < d_theta
+    def add_fish(self, new_fish):
+        """ Adds a new fish, returns False if there is no room for it """
+        return len(self._add(new_fish[None, :])) > 0
+
+    def _add(self, detections, i_fish=None):
+        if i_fish is None:
+            i_fish = np.flatnonzero(np.isnan(self.states[:, 0, 0]))[: len(detections)]
+            detections = detections[: len(i_fish)]
+        self.states[i_fish, :, 0] = detections[:, :3]
+        self.states[i_fish, :, 1] = 0.0
+        self.tail_angles[i_fish] = detections[:, 3:]
+        self.Ps[i_fish] = self.def_P
+        self.i_not_updated[i_fish] = 0
+        return i_fish
+
+    def assign(self, detections):
+        """ Updates the fish with the detections of a frame, and adds the
+        detections which are not assigned to any fish as new fish
+
+        Parameters
+        ----------
+        detections : np.ndarray (n_detections, 3 + n_segments)
+            x, y, theta and tail angles of the detections
+
+        Returns
+        -------
+        the index of the fish each detection was assigned to, -1 if there
+        was no room for a new one, and whether it is a new fish
+
+        """
+        fish_indices = np.full(len(detections), -1)
+        added = np.zeros(len(detections), np.bool_)
+
+        i_fish, i_detections, difs = self.match(detections)
+        self._update(i_fish, detections[i_detections], difs)
+        fish_indices[i_detections] = i_fish
+
+        i_new = np.flatnonzero(fish_indices == -1)
+        i_fish = self._add(detections[i_new])
+        fish_indices[i_new[: len(i_fish)]] = i_fish
+        added[i_new[: len(i_fish)]] = True
+        return fish_indices, added
+
+    def assign_indexed(self, i_fish, detections):
+        """ Updates the given fish with their detections, or adds them if
+        they are not tracked, for when the identity of the fish is known
+        (e.g. when each one is in its own well)
+
+        Parameters
+        ----------
+        i_fish : np.ndarray (n_detections,)
+            indices of the fish
+        detections : np.ndarray (n_detections, 3 + n_segments)
+            x, y, theta and tail angles of the detections
+
+        Returns
+        -------
+        whether each detection is a new fish
+
+        """
+        added = np.isnan(self.states[i_fish, 0, 0])
+        i_tracked = i_fish[~added]
+        difs = detections[~added, :3] - self.states[i_tracked, :, 0]
+        difs[:, 2] = np.mod(difs[:, 2] + np.pi, np.pi * 2) - np.pi
+        self._update(i_tracked, detections[~added], difs)
+        self._add(detections[added], i_fish[added])
+        return added
+
+
+def _state_indices(i_fish):
+    """ Indices of the x, y and theta states of the fish, in the array of
+    all the states"""
+    return (i_fish[:, None] * 3 + np.arange(3)).ravel()
+
+
+@jit(nopython=True, cache=True)
+def _assignment_costs(
+    states, Ps, uncertainties, detections, i_fish, max_distance, gate
+):
+    """ Squared Mahalanobis distances of the detections from the predicted
+    fish, whether they can be assigned to them and their differences in
+    x, y and theta, for :meth:`Fishes.match`
+    """
+    costs = np.zeros((len(i_fish), len(detections)))
+    allowed = np.zeros((len(i_fish), len(detections)), np.bool_)
+    difs = np.empty((len(i_fish), len(detections), 3))
+    for j in range(len(i_fish)):
+        i = i_fish[j]
+        for k in range(len(detections)):
+            for i_coord in range(3):
+                dif = detections[k, i_coord] - states[i, i_coord, 0]
+                if i_coord == 2:
+                    dif = np.mod(dif + np.pi, np.pi * 2) - np.pi
+                difs[j, k, i_coord] = dif
+                costs[j, k] += dif**2 / (Ps[i, i_coord, 0, 0] + uncertainties[i_coord])
+            allowed[j, k] = costs[j, k] < gate or (
+                difs[j, k, 0] ** 2 + difs[j, k, 1] ** 2 < max_distance**2
+                and abs(difs[j, k, 2]) < np.pi / 2
+            )
+    return costs, allowed, difs
 
 
 @jit(nopython=True)
@@ -343,6 +883,149 @@ def points_to_angles(points):
     return angles
 
 
+_FOUND = 0
+_NO_HEAD = 1
+_NO_TAIL = 2
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _track_fish_batch(
+    difference, boxes, threshold_eyes, tail_length, tail_track_window, n_segments
+):
+    """ Finds the heads and the tail angles of the candidate fish, in parallel
+
+    Parameters
+    ----------
+    difference : np.ndarray
+        background difference image, at full resolution
+    boxes : np.ndarray (n_candidates, 4)
+        top, left, bottom and right of the regions of the candidates
+    threshold_eyes : int
+        threshold of the difference for finding the head
+    tail_length : float
+        length of the tail in pixels
+    tail_track_window : int
+        size of the window for finding the tail segments
+    n_segments : int
+        number of tail segments
+
+    Returns
+    -------
+    the x and y of the heads, the angles of the tail segments, and
+    whether the fish were found (_FOUND), or their head (_NO_HEAD) or tail
+    (_NO_TAIL) were not
+
+    """
+    heads = np.full((len(boxes), 2), np.nan)
+    angles = np.full((len(boxes), n_segments), np.nan)
+    found = np.full(len(boxes), _FOUND)
+    for i in prange(len(boxes)):
+        found[i] = _track_fish(
+            difference,
+            boxes[i, 0],
+            boxes[i, 1],
+            boxes[i, 2],
+            boxes[i, 3],
+            threshold_eyes,
+            tail_length,
+            tail_track_window,
+            heads[i],
+            angles[i],
+        )
+    return heads, angles, found
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _track_wells_batch(
+    differences, threshold_eyes, tail_length, tail_track_window, n_segments
+):
+    """ Same as :func:`_track_fish_batch`, for one fish in each of a stack of
+    background difference images of the wells of a plate, with the heads in
+    the coordinates of the wells
+    """
+    heads = np.full((len(differences), 2), np.nan)
+    angles = np.full((len(differences), n_segments), np.nan)
+    found = np.full(len(differences), _FOUND)
+    for i in prange(len(differences)):
+        found[i] = _track_fish(
+            differences[i],
+            0,
+            0,
+            differences.shape[1],
+            differences.shape[2],
+            threshold_eyes,
+            tail_length,
+            tail_track_window,
+            heads[i],
+            angles[i],
+        )
+    return heads, angles, found
+
+
+@jit(nopython=True, cache=True)
+def _track_fish(
+    difference,
+    top,
+    left,
+    bottom,
+    right,
+    threshold_eyes,
+    tail_length,
+    tail_track_window,
+    head_out,
+    angles_out,
+):
+    """ Finds the head and the tail angles of a fish in a region of the
+    background difference, writing them to head_out and angles_out
+
+    Returns
+    -------
+    whether the fish was found (_FOUND), or its head (_NO_HEAD) or tail
+    (_NO_TAIL) were not
+
+    """
+    # estimate the position of the head
+    head = fish_start(difference[top:bottom, left:right], threshold_eyes)
+    if head[0] == -1:
+        return _NO_HEAD
+    head[0] += left
+    head[1] += top
+
+    # the tail is searched for in the region it can reach from the head
+    reach = int(tail_length + tail_track_window) + 1
+    head_x, head_y = int(head[0]), int(head[1])
+    region_top, region_left = max(head_y - reach, 0), max(head_x - reach, 0)
+    tail_region = difference[
+        region_top : head_y + reach + 1, region_left : head_x + reach + 1
+    ]
+    head_region = head - np.array([region_left, region_top])
+
+    theta = _fish_direction_n(tail_region, head_region, int(round(tail_length / 2)))
+    if not fish_midline_angles(
+        tail_region,
+        head_region[0],
+        head_region[1],
+        theta,
+        tail_track_window,
+        tail_length / len(angles_out),
+        angles_out,
+    ):
+        angles_out[:] = np.nan
+        return _NO_TAIL
+    head_out[:] = head
+    return _FOUND
+
+
+def _continuous_angles(angles):
+    """ Wraps the tail angles of the fish (n_fish, n_segments) to (-pi, pi),
+    and makes the angles of the tail segments relative to the first one
+    and continuous
+    """
+    angles = np.mod(angles + np.pi, np.pi * 2) - np.pi
+    angles[:, 1:] = np.unwrap(angles[:, 1:] - angles[:, :1], axis=1)
+    return angles
+
+
 @jit(nopython=True)
 def fish_start(mask, take_min):
     su = 0.0
@@ -365,18 +1048,20 @@ def fish_start(mask, take_min):
 # Utilities for drawing circles.
 
 
-@jit(nopython=True)
-def _symmetry_points(x0, y0, x, y):
-    return [
-        (x0 + x, y0 + y),
-        (x0 - x, y0 + y),
-        (x0 + x, y0 - y),
-        (x0 - x, y0 - y),
-        (x0 + y, y0 + x),
-        (x0 - y, y0 + x),
-        (x0 + y, y0 - x),
-        (x0 - y, y0 - x),
+# signs of the x and y offsets of the symmetric points of a circle, and whether
+# they are swapped, for each octant
+_OCTANTS = np.array(
+    [
+        [1, 1, 0],
+        [-1, 1, 0],
+        [1, -1, 0],
+        [-1, -1, 0],
+        [1, 1, 1],
+        [-1, 1, 1],
+        [1, -1, 1],
+        [-1, -1, 1],
     ]
+)
 
 
 @jit(nopython=True)
@@ -391,20 +1076,23 @@ def _circle_points(x0, y0, radius):
 
     Returns
     -------
-    a list of points
+    an array of the x and y coordinates of the points
 
     """
+    points = np.empty((4 + 8 * (radius + 1), 2), np.int64)
+    points[:2, 0] = x0
+    points[0, 1] = y0 + radius
+    points[1, 1] = y0 - radius
+    points[2, 0] = x0 + radius
+    points[3, 0] = x0 - radius
+    points[2:4, 1] = y0
+    n_points = 4
+
     f = 1 - radius
     ddf_x = 1
     ddf_y = -2 * radius
     x = 0
     y = radius
-    points = [
-        (x0, y0 + radius),
-        (x0, y0 - radius),
-        (x0 + radius, y0),
-        (x0 - radius, y0),
-    ]
     while x < y:
         if f >= 0:
             y -= 1
@@ -413,15 +1101,18 @@ def _circle_points(x0, y0, radius):
         x += 1
         ddf_x += 2
         f += ddf_x
-        points.extend(_symmetry_points(x0, y0, x, y))
-    return points
+        for sx, sy, swap in _OCTANTS:
+            points[n_points, 0] = x0 + sx * (y if swap else x)
+            points[n_points, 1] = y0 + sy * (x if swap else y)
+            n_points += 1
+    return points[:n_points]
 
 
 @jit(nopython=True)
 def _fish_direction_n(image, start_loc, radius):
     centre_int = start_loc.astype(np.int16)
     pixels_rad = _circle_points(centre_int[0], centre_int[1], radius)
-    max_point = pixels_rad[0]
+    max_x, max_y = pixels_rad[0]
     max_val = 0
     h, w = image.shape
     for x, y in pixels_rad:
@@ -429,10 +1120,5 @@ def _fish_direction_n(image, start_loc, radius):
             continue
         if image[y, x] > max_val:
             max_val = image[y, x]
-            max_point = (x, y)
-    return np.arctan2(max_point[1] - centre_int[1], max_point[0] - centre_int[0])
-
-
-@jit(nopython=True)
-def _minimal_angle_dif(th_old, th_new):
-    return th_old + np.mod(th_new - th_old + np.pi, np.pi * 2) - np.pi
+            max_x, max_y = x, y
+    return np.arctan2(max_y - centre_int[1], max_x - centre_int[0])
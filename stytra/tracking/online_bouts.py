@@ -1,8 +1,21 @@
 from collections import namedtuple
 from numba import jit
+from lightparam import Param
+import numpy as np
+
+from stytra.tracking.pipelines import EventNode, NodeOutput
+from stytra.utilities import reduce_to_pi
 
 BoutState = namedtuple("BoutState", "state vel i_inbout i_below n_after")
 
+BoutEvent = namedtuple(
+    "BoutEvent", "event i_fish start_index n_frames x y theta dx dy dtheta peak_vel"
+)
+
+BOUT_STARTED = 1
+BOUT_ENDED = 2
+BOUT_DISCARDED = 3
+
 
 @jit(nopython=True)
 def _process_input(
@@ -97,3 +110,194 @@ def find_bouts_online(
             bout_finished = True
         state = next_state
     return bout_coords, bout_finished, state
+
+
+@jit(nopython=True, cache=True)
+def _update_bout_states(
+    vels, states, threshold, n_without_crossing, pad_after, min_bout_len, transitions
+):
+    """ Advances the bout detection of multiple fish by one frame
+
+    Parameters
+    ----------
+    vels : np.ndarray
+        the velocity of each fish
+    states : np.ndarray
+        n_fish x 5 array with the BoutStates of the fish, updated in place
+    transitions : np.ndarray
+        output, for each fish 0 if nothing happened, or BOUT_STARTED,
+        BOUT_ENDED or BOUT_DISCARDED (if the bout was shorter than
+        min_bout_len)
+
+    """
+    for i in range(len(vels)):
+        prev = BoutState(
+            int(states[i, 0]),
+            states[i, 1],
+            int(states[i, 2]),
+            int(states[i, 3]),
+            int(states[i, 4]),
+        )
+        nxt = _process_input(
+            vels[i],
+            prev,
+            threshold=threshold,
+            n_without_crossing=n_without_crossing,
+            pad_after=pad_after,
+            min_bout_len=min_bout_len,
+        )
+        transitions[i] = 0
+        if prev.state != 1 and nxt.state == 1:
+            transitions[i] = BOUT_STARTED
+        elif prev.state == 2 and nxt.state == 3:
+            transitions[i] = BOUT_ENDED
+        elif prev.state == 2 and nxt.state == 0:
+            transitions[i] = BOUT_DISCARDED
+        states[i, 0] = nxt.state
+        states[i, 1] = nxt.vel
+        states[i, 2] = nxt.i_inbout
+        states[i, 3] = nxt.i_below
+        states[i, 4] = nxt.n_after
+
+
+class BoutDetectorNode(EventNode):
+    """ Detects bouts online, in the tracking process, from the output of a
+    :class:`FishTrackingMethod <stytra.tracking.fish.FishTrackingMethod>`
+    (for each fish, from the squared displacement of its position)
+    or of a :class:`CentroidTrackingMethod
+    <stytra.tracking.tail.CentroidTrackingMethod>` (from the squared change
+    of the cumulative tail angle).
+
+    A BoutEvent is emitted at the start of each bout, with the pose of the
+    fish before the bout, and at its end, with the pose before the bout,
+    its change over the bout and the peak velocity. For the tail, theta is
+    the cumulative tail angle and the position is not defined.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, name="bout_detection", **kwargs)
+        self._fields = None
+        self._coord_columns = None
+        self._pose_index = None
+        self._wrap_angle = False
+        self.reset()
+
+    def reset(self):
+        self._fields = None
+        self._states = None
+
+    def _map_columns(self, fields):
+        """ Finds the columns of the fish or of the tail in the input,
+        returns False if there are none
+        """
+        self._fields = fields
+        # an index past the last column points to a NaN value
+        i_missing = len(fields)
+        field_index = {f: i for i, f in enumerate(fields)}
+        n_fish = 0
+        while "f{:d}_x".format(n_fish) in field_index:
+            n_fish += 1
+        if n_fish > 0:
+            self._pose_index = np.array(
+                [
+                    [field_index["f{:d}_{}".format(i, c)] for c in ("x", "y", "theta")]
+                    for i in range(n_fish)
+                ]
+            )
+            self._coord_columns = [0, 1]
+            self._wrap_angle = True
+        elif "tail_sum" in field_index:
+            n_fish = 1
+            self._pose_index = np.array(
+                [[i_missing, i_missing, field_index["tail_sum"]]]
+            )
+            self._coord_columns = [2]
+            self._wrap_angle = False
+        else:
+            self._states = None
+            return False
+
+        self._states = np.zeros((n_fish, 5))
+        self._transitions = np.zeros(n_fish, np.int64)
+        self._previous_pose = np.full((n_fish, 3), np.nan)
+        self._start_pose = np.full((n_fish, 3), np.nan)
+        self._start_index = np.full(n_fish, -1, np.int64)
+        self._peak_vel = np.zeros(n_fish)
+        return True
+
+    def _process(
+        self,
+        data,
+        frame_index,
+        threshold: Param(0.2, (0.01, 5.0)),
+        n_without_crossing: Param(5, (0, 10)),
+        pad_after: Param(5, (0, 20)),
+        min_bout_len: Param(1, (1, 30)),
+        **extraparams
+    ):
+        messages = []
+        if data._fields != self._fields:
+            if not self._map_columns(data._fields):
+                messages.append("W:No fish or tail found for bout detection")
+        if self._states is None:
+            return NodeOutput(messages, [])
+
+        values = np.array(tuple(data) + (np.nan,), np.float64)
+        pose = values[self._pose_index]
+        vel = np.sum(
+            (pose[:, self._coord_columns] - self._previous_pose[:, self._coord_columns])
+            ** 2,
+            1,
+        )
+        # lost fish are considered still
+        vel[~np.isfinite(vel)] = 0
+        _update_bout_states(
+            vel,
+            self._states,
+            threshold,
+            n_without_crossing,
+            pad_after,
+            min_bout_len,
+            self._transitions,
+        )
+        in_bout = (self._states[:, 0] == 1) | (self._states[:, 0] == 2)
+        self._peak_vel[in_bout] = np.maximum(self._peak_vel[in_bout], vel[in_bout])
+
+        events = []
+        for i_fish in np.flatnonzero(self._transitions):
+            transition = self._transitions[i_fish]
+            if transition == BOUT_STARTED:
+                self._start_pose[i_fish] = self._previous_pose[i_fish]
+                self._start_index[i_fish] = -1 if frame_index is None else frame_index
+                self._peak_vel[i_fish] = vel[i_fish]
+                events.append(
+                    BoutEvent(
+                        BOUT_STARTED,
+                        int(i_fish),
+                        int(self._start_index[i_fish]),
+                        1,
+                        *self._start_pose[i_fish],
+                        np.nan,
+                        np.nan,
+                        np.nan,
+                        vel[i_fish],
+                    )
+                )
+            else:
+                change = pose[i_fish] - self._start_pose[i_fish]
+                if self._wrap_angle:
+                    change[2] = reduce_to_pi(change[2])
+                events.append(
+                    BoutEvent(
+                        int(transition),
+                        int(i_fish),
+                        int(self._start_index[i_fish]),
+                        int(self._states[i_fish, 2]),
+                        *self._start_pose[i_fish],
+                        *change,
+                        self._peak_vel[i_fish],
+                    )
+                )
+        self._previous_pose = pose
+        return NodeOutput(messages, events)
@@ -3,12 +3,23 @@ from anytree import PreOrderIter, Node, Resolver
 from multiprocessing import Queue
 from collections import namedtuple
 from itertools import chain
+from time import perf_counter_ns
+import numpy as np
 
 
 NodeOutput = namedtuple("NodeOutput", "messages data")
 
 
 class PipelineNode(Node):
+    stateful = False
+    """ Set to True if the output of the node depends on the frames having
+    been processed in order. The order-dependent part of the processing has
+    to be implemented in :meth:`update_state`, so that, when the tracking is
+    split over multiple processes, :meth:`_process` can run in any of them
+    and :meth:`update_state` is run by a single process, in frame order.
+    Stateful nodes have to be ImageToDataNodes.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._params = None
@@ -47,6 +58,13 @@ class PipelineNode(Node):
     def _process(self, *inputs, set_diagnostic=None, **kwargs) -> NodeOutput:
         return NodeOutput([], None)
 
+    def update_state(self, output: NodeOutput) -> NodeOutput:
+        """ Applies the order-dependent part of the processing (e.g. Kalman
+        filtering or temporal smoothing) to the output of :meth:`_process`.
+        Only called for stateful nodes.
+        """
+        return output
+
 
 class ImageToImageNode(PipelineNode):
     def __init__(self, *args, **kwargs):
@@ -92,6 +110,66 @@ class ImageToDataNode(PipelineNode):
         return None
 
 
+class EventNode(PipelineNode):
+    """ A node which follows an ImageToDataNode and detects discrete events
+    (e.g. the start and end of bouts) in the output of the pipeline.
+
+    Event nodes are not run together with the other nodes, but through
+    :meth:`Pipeline.detect_events`, after the stateful nodes have been
+    updated, in frame order. Their :meth:`_process` receives the whole
+    output of the pipeline and the index of the frame, and returns the list
+    of detected events as data.
+    """
+
+    def _process(self, data, frame_index, **kwargs) -> NodeOutput:
+        return NodeOutput([], [])
+
+
+class PipelineProfiler:
+    """ Keeps the time spent in each node of a compiled pipeline for the
+    last n_frames frames in a ring buffer, from which percentiles can be
+    computed.
+
+    Parameters
+    ----------
+    node_names : list of str
+        names of the nodes, in the order of the compiled plan
+    n_frames : int
+        number of frames kept
+
+    """
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, node_names, n_frames=1000):
+        self.node_names = list(node_names) + ["total"]
+        # times in nanoseconds, the last column is for the whole pipeline
+        self.times = np.zeros((n_frames, len(self.node_names)), np.int64)
+        self.i_frame = 0
+        self.n_recorded = 0
+
+    @property
+    def current(self):
+        return self.times[self.i_frame]
+
+    def advance(self, total_time):
+        self.times[self.i_frame, -1] = total_time
+        self.i_frame = (self.i_frame + 1) % self.times.shape[0]
+        self.n_recorded = min(self.n_recorded + 1, self.times.shape[0])
+
+    def summary(self):
+        """ Returns a dictionary with the percentiles of the time spent
+        in each node, in microseconds
+        """
+        if self.n_recorded == 0:
+            return dict()
+        percs = (
+            np.percentile(self.times[: self.n_recorded], self.percentiles, axis=0)
+            / 1000
+        )
+        return {name: tuple(percs[:, i]) for i, name in enumerate(self.node_names)}
+
+
 class Pipeline:
     def __init__(self):
         self.root = SourceNode()
@@ -105,6 +183,23 @@ class Pipeline:
         self._param_finder = Resolver()
         self.node_dict = dict()
 
+        self._state_input_type = None
+        self._state_indexes = []
+
+        self.event_nodes = []
+
+        self._plan = None
+        self._plan_params = []
+        self._plan_slots = []
+        self._plan_data_slots = []
+        self._plan_data_nodes = []
+
+        self.profiler = None
+
+    @property
+    def stateful_nodes(self):
+        return [node for node in PreOrderIter(self.root) if node.stateful]
+
     @property
     def headers_to_plot(self):
         hds = []
@@ -120,6 +215,10 @@ class Pipeline:
         """
         diag_images = []
         for node in PreOrderIter(self.root):
+            if node.stateful and not isinstance(node, ImageToDataNode):
+                raise TypeError(
+                    "Stateful node " + node.name + " has to be an ImageToDataNode"
+                )
             node.setup()
             if node._params is not None:
                 self.all_params[node.strpath] = node._params
@@ -132,6 +231,9 @@ class Pipeline:
                     for imname in node.diagnostic_image_options
                 )
             )
+        self.event_nodes = [
+            node for node in PreOrderIter(self.root) if isinstance(node, EventNode)
+        ]
         self.all_params["diagnostics"] = Parametrized(
             name="tracking/diagnostics",
             params=dict(image=Param("unprocessed", ["unprocessed"] + diag_images)),
@@ -181,18 +283,23 @@ class Pipeline:
                     ].set_diagnostic = imname.split("/")[-1]
                 except KeyError:  # this can happen on reloading if the pipeline is changed
                     self.all_params["diagnostics"].image = "unprocessed"
+        if self._plan is not None:
+            self._refresh_plan_params()
         # reset group always exists, checks if there are actual changes (the second and)
         if "reset" in rec_params.keys() and "reset" in rec_params["reset"].keys():
             for node in self.node_dict.values():
                 node.reset()
 
-    def recursive_run(self, node: PipelineNode, *input_data):
+    def recursive_run(self, node: PipelineNode, *input_data, defer_state=False):
         output = node.process(*input_data)
         if isinstance(node, ImageToDataNode):
+            if node.stateful and not defer_state:
+                output = node.update_state(output)
             return output
 
         child_outputs = tuple(
-            self.recursive_run(child, output.data) for child in node.children
+            self.recursive_run(child, output.data, defer_state=defer_state)
+            for child in node.children
         )
         if node._output_type is None or node.output_type_changed:
             node._output_type = namedtuple(
@@ -213,7 +320,191 @@ class Pipeline:
             output_tuple,
         )
 
-    def run(self, input):
-        out = self.recursive_run(self.root, input)
+    def compile(self):
+        """ Flattens the node tree into a list of steps which are run in
+        sequence, instead of recursing through the tree for every frame.
+        The output of each node is kept in a preallocated slot, from which
+        its children read their input, and the parameter values of the nodes
+        are cached until they are changed through :meth:`deserialize_params`.
+        After compiling, :meth:`run` uses the compiled plan. Event nodes
+        are not part of the plan, see :meth:`detect_events`.
+
+        """
+        nodes = [
+            node for node in PreOrderIter(self.root) if not isinstance(node, EventNode)
+        ]
+        slot_index = {node: i for i, node in enumerate(nodes)}
+        # the last slot holds the input of the pipeline
+        self._plan = [
+            (node, slot_index.get(node.parent, -1), node.stateful) for node in nodes
+        ]
+        self._plan_slots = [None] * (len(nodes) + 1)
+        self._plan_data_slots = [
+            i for i, node in enumerate(nodes) if isinstance(node, ImageToDataNode)
+        ]
+        self._plan_data_nodes = [nodes[i] for i in self._plan_data_slots]
+        self._output_type = None
+        self._refresh_plan_params()
+        if self.profiler is not None:
+            self.enable_profiling(self.profiler.times.shape[0])
+
+    def enable_profiling(self, n_frames=1000):
+        """ Starts recording the time spent in each node, see
+        :class:`PipelineProfiler`. Only the compiled plan is profiled.
+        """
+        if self._plan is None:
+            self.compile()
+        self.profiler = PipelineProfiler(
+            [node.name for node, _, _ in self._plan], n_frames
+        )
+
+    def _refresh_plan_params(self):
+        self._plan_params = [
+            node._params.params.values if node._params is not None else dict()
+            for node, _, _ in self._plan
+        ]
+
+    def compiled_run(self, input, defer_state=False):
+        profiler = self.profiler
+        if profiler is not None:
+            t_start = perf_counter_ns()
+            node_times = profiler.current
+
+        slots = self._plan_slots
+        slots[-1] = input
+        messages = []
+        for i_slot, ((node, i_parent, stateful), params) in enumerate(
+            zip(self._plan, self._plan_params)
+        ):
+            if profiler is not None:
+                t_node = perf_counter_ns()
+            output = node._process(slots[i_parent], **params)
+            if stateful and not defer_state:
+                output = node.update_state(output)
+            if profiler is not None:
+                node_times[i_slot] = perf_counter_ns() - t_node
+            slots[i_slot] = output.data
+            messages.extend(output.messages)
+
+        # the output type is only rebuilt if one of the data nodes changed it
+        if self._output_type is None or any(
+            node._output_type_changed for node in self._plan_data_nodes
+        ):
+            self._output_type = namedtuple(
+                "o",
+                chain.from_iterable(slots[i]._fields for i in self._plan_data_slots),
+            )
+            for node in self._plan_data_nodes:
+                node.acknowledge_changes()
+
+        output = NodeOutput(
+            messages,
+            self._output_type(
+                *chain.from_iterable(slots[i] for i in self._plan_data_slots)
+            ),
+        )
+        if profiler is not None:
+            profiler.advance(perf_counter_ns() - t_start)
+        return output
+
+    def run(self, input, defer_state=False):
+        """ Processes an input image through the pipeline
+
+        Parameters
+        ----------
+        input :
+            the image to be processed
+        defer_state : bool
+            if True, the update_state step of stateful nodes is skipped,
+            and has to be applied afterwards in frame order with
+            :meth:`update_state`
+
+        Returns
+        -------
+        NodeOutput with the diagnostic messages and the pipeline output,
+        computed with the compiled plan if :meth:`compile` has been called
+
+        """
+        if self._plan is not None:
+            return self.compiled_run(input, defer_state=defer_state)
+        out = self.recursive_run(self.root, input, defer_state=defer_state)
         self.root.acknowledge_changes()
         return out
+
+    def _map_state_columns(self, data):
+        self._state_input_type = type(data)
+        field_index = {f: i for i, f in enumerate(data._fields)}
+        self._state_indexes = []
+        for node in self.stateful_nodes:
+            if node._output_type is None:
+                node.reset()
+            try:
+                indexes = [field_index[f] for f in node._output_type._fields]
+            except KeyError:
+                indexes = None
+            self._state_indexes.append((node, node._output_type, indexes))
+
+    def update_state(self, output: NodeOutput) -> NodeOutput:
+        """ Applies the update_state step of all stateful nodes to the output
+        of a run with deferred state. The columns belonging to each node are
+        found by name, so the output can come from a pipeline in a different
+        process. The outputs are converted to a single namedtuple type, as
+        the ones coming from different processes all have different types.
+
+        """
+        data = output.data
+        if (
+            self._state_input_type is None
+            or data._fields != self._state_input_type._fields
+            or any(
+                node._output_type is not node_type
+                for node, node_type, _ in self._state_indexes
+            )
+        ):
+            self._map_state_columns(data)
+
+        if not self._state_indexes:
+            return NodeOutput(output.messages, self._state_input_type(*data))
+
+        messages = list(output.messages)
+        values = list(data)
+        for node, _, indexes in self._state_indexes:
+            if indexes is None:
+                messages.append(
+                    "W:Output of {} does not match its state, not updated".format(
+                        node.name
+                    )
+                )
+                continue
+            node_output = node.update_state(
+                NodeOutput([], node._output_type(*(values[i] for i in indexes)))
+            )
+            messages.extend(node_output.messages)
+            for i, v in zip(indexes, node_output.data):
+                values[i] = v
+        return NodeOutput(messages, self._state_input_type(*values))
+
+    def detect_events(self, data, frame_index=None) -> NodeOutput:
+        """ Runs the event nodes on an output of the pipeline. Has to be
+        called in frame order, once the state of the stateful nodes has
+        been updated.
+
+        Parameters
+        ----------
+        data : namedtuple
+            the output of the pipeline
+        frame_index : int
+            index of the frame the output comes from
+
+        Returns
+        -------
+        NodeOutput with the diagnostic messages and the list of events
+
+        """
+        messages = []
+        events = []
+        for node in self.event_nodes:
+            node_output = node.process(data, frame_index)
+            messages.extend(node_output.messages)
+            events.extend(node_output.data)
+        return NodeOutput(messages, events)
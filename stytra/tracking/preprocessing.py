@@ -6,15 +6,30 @@
 import cv2
 
 import numpy as np
-from numba import vectorize, uint8, float32
+from numba import jit, vectorize, uint8, float32
 from lightparam import Param
 from stytra.tracking.pipelines import ImageToImageNode, NodeOutput
 
 
 class Prefilter(ImageToImageNode):
+    """Optionally resizes, smooths, inverts and clips the image.
+
+    The intermediate and output images are kept in buffers which are reused
+    as long as the size of the frames does not change, and the inversion
+    and clipping are done in a single pass. The output image is therefore
+    only valid until the next frame is processed.
+
+    If crop is set, only the region of interest is processed, and the
+    output outside of it is 0. The output keeps the size of the whole
+    image, so that positions relative to the image (e.g. the tail start)
+    are not changed.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="filtering", **kwargs)
         self.diagnostic_image_options = ["filtered"]
+        self._buffers = None
+        self._buffers_key = None
 
     def _process(
         self,
@@ -23,33 +38,152 @@ class Prefilter(ImageToImageNode):
         filter_size: Param(2, (0, 15)),
         color_invert: Param(True),
         clip: Param(140, (0, 255)),
+        crop: Param(False),
+        roi: Param((0.0, 0.0, 1.0, 1.0), gui=False),
         **extraparams
     ):
         """ Optionally resizes, smooths and inverts the image
 
         :param im:
-        :param state:
         :param filter_size:
         :param image_scale:
         :param color_invert:
+        :param clip:
+        :param crop: if True, only the roi is processed
+        :param roi: region of interest (y, x, height, width), relative to
+            the image height
         :return:
         """
-        if image_scale != 1:
-            im = cv2.resize(
-                im, None, fx=image_scale, fy=image_scale, interpolation=cv2.INTER_AREA
+        if im.dtype != np.uint8:
+            im = _prefilter_copying(im, image_scale, filter_size, color_invert, clip)
+        elif crop or image_scale != 1 or filter_size > 0 or color_invert or clip > 0:
+            im = self._prefilter_buffered(
+                im,
+                image_scale,
+                filter_size,
+                color_invert,
+                clip,
+                tuple(roi) if crop else None,
             )
-        if filter_size > 0:
-            im = cv2.boxFilter(im, -1, (filter_size, filter_size))
-        if color_invert:
-            im = 255 - im
-        if clip > 0:
-            im = np.maximum(im, clip) - clip
 
         if self.set_diagnostic == "filtered":
             self.diagnostic_image = im
 
         return NodeOutput([], im)
 
+    def _prefilter_buffered(
+        self, im, image_scale, filter_size, color_invert, clip, roi
+    ):
+        key = (im.shape, image_scale, filter_size > 0, roi)
+        if key != self._buffers_key:
+            self._buffers = _prefilter_buffers(*key)
+            self._buffers_key = key
+        (in_y, in_x), (out_y, out_x), scaled, filtered, cropped, output = self._buffers
+        if cropped is not None and cropped.size == 0:
+            return output
+
+        im = im[in_y, in_x]
+        if image_scale != 1:
+            if roi is None:
+                im = cv2.resize(
+                    im,
+                    None,
+                    dst=scaled,
+                    fx=image_scale,
+                    fy=image_scale,
+                    interpolation=cv2.INTER_AREA,
+                )
+            else:
+                im = cv2.resize(
+                    im, scaled.shape[::-1], dst=scaled, interpolation=cv2.INTER_AREA
+                )
+        if filter_size > 0:
+            im = cv2.boxFilter(im, -1, (filter_size, filter_size), dst=filtered)
+        if cropped is None:
+            invert_clip(im, np.uint8(clip), color_invert, output)
+        else:
+            # the processing is done in a contiguous buffer, which is faster
+            # than writing to the region of the output directly
+            output[out_y, out_x] = invert_clip(
+                im, np.uint8(clip), color_invert, cropped
+            )
+        return output
+
+
+def _prefilter_buffers(shape, image_scale, filtering, roi):
+    """ Allocates the buffers of the :class:`Prefilter`
+
+    Returns
+    -------
+    the slices of the processed region in the input and in the output,
+    the buffers for the resized, the filtered and the cropped output image
+    (or None if not needed), and the output image
+    """
+    full_shape = tuple(
+        int(round(s * image_scale)) if image_scale != 1 else s for s in shape[:2]
+    )
+    if roi is None:
+        out_slices = in_slices = (slice(None), slice(None))
+    else:
+        # the region is taken on the output pixel grid, and the input region
+        # is the corresponding one
+        y, x, h, w = (v * full_shape[0] for v in roi)
+        out_slices = tuple(
+            slice(
+                min(max(int(np.floor(start)), 0), size),
+                min(max(int(np.ceil(start + extent)), 0), size),
+            )
+            for start, extent, size in zip((y, x), (h, w), full_shape)
+        )
+        in_slices = tuple(
+            slice(
+                min(int(round(sl.start / image_scale)), size),
+                min(int(round(sl.stop / image_scale)), size),
+            )
+            for sl, size in zip(out_slices, shape[:2])
+        )
+
+    processed_shape = tuple(
+        len(range(*sl.indices(size))) for sl, size in zip(out_slices, full_shape)
+    )
+    output = np.zeros(full_shape, np.uint8)
+    scaled = np.empty(processed_shape, np.uint8) if image_scale != 1 else None
+    filtered = np.empty(processed_shape, np.uint8) if filtering else None
+    cropped = np.empty(processed_shape, np.uint8) if roi is not None else None
+    return in_slices, out_slices, scaled, filtered, cropped, output
+
+
+def _prefilter_copying(im, image_scale, filter_size, color_invert, clip):
+    """ Prefiltering for images which are not 8-bit"""
+    if image_scale != 1:
+        im = cv2.resize(
+            im, None, fx=image_scale, fy=image_scale, interpolation=cv2.INTER_AREA
+        )
+    if filter_size > 0:
+        im = cv2.boxFilter(im, -1, (filter_size, filter_size))
+    if color_invert:
+        im = 255 - im
+    if clip > 0:
+        im = np.maximum(im, clip) - clip
+    return im
+
+
+@jit(nopython=True, cache=True)
+def invert_clip(im, clip, invert, out):
+    """ Optionally inverts an 8-bit image and subtracts clip, setting the
+    values below it to 0, in a single pass writing to out
+    """
+    for i in range(im.shape[0]):
+        for j in range(im.shape[1]):
+            x = im[i, j]
+            if invert:
+                x = 255 - x
+            if x > clip:
+                out[i, j] = x - clip
+            else:
+                out[i, j] = 0
+    return out
+
 
 @vectorize([uint8(float32, uint8)])
 def negdif(xf, y):
@@ -96,10 +230,33 @@ def absdif(xf, y):
 
 
 class BackgroundSubtractor(ImageToImageNode):
+    """Subtracts a background image learned as the running average of
+    the frames.
+
+    The background can be kept at a lower resolution than the frames, in
+    which case the output is the downsampled difference image, and the
+    difference at full resolution is computed only in the regions
+    which need it with :meth:`full_resolution_difference`.
+
+    The background is updated in place, a band of rows every frame, so that
+    all of it is updated once every learn_every frames, and the difference
+    image is written to a buffer which is reused for the next frame.
+    """
+
+    # The background changes slowly, so if the tracking is split over
+    # multiple processes each of them can learn its own copy of it
+    # and the node does not need to be run in frame order
+    stateful = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="bgsub", **kwargs)
         self.background_image = None
         self.i = 0
+        self.downsample = 1
+        self.only_darker = True
+        self._image = None
+        self._small = None
+        self._difference = None
 
     def reset(self):
         self.background_image = None
@@ -110,19 +267,85 @@ class BackgroundSubtractor(ImageToImageNode):
         learning_rate: Param(0.04, (0.0, 1.0)),
         learn_every: Param(400, (1, 10000)),
         only_darker: Param(True),
+        downsample: Param(1, (1, 8)),
     ):
         messages = []
-        if self.background_image is None:
-            self.background_image = im.astype(np.float32)
-            messages.append("I:New backgorund image set")
-        elif self.i == 0:
-            self.background_image[:, :] = im.astype(np.float32) * np.float32(
-                learning_rate
-            ) + self.background_image * np.float32(1 - learning_rate)
+        self._image = im
+        self.only_darker = only_darker
+        if downsample > 1:
+            # only whole blocks of pixels are averaged, so that each pixel of
+            # the downsampled image corresponds to downsample x downsample
+            # pixels of the original one
+            small_shape = (im.shape[0] // downsample, im.shape[1] // downsample)
+            if self._small is None or self._small.shape != small_shape:
+                self._small = np.empty(small_shape, np.uint8)
+            small = cv2.resize(
+                im[: small_shape[0] * downsample, : small_shape[1] * downsample],
+                small_shape[::-1],
+                dst=self._small,
+                interpolation=cv2.INTER_AREA,
+            )
+        else:
+            small = im
 
-        self.i = (self.i + 1) % learn_every
+        if (
+            self.background_image is None
+            or self.background_image.shape != small.shape
+            or self.downsample != downsample
+        ):
+            self.background_image = small.astype(np.float32)
+            self._difference = np.empty(small.shape, np.uint8)
+            self.downsample = downsample
+            self.i = 0
+            messages.append("I:New backgorund image set")
+        else:
+            n_rows = -(-small.shape[0] // learn_every)
+            rows = slice(self.i * n_rows, (self.i + 1) * n_rows)
+            if rows.start < small.shape[0]:
+                cv2.accumulateWeighted(
+                    small[rows], self.background_image[rows], learning_rate
+                )
+            self.i = (self.i + 1) % learn_every
 
         if only_darker:
-            return NodeOutput(messages, negdif(self.background_image, im))
+            negdif(self.background_image, small, out=self._difference)
+        else:
+            absdif(self.background_image, small, out=self._difference)
+        return NodeOutput(messages, self._difference)
+
+    @property
+    def full_resolution_shape(self):
+        """ Shape of the last frame, which the background is subtracted
+        from, None if no frame was processed yet
+        """
+        return None if self._image is None else self._image.shape
+
+    def full_resolution_difference(self, slices):
+        """ Difference of a region of the last frame with the background,
+        at the resolution of the frame. If the background is downsampled,
+        each of its pixels is used for the corresponding block of pixels of
+        the frame
+
+        Parameters
+        ----------
+        slices : tuple of slices
+            region of the frame (rows, columns)
+
+        Returns
+        -------
+        the difference image of the region
+
+        """
+        if self.downsample == 1:
+            return self._difference[slices]
+        rows, columns = (
+            np.minimum(np.arange(*sl.indices(n_full)) // self.downsample, n - 1)
+            for sl, n_full, n in zip(
+                slices, self.full_resolution_shape, self.background_image.shape
+            )
+        )
+        background = self.background_image[np.ix_(rows, columns)]
+        if self.only_darker:
+            return negdif(background, self._image[slices])
         else:
-            return NodeOutput(messages, absdif(self.background_image, im))
+            return absdif(background, self._image[slices])
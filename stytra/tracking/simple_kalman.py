@@ -2,25 +2,76 @@ from numba import jit
 import numpy as np
 
 
-@jit(nopython=True)
-def predict_inplace(x, P, F, Q):
-    x[0] = x[0] + x[1]
-    P[:, :] = np.dot(np.dot(F, P), F.T) + Q
+@jit(nopython=True, cache=True)
+def predict_inplace(x, P, F, Q, indices):
+    """ Kalman filter prediction for a batch of independent (position,
+    velocity) states
 
+    Parameters
+    ----------
+    x : np.ndarray (n_states, 2)
+        states
+    P : np.ndarray (n_states, 2, 2)
+        covariances of the states
+    F : np.ndarray (2, 2)
+        state transition matrix
+    Q : np.ndarray (2, 2)
+        process noise
+    indices : np.ndarray
+        indices of the states to predict
 
-@jit(nopython=True)
-def update_inplace(z, x, P, R):
-    # error (residual) between measurement and prediction
-    y = z - x[0]
+    """
+    FP = np.empty((2, 2))
+    for i in indices:
+        x[i, 0] = x[i, 0] + x[i, 1]
+        for a in range(2):
+            for b in range(2):
+                FP[a, b] = F[a, 0] * P[i, 0, b] + F[a, 1] * P[i, 1, b]
+        for a in range(2):
+            for b in range(2):
+                P[i, a, b] = FP[a, 0] * F[b, 0] + FP[a, 1] * F[b, 1] + Q[a, b]
 
-    # project system uncertainty into measurement space
-    S = P[0, 0] + R
-    K = P[:, 0] / S
 
-    x[:] = x + K * y
+@jit(nopython=True, cache=True)
+def update_inplace(z, x, P, R, indices):
+    """ Kalman filter update for a batch of independent (position, velocity)
+    states, of which the position is measured
 
+    Parameters
+    ----------
+    z : np.ndarray (n_indices,)
+        measured positions
+    x : np.ndarray (n_states, 2)
+        states
+    P : np.ndarray (n_states, 2, 2)
+        covariances of the states
+    R : np.ndarray (n_indices,)
+        measurement noise
+    indices : np.ndarray (n_indices,)
+        indices of the measured states
+
+    """
     I_KH = np.eye(2)
-    I_KH[0, 0] -= K[0]
-    I_KH[1, 0] = -K[1]
+    I_KHP = np.empty((2, 2))
+    for j in range(len(indices)):
+        i = indices[j]
+        # error (residual) between measurement and prediction
+        y = z[j] - x[i, 0]
+
+        # project system uncertainty into measurement space
+        S = P[i, 0, 0] + R[j]
+        K0 = P[i, 0, 0] / S
+        K1 = P[i, 1, 0] / S
+
+        x[i, 0] += K0 * y
+        x[i, 1] += K1 * y
 
-    P[:, :] = ((I_KH @ P) @ I_KH.T) + R * (K @ K.T)
+        I_KH[0, 0] = 1 - K0
+        I_KH[1, 0] = -K1
+        for a in range(2):
+            for b in range(2):
+                I_KHP[a, b] = I_KH[a, 0] * P[i, 0, b] + I_KH[a, 1] * P[i, 1, b]
+        RKK = R[j] * (K0 * K0 + K1 * K1)
+        for a in range(2):
+            for b in range(2):
+                P[i, a, b] = I_KHP[a, 0] * I_KH[b, 0] + I_KHP[a, 1] * I_KH[b, 1] + RKK
@@ -1,8 +1,6 @@
 import numpy as np
 from numba import jit
-from lightparam import Param, Parametrized
-from scipy.ndimage.filters import gaussian_filter1d
-from stytra.utilities import reduce_to_pi
+from lightparam import Param
 from stytra.tracking.pipelines import ImageToDataNode, NodeOutput
 from collections import namedtuple
 
@@ -32,10 +30,14 @@ class TailTrackingMethod(ImageToDataNode):
 class CentroidTrackingMethod(TailTrackingMethod):
     """Center-of-mass method to find consecutive segments."""
 
+    stateful = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.resting_angles = None
         self.previous_angles = None
+        self._offsets = None
+        self._offsets_window_size = None
 
     def _process(
         self,
@@ -82,57 +84,39 @@ class CentroidTrackingMethod(TailTrackingMethod):
             list of cumulative sum + list of angles
 
         """
-        messages = []
-        start_y, start_x = tail_start
-        tail_length_y, tail_length_x = tail_length
-
-        scale = im.shape[0]
-
-        # Calculate tail length:
-        length_tail = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale
-
-        # Segment length from tail length and n of segments:
-        seg_length = length_tail / n_segments
-
-        n_segments += 1
-
-        # Initial displacements in x and y:
-        disp_x = tail_length_x * scale / n_segments
-        disp_y = tail_length_y * scale / n_segments
-
-        angles = np.full(n_segments - 1, np.nan)
-        start_x *= scale
-        start_y *= scale
-
-        halfwin = window_size / 2
-        for i in range(1, n_segments):
-            # Use next segment function for find next point
-            # with center-of-mass displacement:
-            start_x, start_y, disp_x, disp_y, acc = _next_segment(
-                im, start_x, start_y, disp_x, disp_y, halfwin, seg_length
-            )
-            if start_x < 0:
-                messages.append("W:segment {} not detected".format(i))
-                break
-
-            abs_angle = np.arctan2(disp_x, disp_y)
-            angles[i - 1] = abs_angle
+        if window_size != self._offsets_window_size:
+            self._offsets = _window_offsets(window_size)
+            self._offsets_window_size = window_size
+
+        # The whole tail is traced by a single jitted function
+        output, i_missing = _tail_trace_centroid(
+            im,
+            *tail_start,
+            *tail_length,
+            n_segments,
+            window_size / 2,
+            *self._offsets,
+            tail_filter_width,
+            n_output_segments
+        )
+        if i_missing > 0:
+            messages = ["W:segment {} not detected".format(i_missing)]
+        else:
+            messages = []
 
-        # we want angles to be continuous, this removes potential 2pi discontinuities
-        angles = np.unwrap(angles)
+        if self._output_type is None:
+            self.reset()
 
-        # we do not need to record a large amount of angles
-        if tail_filter_width > 0:
-            angles = gaussian_filter1d(angles, tail_filter_width, mode="nearest")
+        return NodeOutput(messages, self._output_type(*output))
 
-        angles = np.interp(
-            np.linspace(0, 1, n_output_segments),
-            np.linspace(0, 1, n_segments - 1),
-            angles,
-        )
-        # Interpolate to the desired number of output segments
+    def update_state(self, output):
+        """ Applies the resting angle correction and the temporal filtering,
+        which depend on the previously tracked frames
+        """
+        angles = np.array(output.data[1:])
+        time_filter_weight = self._params.time_filter_weight
 
-        if reset_zero:
+        if self._params.reset_zero:
             if self.resting_angles is None or len(self.resting_angles) != len(angles):
                 self.resting_angles = angles
             else:
@@ -141,7 +125,11 @@ class CentroidTrackingMethod(TailTrackingMethod):
             if self.resting_angles is not None:
                 angles = angles - self.resting_angles + self.resting_angles[0]
 
-        if time_filter_weight > 0 and self.previous_angles is not None:
+        if (
+            time_filter_weight > 0
+            and self.previous_angles is not None
+            and len(self.previous_angles) == len(angles)
+        ):
             angles = (
                 time_filter_weight * self.previous_angles
                 + (1 - time_filter_weight) * angles
@@ -149,14 +137,228 @@ class CentroidTrackingMethod(TailTrackingMethod):
 
         self.previous_angles = angles
 
+        return NodeOutput(
+            output.messages,
+            type(output.data)(
+                angles[-1] + angles[-2] - angles[0] - angles[1], *angles
+            ),
+        )
+
+
+class AnglesTrackingMethod(TailTrackingMethod):
+    """Angular sweep method to find consecutive segments: each segment
+    ends at the brightest point of an arc in front of the previous one.
+
+    The arcs are sampled on a fixed grid of directions, so the displacements
+    to their points are looked up in a table computed when the tail
+    parameters change, and no trigonometric functions are evaluated
+    while tracking.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._arc_table = None
+        self._arc_table_key = None
+
+    def _process(
+        self,
+        im,
+        tail_start: Param((0.47, 1.7), gui=False),
+        tail_length: Param((0.07, -1.36), gui=False),
+        n_segments: Param(12, (1, 50)),
+        n_output_segments: Param(9, (2, 30)),
+        n_arc_points: Param(21, (3, 61)),
+        bilinear: Param(False),
+        **extraparams
+    ):
+        """Traces the tail of an embedded fish, given the starting point and
+        the direction of the tail.
+
+        Parameters
+        ----------
+        im :
+            image to process
+        tail_start :
+            starting point (y, x), relative to the image height
+        tail_length :
+            tail length (y, x), relative to the image height
+        n_segments :
+            number of segments
+        n_output_segments :
+            number of angles in the output, interpolated from the segments
+        n_arc_points :
+            number of points sampled on each arc, spanning 180 degrees
+            (rounded up to an odd number)
+        bilinear :
+            if True the image is sampled with bilinear interpolation on the
+            arcs, otherwise the nearest pixel is taken
+
+        Returns
+        -------
+        NodeOutput with the total curvature and the angles of the
+        output segments
+
+        """
+        key = (tuple(tail_length), n_segments, n_arc_points)
+        if key != self._arc_table_key:
+            self._arc_table = _arc_table(tail_length, n_segments, n_arc_points)
+            self._arc_table_key = key
+
+        output, i_missing = _tail_trace_angles(
+            im, *tail_start, n_segments, *self._arc_table, bilinear, n_output_segments
+        )
+        if i_missing > 0:
+            messages = ["W:segment {} not detected".format(i_missing)]
+        else:
+            messages = []
+
         if self._output_type is None:
             self.reset()
 
-        # Total curvature as sum of the last 2 angles - sum of the first 2
-        return NodeOutput(
-            messages,
-            self._output_type(angles[-1] + angles[-2] - angles[0] - angles[1], *angles),
-        )
+        return NodeOutput(messages, self._output_type(*output))
+
+
+def _arc_table(tail_length, n_segments, n_arc_points):
+    """Lookup table of the displacements of one segment along the directions
+    of the arcs of :class:`AnglesTrackingMethod`. The arcs span 180 degrees
+    with n_arc_points points, which are all on a grid of directions spaced
+    by angle_step starting from the direction of the tail.
+
+    Parameters
+    ----------
+    tail_length :
+        tail length (y, x), relative to the image height
+    n_segments :
+        number of segments
+    n_arc_points :
+        number of points on the arcs
+
+    Returns
+    -------
+    tuple of the x and y displacements (relative to the image height) for all
+    directions of the grid, the angle of the tail and the angle step
+
+    """
+    half_arc = max(n_arc_points // 2, 1)
+    angle_step = np.pi / (2 * half_arc)
+    start_angle = np.arctan2(tail_length[1], tail_length[0])
+    seg_length = np.sqrt(tail_length[0] ** 2 + tail_length[1] ** 2) / n_segments
+    directions = start_angle + np.arange(4 * half_arc) * angle_step
+    return (
+        seg_length * np.sin(directions),
+        seg_length * np.cos(directions),
+        start_angle,
+        angle_step,
+    )
+
+
+@jit(nopython=True, cache=True)
+def _sample(im, y, x, bilinear):
+    """Value of the image at a point, -inf outside of the image"""
+    if bilinear:
+        x0 = int(np.floor(x))
+        y0 = int(np.floor(y))
+        if not (0 <= x0 < im.shape[1] - 1 and 0 <= y0 < im.shape[0] - 1):
+            return -np.inf
+        fx = x - x0
+        fy = y - y0
+        return (im[y0, x0] * (1 - fx) + im[y0, x0 + 1] * fx) * (1 - fy) + (
+            im[y0 + 1, x0] * (1 - fx) + im[y0 + 1, x0 + 1] * fx
+        ) * fy
+
+    xp = int(x)
+    yp = int(y)
+    if 0 <= xp < im.shape[1] and 0 <= yp < im.shape[0]:
+        return float(im[yp, xp])
+    return -np.inf
+
+
+@jit(nopython=True, cache=True)
+def _tail_trace_angles(
+    im,
+    start_y,
+    start_x,
+    n_segments,
+    directions_x,
+    directions_y,
+    start_angle,
+    angle_step,
+    bilinear,
+    n_output_segments,
+):
+    """Traces the tail with consecutive arcs, for
+    :class:`AnglesTrackingMethod`, with the directions from
+    :func:`_arc_table`
+
+    Returns
+    -------
+    array of the total curvature followed by the n_output_segments angles,
+    index of the first segment which could not be detected (0 if all were)
+
+    """
+    scale = im.shape[0]
+    n_directions = len(directions_x)
+    half_arc = n_directions // 4
+    x = start_x * scale
+    y = start_y * scale
+
+    angles = np.full(n_segments, np.nan)
+    i_missing = 0
+    # index of the current direction on the grid, not wrapped around so that
+    # the angles are continuous
+    i_direction = 0
+    for i_segment in range(n_segments):
+        best_value = -np.inf
+        best_direction = 0
+        for i_arc in range(i_direction - half_arc, i_direction + half_arc + 1):
+            i_table = i_arc % n_directions
+            value = _sample(
+                im,
+                y + directions_y[i_table] * scale,
+                x + directions_x[i_table] * scale,
+                bilinear,
+            )
+            if value > best_value:
+                best_value = value
+                best_direction = i_arc
+        if best_value == -np.inf:
+            i_missing = i_segment + 1
+            break
+
+        i_direction = best_direction
+        i_table = i_direction % n_directions
+        x += directions_x[i_table] * scale
+        y += directions_y[i_table] * scale
+        angles[i_segment] = start_angle + i_direction * angle_step
+
+    return _tail_output(angles, n_output_segments), i_missing
+
+
+def tail_roi(tail_start, tail_length, margin=0.1):
+    """ Square region containing all the points the tail can reach, whatever
+    its shape, to restrict the :class:`Prefilter` to it
+
+    Parameters
+    ----------
+    tail_start :
+        starting point (y, x), relative to the image height
+    tail_length :
+        tail length (y, x), relative to the image height
+    margin :
+        margin around the tail, relative to its length
+
+    Returns
+    -------
+    region of interest (y, x, height, width), relative to the image height
+
+    """
+    radius = np.sqrt(tail_length[0] ** 2 + tail_length[1] ** 2) * (1 + margin)
+    return (
+        tail_start[0] - radius,
+        tail_start[1] - radius,
+        2 * radius,
+        2 * radius,
+    )
 
 
 @jit(nopython=True, cache=True)
@@ -201,75 +403,28 @@ def find_fish_midline(im, xm, ym, angle, r=9, m=3, n_points=20):
     return points
 
 
-class AnglesTrackingMethod(TailTrackingMethod):
-    """Angular sweep method to find consecutive segments."""
-
-    def __init__(self):
-        super().__init__()
-        # self.add_params(dark_tail=False)
-        self.params = Parametrized(name="tracking/tail_angles", params=self.detect)
-        self.accumulator_headers = ["tail_sum"] + [
-            "theta_{:02}".format(i) for i in range(self.params.n_segments)
-        ]
-
-    def detect(
-        self,
-        im,
-        tail_start: Param((0, 0), gui=False),
-        n_segments: Param(7),
-        tail_length: Param((1, 1), gui=False),
-        **extraparams
-    ):
-        """Tail tracing based on min (or max) detection on arches. Wraps
-        _tail_trace_core_ls. Speed testing: 20 us for a 514x640 image without
-        smoothing, 300 us with smoothing.
-
-        Parameters
-        ----------
-        img :
-            input image
-        tail_start :
-            tail starting point (x, y) (Default value = (0)
-        tail_length :
-            tail length (Default value = (1)
-        n_segments :
-            number of segments (Default value = 7)
-        dark_tail :
-            True for inverting image colors (Default value = False)
-        im :
-
-        0) :
-
-        1) :
-
-        image_scale :
-             (Default value = 1)
-
-        Returns
-        -------
-
-        """
-        start_y, start_x = tail_start
-        tail_length_y, tail_length_x = tail_length
-
-        scale = im.shape[0]
-
-        # Calculate tail length:
-        length_tail = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale
-
-        # Initial displacements in x and y:
-        disp_x = tail_length_x * scale / n_segments
-        disp_y = tail_length_y * scale / n_segments
+@jit(nopython=True, cache=True)
+def fish_midline_angles(im, xm, ym, angle, r, m, angles):
+    """Same as :func:`find_fish_midline`, but writes the angles of the
+    segments between the points of the midline to the angles array
+    (with one element less than the number of points), without building
+    lists of points
 
-        start_x *= scale
-        start_y *= scale
+    Returns
+    -------
+    True if the tail was completely tracked
 
-        # Use jitted function for the actual calculation:
-        angle_list = _tail_trace_core_ls(
-            im, start_x, start_y, disp_x, disp_y, n_segments, length_tail
-        )
+    """
+    dx = np.cos(angle) * m
+    dy = np.sin(angle) * m
 
-        return angle_list
+    for i in range(len(angles)):
+        xn, yn, dx, dy, _ = _next_segment(im, xm, ym, dx, dy, r, m)
+        if not xn > 0:
+            return False
+        angles[i] = np.arctan2(yn - ym, xn - xm)
+        xm, ym = xn, yn
+    return True
 
 
 @jit(nopython=True)
@@ -347,82 +502,161 @@ def _next_segment(fc, xm, ym, dx, dy, halfwin, next_point_dist):
     return xm + dx, ym + dy, dx, dy, acc
 
 
-@jit(nopython=True)
-def _tail_trace_core_ls(img, start_x, start_y, disp_x, disp_y, num_points, tail_length):
-    """Tail tracing based on min (or max) detection on arches. Wrapped by
-    trace_tail_angular_sweep.
+def _window_offsets(window_size):
+    """Offsets of the pixels of the circular window used for the
+    center-of-mass calculation in :func:`_next_segment`, relative to the
+    corner of the square window which contains it
 
     Parameters
     ----------
-    img :
-        
-    start_x :
-        
-    start_y :
-        
-    disp_x :
-        
-    disp_y :
-        
-    num_points :
-        
-    tail_length :
-
+    window_size :
+        diameter of the window in pixels
 
     Returns
     -------
+    tuple of x and y offsets
 
     """
-    # Define starting angle based on tail dimensions:
-    start_angle = np.arctan2(disp_x, disp_y)
-
-    # Initialise first angle arch, tail sum and angle list:
-    pi2 = np.pi / 2
-    lin = np.linspace(-pi2 + start_angle, pi2 + start_angle, 25)
-    tail_sum = 0.0
-    angles = np.zeros(num_points + 1)
-
-    # Create vector of intensities along the arch:
-    intensity_vect = np.zeros(len(lin), dtype=np.int16)
-    seglen = tail_length / num_points
-
-    for j in range(num_points):  # Cycle on segments
-        # Transform arch angles in x and y coordinates:
-        xs = start_x + seglen * np.sin(lin)
-        ys = start_y + seglen * np.cos(lin)
-
-        # fill the vector of intensities along the arch
-        for i in range(len(xs)):
-            yp = int(ys[i])
-            xp = int(xs[i])
-            if (
-                img.shape[1] > xp >= 0 and 0 <= yp < img.shape[0]
-            ):  # check image boundaries
-                intensity_vect[i] = img[yp, xp]
-
-        # Find minimum or maximum of the arch.
-        # This switch is much faster than inverting the entire image.
-        ident = np.argmax(intensity_vect)
-
-        if not np.isnan(lin[ident]):
-            new_angle = lin[ident]
-        else:
-            new_angle = angles[j]
+    halfwin = window_size / 2
+    size = int(np.ceil(window_size)) + 1
+    off_y, off_x = np.mgrid[0:size, 0:size]
+    inside = (halfwin - off_x) ** 2 + (halfwin - off_y) ** 2 <= halfwin ** 2
+    return off_x[inside].astype(np.int64), off_y[inside].astype(np.int64)
+
 
-        new_angle = reduce_to_pi(new_angle)
+@jit(nopython=True, cache=True)
+def _next_segment_masked(fc, xm, ym, dx, dy, halfwin, next_point_dist, off_x, off_y):
+    """Same as :func:`_next_segment`, with the pixels of the circular
+    window given by the precomputed offsets of :func:`_window_offsets`
+    """
+    y_max, x_max = fc.shape
+    xs = min(max(int(round(xm + dx - halfwin)), 0), x_max)
+    xe = min(max(int(round(xm + dx + halfwin)), 0), x_max)
+    ys = min(max(int(round(ym + dy - halfwin)), 0), y_max)
+    ye = min(max(int(round(ym + dy + halfwin)), 0), y_max)
+
+    # at the edge returns invalid data
+    if xs == xe and ys == ye:
+        return -1.0, -1.0, 0.0, 0.0, 0.0
+
+    acc = 0.0
+    acc_x = 0.0
+    acc_y = 0.0
+    for i in range(len(off_x)):
+        x = xs + off_x[i]
+        y = ys + off_y[i]
+        if x < xe and y < ye:
+            acc_x += x * fc[y, x]
+            acc_y += y * fc[y, x]
+            acc += fc[y, x]
 
-        # skip the first angle for the tail sum
-        if j > 0:
-            tail_sum += reduce_to_pi(new_angle - angles[j])
+    if acc == 0:
+        return -1.0, -1.0, 0.0, 0.0, 0.0
 
-        angles[j + 1] = new_angle
+    mn_y = acc_y / acc - ym
+    mn_x = acc_x / acc - xm
+    a = np.sqrt(mn_y ** 2 + mn_x ** 2) / next_point_dist
+    if a == 0:
+        return -1.0, -1.0, 0.0, 0.0, 0.0
+
+    dx = mn_x / a
+    dy = mn_y / a
+    return xm + dx, ym + dy, dx, dy, acc
+
+
+@jit(nopython=True, cache=True)
+def _unwrap_inplace(angles):
+    """np.unwrap for a 1D array, in place"""
+    correction = 0.0
+    previous = angles[0]
+    for i in range(1, len(angles)):
+        dd = angles[i] - previous
+        previous = angles[i]
+        if not abs(dd) < np.pi:
+            ddmod = (dd + np.pi) % (2 * np.pi) - np.pi
+            if ddmod == -np.pi and dd > 0:
+                ddmod = np.pi
+            correction += ddmod - dd
+        angles[i] += correction
+
+
+@jit(nopython=True, cache=True)
+def _gaussian_filter_nearest(x, sigma):
+    """scipy.ndimage.gaussian_filter1d with mode="nearest", for a 1D array"""
+    radius = int(4.0 * sigma + 0.5)
+    weights = np.exp(-0.5 / sigma ** 2 * np.arange(-radius, radius + 1) ** 2)
+    weights /= np.sum(weights)
+    n = len(x)
+    filtered = np.zeros(n)
+    for i in range(n):
+        for j in range(-radius, radius + 1):
+            filtered[i] += weights[j + radius] * x[min(max(i + j, 0), n - 1)]
+    return filtered
+
+
+@jit(nopython=True, cache=True)
+def _tail_output(angles, n_output_segments):
+    """Interpolates the angles of the segments to the desired number of
+    output segments, and puts the total curvature in front of them
+    """
+    output = np.empty(n_output_segments + 1)
+    output[1:] = np.interp(
+        np.linspace(0, 1, n_output_segments), np.linspace(0, 1, len(angles)), angles
+    )
+
+    # Total curvature as sum of the last 2 angles - sum of the first 2
+    output[0] = output[-1] + output[-2] - output[1] - output[2]
+    return output
+
+
+@jit(nopython=True, cache=True)
+def _tail_trace_centroid(
+    im,
+    start_y,
+    start_x,
+    tail_length_y,
+    tail_length_x,
+    n_segments,
+    halfwin,
+    off_x,
+    off_y,
+    tail_filter_width,
+    n_output_segments,
+):
+    """Traces the tail with consecutive center-of-mass windows, for
+    :class:`CentroidTrackingMethod`. The starting point and tail length are
+    relative to the image height.
+
+    Returns
+    -------
+    array of the total curvature followed by the n_output_segments angles,
+    index of the first segment which could not be detected (0 if all were)
+
+    """
+    scale = im.shape[0]
+    seg_length = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale / n_segments
+
+    # Initial displacements in x and y:
+    disp_x = tail_length_x * scale / (n_segments + 1)
+    disp_y = tail_length_y * scale / (n_segments + 1)
+    x = start_x * scale
+    y = start_y * scale
+
+    angles = np.full(n_segments, np.nan)
+    i_missing = 0
+    for i in range(n_segments):
+        x, y, disp_x, disp_y, _ = _next_segment_masked(
+            im, x, y, disp_x, disp_y, halfwin, seg_length, off_x, off_y
+        )
+        if x < 0:
+            i_missing = i + 1
+            break
+        angles[i] = np.arctan2(disp_x, disp_y)
 
-        # The point found will be the starting point of the next arc
-        start_x = xs[ident]
-        start_y = ys[ident]
+    # we want angles to be continuous, this removes potential 2pi discontinuities
+    _unwrap_inplace(angles)
 
-        # Create an 120 deg angle depending on the previous one:
-        lin = np.linspace(new_angle - pi2, new_angle + pi2, 20)
+    if tail_filter_width > 0:
+        angles = _gaussian_filter_nearest(angles, tail_filter_width)
 
-    angles[0] = tail_sum
-    return angles
+    return _tail_output(angles, n_output_segments), i_missing
@@ -1,10 +1,37 @@
+import heapq
+import time as pytime
+from datetime import datetime
 from queue import Empty, Full
-from multiprocessing import Event, Value
+from multiprocessing import Event, Value, Queue
 
 from stytra.utilities import FrameProcess
+from stytra.tracking.pipelines import NodeOutput
 from arrayqueues.shared_arrays import TimestampedArrayQueue
 
 
+def finalize_frame(pipeline, event_queue, estimation, time, frame_idx, output):
+    """ The steps applied in frame order to the complete output of the
+    tracking of a frame: the events are detected (if they are required) and
+    put in the event_queue, and the estimates are updated
+
+    Returns
+    -------
+    list of diagnostic messages
+
+    """
+    if event_queue is None and estimation is None:
+        return []
+    messages, events = pipeline.detect_events(output, frame_idx)
+    if event_queue is not None:
+        for event in events:
+            event_queue.put(((time, frame_idx), event))
+    if estimation is not None:
+        estimation.update(
+            time, frame_idx, output, events if pipeline.event_nodes else None
+        )
+    return messages
+
+
 class TrackingProcess(FrameProcess):
     """A class which handles taking frames from the camera and processing them,
      as well as dispatching a subset for display
@@ -17,6 +44,8 @@ class TrackingProcess(FrameProcess):
 
     """
 
+    frame_policies = ("fifo", "latest", "budgeted")
+
     def __init__(
         self,
         in_frame_queue,
@@ -24,9 +53,16 @@ class TrackingProcess(FrameProcess):
         pipeline=None,
         processing_parameter_queue=None,
         output_queue=None,
-        recording_signal=None,
+        event_queue=None,
+        estimation=None,
         gui_framerate=30,
         max_mb_queue=100,
+        sharded=False,
+        gui_dispatcher=True,
+        profile=False,
+        profiling_interval=1.0,
+        frame_policy="fifo",
+        max_latency=0.02,
         **kwargs
     ):
         """
@@ -34,8 +70,9 @@ class TrackingProcess(FrameProcess):
 
         Parameters
         ----------
-        in_frame_queue:
-            queue dispatching frames from camera
+        in_frame_queue: FrameRingReader
+            reader of the frames from the camera, shared
+            among the processes of a pool
         finished_signal
             signal for the end of the acquisition
         pipeline: Pipeline
@@ -43,9 +80,16 @@ class TrackingProcess(FrameProcess):
         processing_parameter_queue
             queue for function&parameters
         output_queue:
-            tracking output queue
-        recording_signal: bool (false)
-
+            tracking output queue, the outputs are put together with the
+            time and index of the frame
+        event_queue:
+            queue for the events detected by the event nodes of the
+            pipeline (e.g. bouts), put in the same way as the outputs.
+            If None, the events are not detected
+        estimation: EstimationStage
+            if given, computes the estimates for the closed-loop stimuli
+            from the output of each frame and publishes them in shared
+            memory (not in sharded processes)
         processing_counter
         gui_framerate: int
             target framerate of the display GUI
@@ -54,23 +98,50 @@ class TrackingProcess(FrameProcess):
         max_mb_queue: int (200)
             the maximal size of the image output queues
 
+        sharded: bool (False)
+            if True, the process is one of a pool of tracking processes
+            sharing the frame reader: the order-dependent steps of the
+            pipeline are not run, and the outputs are merged back in frame
+            order by a :class:`TrackingReassemblyProcess`
+
+        gui_dispatcher: bool (True)
+            whether this process sends frames to the GUI
+
+        profile: bool (False)
+            if True, the time spent in each node of the pipeline is
+            recorded, and its percentiles are put in the profiling_queue
+
+        profiling_interval: float (1.0)
+            interval in seconds between the profiling summaries
+
+        frame_policy: str ("fifo")
+            which frames are processed when the tracking is slower than
+            the camera: "fifo" processes all the frames in order (as long as
+            they are not overwritten in the frame ring), "latest"
+            always skips to the last frame acquired, and "budgeted" skips the
+            frames acquired more than max_latency seconds ago.
+            The skipped frames are still recorded.
+
+        max_latency: float (0.02)
+            latency target for the "budgeted" frame policy, in seconds
+
         kwargs
         """
 
         super().__init__(name="tracking", **kwargs)
 
         self.frame_queue = in_frame_queue
-        self.gui_queue = TimestampedArrayQueue(max_mbytes=max_mb_queue)  # GUI queue for
-
-        self.recording_signal = recording_signal
-        if recording_signal is not None:
-            self.frame_copy_queue = TimestampedArrayQueue(max_mbytes=max_mb_queue)
-        else:
-            self.frame_copy_queue = None
+        self.sharded = sharded
+        self.gui_dispatcher = gui_dispatcher
+        self.gui_queue = (
+            TimestampedArrayQueue(max_mbytes=max_mb_queue) if gui_dispatcher else None
+        )  # GUI queue for
 
         #  displaying
         #  the image
         self.output_queue = output_queue  # queue for processing output (e.g., pos)
+        self.event_queue = event_queue
+        self.estimation = estimation
         self.processing_parameter_queue = processing_parameter_queue
 
         self.finished_signal = finished_signal
@@ -79,6 +150,22 @@ class TrackingProcess(FrameProcess):
         self.pipeline_cls = pipeline
         self.pipeline = None
 
+        if frame_policy not in self.frame_policies:
+            raise ValueError(
+                "Unknown frame policy {}, has to be one of {}".format(
+                    frame_policy, ", ".join(self.frame_policies)
+                )
+            )
+        self.frame_policy = frame_policy
+        self.max_latency = max_latency
+        self.n_dropped_reported = 0
+        self.n_skipped_reported = 0
+
+        self.profile = profile
+        self.profiling_interval = profiling_interval
+        self.profiling_queue = Queue()
+        self.last_profiling_time = None
+
         self.i = 0
 
     def process_internal(self, frame):
@@ -110,48 +197,104 @@ class TrackingProcess(FrameProcess):
 
         self.pipeline = self.pipeline_cls()
         self.pipeline.setup()
+        self.pipeline.compile()
+        if self.profile:
+            self.pipeline.enable_profiling()
 
         while not self.finished_signal.is_set():
 
             # Gets the processing parameters from their queue
             self.retrieve_params()
 
-            # Gets frame from its queue, if the input is too fast, drop frames
-            # and process the latest, if it is too slow continue:
+            # Gets frame from the camera, if the input is too fast, frames
+            # are skipped according to the frame policy, and the
+            # ones which are overwritten before being read are dropped
             try:
-                time, frame_idx, frame = self.frame_queue.get(timeout=0.001)
+                time, frame_idx, frame = self.frame_queue.get(
+                    timeout=0.001,
+                    latest=self.frame_policy == "latest",
+                    max_latency=self.max_latency
+                    if self.frame_policy == "budgeted"
+                    else None,
+                )
             except Empty:
                 continue
 
             messages = []
-            # If we are copying the frames to another queue (e.g. for video recording), do it here
-            if self.recording_signal is not None and self.recording_signal.is_set():
-                try:
-                    self.frame_copy_queue.put(frame.copy(), timestamp=time)
-                except:
-                    messages.append("W:Dropping frames from recording")
+            if self.frame_queue.n_dropped > self.n_dropped_reported:
+                self.n_dropped_reported = self.frame_queue.n_dropped
+                messages.append("W:Dropped frames in tracking")
+            if self.frame_queue.n_skipped > self.n_skipped_reported:
+                self.n_skipped_reported = self.frame_queue.n_skipped
+                messages.append("I:Skipping frames in tracking to keep up")
 
             # If a processing function is specified, apply it:
 
-            new_messages, output = self.pipeline.run(frame)
-            for msg in messages + new_messages:
+            # the state of the stateful nodes is only updated once it is
+            # known that the frame is valid
+            new_messages, output = self.pipeline.run(frame, defer_state=True)
+            messages.extend(new_messages)
+
+            # the camera can overwrite the frame while it is being tracked,
+            # in which case the output is discarded and the frame dropped
+            if not self.frame_queue.confirm(frame_idx):
+                for msg in messages:
+                    self.message_queue.put(msg)
+                continue
+
+            # the state is updated and the events are detected in frame
+            # order, so in the reassembly process if the tracking is sharded
+            if not self.sharded:
+                new_messages, output = self.pipeline.update_state(
+                    NodeOutput([], output)
+                )
+                messages.extend(new_messages)
+                messages.extend(
+                    finalize_frame(
+                        self.pipeline,
+                        self.event_queue,
+                        self.estimation,
+                        time,
+                        frame_idx,
+                        output,
+                    )
+                )
+
+            for msg in messages:
                 self.message_queue.put(msg)
 
-            self.output_queue.put(time, output)
+            self.output_queue.put((time, frame_idx), output)
 
-            # calculate the frame rate
-            self.update_framerate()
+            # calculate the frame rate, and the latency if this process gives
+            # the final output
+            self.update_framerate(None if self.sharded else time)
+
+            if self.profile:
+                self.send_profiling()
 
             # put current frame into the GUI queue
-            self.send_to_gui(
-                time,
-                self.pipeline.diagnostic_image
-                if self.pipeline.diagnostic_image is not None
-                else frame,
-            )
+            if self.gui_dispatcher:
+                self.send_to_gui(
+                    time,
+                    self.pipeline.diagnostic_image
+                    if self.pipeline.diagnostic_image is not None
+                    else frame,
+                )
 
         return
 
+    def send_profiling(self):
+        """ Sends the percentiles of the node timings every
+        profiling_interval seconds"""
+        t = datetime.now()
+        if (
+            self.last_profiling_time is None
+            or (t - self.last_profiling_time).total_seconds()
+            > self.profiling_interval
+        ):
+            self.profiling_queue.put((t, self.pipeline.profiler.summary()))
+            self.last_profiling_time = t
+
     def send_to_gui(self, frametime, frame):
         """ Sends the current frame to the GUI queue at the appropriate framerate"""
         if self.framerate_rec.current_framerate:
@@ -169,9 +312,141 @@ class TrackingProcess(FrameProcess):
         self.i = (self.i + 1) % every_x
 
 
+class TrackingReassemblyProcess(FrameProcess):
+    """Collects the outputs of a pool of sharded :class:`TrackingProcess`
+    workers, puts them back in frame order and runs the stateful nodes
+    of the pipeline on them (the stateful tail), so that state like the
+    Kalman filters of the fish tracking is updated frame by frame.
+
+    Each worker reads the frames in increasing index order, so
+    a frame can be emitted once every worker has gone past it. Frames
+    which are missing (e.g. dropped by a worker) are skipped after
+    max_wait seconds.
+
+    """
+
+    def __init__(
+        self,
+        worker_queues,
+        finished_signal: Event = None,
+        pipeline=None,
+        processing_parameter_queue=None,
+        output_queue=None,
+        event_queue=None,
+        estimation=None,
+        max_wait=0.05,
+        **kwargs
+    ):
+        """
+        Parameters
+        ----------
+        worker_queues:
+            list of RowRings, one per tracking process
+        finished_signal:
+            signal for the end of the acquisition
+        pipeline: Pipeline
+            tracking pipeline class
+        processing_parameter_queue:
+            queue for the pipeline parameters
+        output_queue:
+            ordered tracking output queue
+        event_queue:
+            queue for the events detected by the event nodes of the pipeline
+        estimation: EstimationStage
+            if given, computes the estimates for the closed-loop stimuli
+            from the output of each frame
+        max_wait: float
+            maximal time in seconds to wait for a missing frame
+
+        """
+        super().__init__(name="tracking_reassembly", **kwargs)
+        self.worker_queues = worker_queues
+        self.finished_signal = finished_signal
+        self.pipeline_cls = pipeline
+        self.pipeline = None
+        self.processing_parameter_queue = processing_parameter_queue
+        self.output_queue = output_queue
+        self.event_queue = event_queue
+        self.estimation = estimation
+        self.max_wait = max_wait
+
+        self.pending = []
+        self.next_index = None
+        self.last_index = [-1] * len(worker_queues)
+
+    def retrieve_params(self):
+        while True:
+            try:
+                param_dict = self.processing_parameter_queue.get(timeout=0.0001)
+                self.pipeline.deserialize_params(param_dict)
+            except Empty:
+                break
+
+    def collect(self):
+        """ Moves all available outputs of the workers to the pending heap """
+        for i_worker, queue in enumerate(self.worker_queues):
+            while True:
+                try:
+                    rows = queue.get_many()
+                except Empty:
+                    break
+                t_arrived = pytime.monotonic()
+                for (time, frame_idx), output in queue.to_tuples(rows):
+                    self.last_index[i_worker] = frame_idx
+                    heapq.heappush(
+                        self.pending, (frame_idx, t_arrived, time, output)
+                    )
+
+    def emit_ready(self):
+        watermark = min(self.last_index)
+        while self.pending:
+            frame_idx, t_arrived, time, output = self.pending[0]
+            if self.next_index is not None and frame_idx < self.next_index:
+                # arrived after it was given up on
+                heapq.heappop(self.pending)
+                continue
+            if not (
+                frame_idx == self.next_index
+                or frame_idx <= watermark
+                or pytime.monotonic() - t_arrived > self.max_wait
+            ):
+                break
+            heapq.heappop(self.pending)
+            self.next_index = frame_idx + 1
+
+            messages, output = self.pipeline.update_state(NodeOutput([], output))
+            messages.extend(
+                finalize_frame(
+                    self.pipeline,
+                    self.event_queue,
+                    self.estimation,
+                    time,
+                    frame_idx,
+                    output,
+                )
+            )
+            for msg in messages:
+                self.message_queue.put(msg)
+            self.output_queue.put((time, frame_idx), output)
+            self.update_framerate(time)
+
+    def run(self):
+        self.pipeline = self.pipeline_cls()
+        self.pipeline.setup()
+
+        while not self.finished_signal.is_set():
+            self.retrieve_params()
+            self.collect()
+            if not self.pending:
+                pytime.sleep(0.0005)
+                continue
+            self.emit_ready()
+
+
 class DispatchProcess(FrameProcess):
-    """ A class which handles taking frames from the camera and dispatch them to both a separate
-    process (e.g. for saving a movie) and to a gui for display
+    """ A class which handles taking frames from the camera and dispatch them
+    to a gui for display (the frames are recorded by reading them directly
+    from the camera)
 
     Parameters
     ----------
@@ -185,13 +460,12 @@ class DispatchProcess(FrameProcess):
         self,
         in_frame_queue,
         finished_evt: Event = None,
-        dispatching_set_evt: Event = None,
         gui_framerate=30,
         gui_dispatcher=False,
         **kwargs
     ):
         """
-        :param in_frame_queue: queue dispatching frames from camera
+        :param in_frame_queue: reader of the frames from the camera
         :param finished_evt: signal for the end of the acquisition
         :param processing_parameter_queue: queue for function&parameters
         :param gui_framerate: framerate of the display GUI
@@ -201,9 +475,7 @@ class DispatchProcess(FrameProcess):
         self.frame_queue = in_frame_queue
         self.gui_queue = TimestampedArrayQueue(max_mbytes=600)  # GUI queue
         # for displaying the image
-        self.output_frame_queue = TimestampedArrayQueue(max_mbytes=600)
 
-        self.dispatching_set_evt = dispatching_set_evt
         self.finished_signal = finished_evt
         self.gui_framerate = gui_framerate
         self.gui_dispatcher = gui_dispatcher
@@ -222,9 +494,6 @@ class DispatchProcess(FrameProcess):
             except Empty:
                 continue
 
-            if self.dispatching_set_evt.is_set():
-                self.output_frame_queue.put(frame.copy(), time)
-
             # put current frame into the GUI queue
             self.send_to_gui(time, frame)
 
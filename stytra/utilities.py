@@ -90,14 +90,34 @@ class FrameProcess(Process):
         self.name = name
         self.framerate_rec = FramerateRecorder(n_fps_frames=n_fps_frames)
         self.framerate_queue = Queue()
+        self.latency_queue = Queue()
         self.message_queue = Queue()
-
-    def update_framerate(self):
+        self.latency_sum = 0.0
+        self.n_latency = 0
+
+    def update_framerate(self, frame_time=None):
+        """ Updates the framerate, and if the time of acquisition of the
+        current frame is given, the latency (the time since the
+        acquisition, in seconds), which is averaged and sent together with the
+        framerate
+        """
+        if frame_time is not None:
+            self.latency_sum += (datetime.now() - frame_time).total_seconds()
+            self.n_latency += 1
         self.framerate_rec.update_framerate()
         if self.framerate_rec.i_fps == 0:
             self.framerate_queue.put(
                 (self.framerate_rec.current_time, self.framerate_rec.current_framerate)
             )
+            if self.n_latency > 0:
+                self.latency_queue.put(
+                    (
+                        self.framerate_rec.current_time,
+                        self.latency_sum / self.n_latency,
+                    )
+                )
+                self.latency_sum = 0.0
+                self.n_latency = 0
 
 
 def prepare_json(it, **kwargs):